@@ -0,0 +1,386 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements the force and energy backends of an argon
+    * N-body simulation and the registry from which a Box picks its
+    * backend by name.
+    * Every backend implements the same contract for the box it is bound
+    * to: the forces, the forces together with the potential energy and
+    * virial in one sweep over the pairs, and the energies. Other compiled
+    * or JIT kernels are added by subclassing Backend and decorating the
+    * class with register.
+    * The 'auto' backend times every available backend on the box when it
+    * is created and uses the fastest. The choice is cached on disk for the
+    * machine, number of particles, density and pair search method, so
+    * later runs skip the calibration.
+"""
+import copy
+import hashlib
+import json
+import os
+import platform
+import time
+import numpy as np
+import NumpyKernels
+from Particle3D import Particle3D
+from Utilities import LJ_Force, LJ_Potential, Total_PE, Total_KE
+try:
+    import accelerate_lib
+except ImportError: # C++ library not compiled, see README
+    accelerate_lib = None
+
+REGISTRY = {} # Backend classes by name, in the order they were registered
+CALIBRATION_REPEAT = 3 # Timed calls per backend after a warm-up call
+CACHE_FILE = os.environ.get('LJ_BACKEND_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'lj-nbody',
+                                         'backends.json'))
+
+
+def register(cls):
+    """ Class decorator adding a Backend subclass to REGISTRY. """
+
+    REGISTRY[cls.name] = cls
+
+    return cls
+
+
+def get(name):
+    """Returns the backend class registered as name. Raises ValueError if
+    there is none and ImportError if it cannot run here."""
+
+    if name not in REGISTRY:
+        raise ValueError('Unknown backend: %s' % name)
+    if not REGISTRY[name].available():
+        raise ImportError(REGISTRY[name].unavailable)
+
+    return REGISTRY[name]
+
+
+def available():
+    """ Returns the names of the registered backends that can run here. """
+
+    return [name for name, cls in REGISTRY.items() if cls.available()]
+
+
+class Backend(object):
+    """ CLASS VARIABLES:
+    name - Name of the backend in REGISTRY.
+    unavailable - Message of the ImportError if it cannot run here.
+    calibration_max_N - Largest number of particles for which the backend
+                        is timed by autotune, None for any number.
+    box - Box whose forces and energies are calculated.
+
+    Base class of the force and energy backends. Subclasses implement
+    forces, forces_energy and energies, and available if they depend on
+    optional modules.
+    """
+
+    name = None
+    unavailable = ''
+    calibration_max_N = None
+
+    def __init__(self, box, threads=None):
+        """
+        Binds the backend to box and sets box.threads to the number of
+        threads it uses.
+        Param:
+            box - Box whose forces and energies are calculated
+            threads - Number of threads, for backends that have several
+        """
+        self.box = box
+        box.threads = 1
+
+        return None
+
+
+    @classmethod
+    def available(cls):
+        """ Returns True if the backend can run here. """
+
+        return True
+
+
+    def forces(self, out):
+        """ Adds the forces on all particles to the zeroed [N,3] narray out
+        and returns it. """
+
+        raise NotImplementedError
+
+
+    def forces_energy(self, out):
+        """Writes the forces on all particles into the [N,3] narray out
+        and returns it with the potential energy and virial, calculated
+        in the same sweep over the pairs."""
+
+        raise NotImplementedError
+
+
+    def energies(self):
+        """ Returns the narray of the potential, kinetic and total energy. """
+
+        raise NotImplementedError
+
+
+@register
+class PythonBackend(Backend):
+    """ Pure Python loop over the pairs, one pair at a time. """
+
+    name = 'python'
+    calibration_max_N = 128 # Larger boxes take too long to time
+
+    def forces(self, out):
+        box = self.box
+        # Iterate over all candidate pairs, then calculate
+        # force for each i, j combination
+        for i, j in box.get_pairs():
+            # Get force of particle i on j, respecting pbc and mic.
+            sep = Particle3D.pbc_sep(box.particles[i], box.particles[j], box.boxdim)
+            force = LJ_Force(sep, box.LJ_cutoff, box.table)
+            out[j] += force
+            out[i] += -force # Using Newtons 3rd law
+
+        return out
+
+
+    def forces_energy(self, out):
+        box = self.box
+        out[:] = 0
+        potential, virial = 0, 0
+        for i, j in box.get_pairs():
+            sep = Particle3D.pbc_sep(box.particles[i], box.particles[j], box.boxdim)
+            force = LJ_Force(sep, box.LJ_cutoff, box.table)
+            out[j] += force
+            out[i] += -force # Using Newtons 3rd law
+            potential += LJ_Potential(sep, box.LJ_cutoff, box.table)
+            virial += np.sum(sep*force)
+
+        return out, potential, virial
+
+
+    def energies(self):
+        box = self.box
+        pot = Total_PE(box.particles, box.LJ_cutoff, box.boxdim, box.get_pairs(), box.table)
+        kin = Total_KE(box.get_velocities())
+
+        return np.array([pot, kin, pot+kin])
+
+
+@register
+class CppBackend(Backend):
+    """ C++ kernels of accelerate_lib, parallelised with OpenMP. """
+
+    name = 'cpp'
+    unavailable = 'accelerate_lib is not compiled, see README'
+
+    def __init__(self, box, threads=None):
+        """
+        Binds the backend to box and sets the number of threads of the
+        C++ kernels, by default the OMP_NUM_THREADS environment variable
+        or all cores.
+        """
+        self.box = box
+        if threads is not None:
+            accelerate_lib.c_setthreads(threads)
+        box.threads = accelerate_lib.c_getthreads()
+
+        return None
+
+
+    @classmethod
+    def available(cls):
+        return accelerate_lib is not None
+
+
+    def set_table(self):
+        """ Sets the pair potential of the C++ kernels to the box table. """
+
+        table = self.box.table
+        if table is None:
+            accelerate_lib.c_settable(None)
+        else:
+            accelerate_lib.c_settable(table.coeffs, table.s0, table.inv_h)
+
+        return None
+
+
+    def forces(self, out):
+        box = self.box
+        if(box.mixed):
+            # Only the single sweep kernels take float positions.
+            return self.forces_energy(out)[0]
+        self.set_table()
+        positions = box.get_positions()
+        if(box.method == 'verlet'):
+            box.neighbours.update(positions, box.boxdim)
+            accelerate_lib.c_getforces_list(positions, out,
+                    box.neighbours.pairs_i, box.neighbours.pairs_j,
+                    box.boxdim, box.LJ_cutoff)
+        elif(box.method == 'cells'):
+            accelerate_lib.c_getforces_cells(positions, out, box.boxdim, box.LJ_cutoff)
+        else:
+            accelerate_lib.c_getforces(positions, out, box.boxdim, box.LJ_cutoff)
+
+        return out
+
+
+    def forces_energy(self, out):
+        box = self.box
+        self.set_table()
+        energy = np.zeros(2) # Potential energy and virial
+        positions = box.get_positions()
+        # Float positions use the mixed precision kernels.
+        suffix = '_f' if box.mixed else ''
+        if(box.method == 'verlet'):
+            box.neighbours.update(positions, box.boxdim)
+            getattr(accelerate_lib, 'c_getforcesenergy_list'+suffix)(positions,
+                    out, energy, box.neighbours.pairs_i, box.neighbours.pairs_j,
+                    box.boxdim, box.LJ_cutoff)
+        elif(box.method == 'cells'):
+            getattr(accelerate_lib, 'c_getforcesenergy_cells'+suffix)(positions,
+                    out, energy, box.boxdim, box.LJ_cutoff)
+        else:
+            getattr(accelerate_lib, 'c_getforcesenergy'+suffix)(positions,
+                    out, energy, box.boxdim, box.LJ_cutoff)
+
+        return out, energy[0], energy[1]
+
+
+    def energies(self):
+        box = self.box
+        if(box.mixed):
+            forces, pot, virial = self.forces_energy(np.empty_like(box.forces))
+            kin = box.kinetic_energy()
+            return np.array([pot, kin, pot+kin])
+        self.set_table()
+        energies = np.zeros(3) # Initialises Energy output array
+        positions = box.get_positions()
+        if(box.method == 'verlet'):
+            box.neighbours.update(positions, box.boxdim)
+            accelerate_lib.c_getenergies_list(positions, box.get_velocities(), \
+                  energies, box.neighbours.pairs_i, box.neighbours.pairs_j, \
+                  box.boxdim, box.LJ_cutoff)
+        elif(box.method == 'cells'):
+            accelerate_lib.c_getenergies_cells(positions, box.get_velocities(), \
+                  energies, box.boxdim, box.LJ_cutoff)
+        else:
+            accelerate_lib.c_getenergies(positions, box.get_velocities(), \
+                  energies, box.boxdim, box.LJ_cutoff)
+
+        return energies
+
+
+@register
+class NumpyBackend(Backend):
+    """ Vectorised NumPy kernels over blocks of pairs. """
+
+    name = 'numpy'
+
+    def forces(self, out):
+        box = self.box
+        return NumpyKernels.get_forces(box.get_positions(), box.get_pair_blocks(),
+                    box.boxdim, box.LJ_cutoff, out, box.table)
+
+
+    def forces_energy(self, out):
+        box = self.box
+        out[:] = 0
+        return NumpyKernels.get_forces_energy(box.get_positions(), box.get_pair_blocks(),
+                    box.boxdim, box.LJ_cutoff, out, box.table)
+
+
+    def energies(self):
+        box = self.box
+        return NumpyKernels.get_energies(box.get_positions(), box.get_velocities(),
+                    box.masses, box.get_pair_blocks(), box.boxdim, box.LJ_cutoff,
+                    box.table)
+
+
+def calibration_key(box, threads=None):
+    """Returns the cache key of the calibration of box: the machine, the
+    available backends, the number of particles, density, cutoff, pair
+    search method, precision, whether a table is used and the number of
+    threads."""
+
+    machine = (platform.node(), platform.machine(), platform.processor(), os.cpu_count())
+    N = len(box.positions)
+    key = dict(machine=machine, backends=available(), N=N,
+               rho='%.4g' % (N/box.boxdim**3), cutoff=box.LJ_cutoff, method=box.method,
+               dtype=box.positions.dtype.name, table=box.table is not None,
+               threads=threads or os.environ.get('OMP_NUM_THREADS'))
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def read_cache(filename=CACHE_FILE):
+    """ Returns the dict of cached calibrations, empty if there is none. """
+
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(cache, filename=CACHE_FILE):
+    """Writes the dict of calibrations to filename, replacing it in one
+    step so that concurrent runs never read half a file. A cache that
+    cannot be written is skipped."""
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        temporary = '%s.%i.tmp' % (filename, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(temporary, filename)
+    except OSError:
+        pass
+
+    return None
+
+
+def calibrate(box, threads=None, repeat=CALIBRATION_REPEAT):
+    """Returns the dict of the fastest time of a force and energy sweep
+    of box for every available backend, after one warm-up call. The
+    state of box is not changed."""
+
+    N = len(box.positions)
+    out = np.empty_like(box.forces)
+    neighbours = copy.deepcopy(box.neighbours)
+    times = {}
+    for name in available():
+        cls = REGISTRY[name]
+        if cls.calibration_max_N is not None and N > cls.calibration_max_N:
+            continue
+        kernels = cls(box, threads)
+        kernels.forces_energy(out)
+        times[name] = np.inf
+        for r in range(repeat):
+            start = time.perf_counter()
+            kernels.forces_energy(out)
+            times[name] = min(times[name], time.perf_counter() - start)
+    box.neighbours = neighbours
+
+    return times
+
+
+def autotune(box, threads=None, cache=CACHE_FILE):
+    """Returns the name of the fastest available backend for box, from
+    the cache file if it holds a calibration of the same kind of box on
+    this machine, and otherwise by timing every backend with calibrate
+    and saving the result to the cache. cache None skips the cache."""
+
+    key = calibration_key(box, threads)
+    calibrations = read_cache(cache) if cache else {}
+    if key in calibrations and calibrations[key]['backend'] in available():
+        print("Backend %s from the calibration cache.\n" % calibrations[key]['backend'])
+        return calibrations[key]['backend']
+
+    times = calibrate(box, threads)
+    fastest = min(times, key=times.get)
+    print("Backend calibration: %s, using %s.\n" % (', '.join('%s %.3g s' % item
+                                                    for item in times.items()), fastest))
+    if cache:
+        calibrations = read_cache(cache)
+        calibrations[key] = dict(backend=fastest, seconds=times,
+                                 N=len(box.positions), method=box.method)
+        write_cache(calibrations, cache)
+
+    return fastest
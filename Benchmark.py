@@ -0,0 +1,221 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements a benchmark suite for the hot paths of an
+    * argon N-body simulation: Box.get_forces, Box.get_energies, a velocity
+    * Verlet step, and the RDF and MSD analysis. They are timed over a sweep
+    * of particle numbers, the states in the parameter files, the backends
+    * and the pair search methods. The results are saved as JSON and
+    * compared against a stored baseline to catch regressions. The first
+    * run on a machine saves its results as the baseline BASELINE, which
+    * later runs are compared against.
+    * Usage:
+    * python3 Benchmark.py [--sizes=108,256,500] [--states=solid.txt,liquid.txt,gas.txt]
+    *     [--backends=python,cpp,numpy] [--methods=allpairs,cells]
+    *     [--repeat=5] [--output=benchmark.json]
+    *     [--baseline=benchmark_baseline.json] [--tolerance=0.25]
+    * The exit status is 1 if any case is more than tolerance slower than
+    * in the baseline.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+import numpy as np
+import Box
+from Utilities import RDF, MSD_FFT, read_parameters
+
+BASELINE = 'benchmark_baseline.json' # Baseline results of this machine
+PYTHON_MAX_N = 256 # Larger boxes take too long with the Python backend
+RDF_FRAMES = 20 # Frames of the synthetic trajectory timed for the RDF
+MSD_FRAMES = 1000 # and for the MSD
+KEY = ('state', 'N', 'backend', 'method', 'case') # Identifies a result
+
+
+def read_state(paramfile):
+    """Returns the density, LJ cutoff, temperature and timestep from a
+    parameter file."""
+
+    N, rho, cutoff, T, dt, nsteps = read_parameters(paramfile)[0]
+
+    return rho, cutoff, T, dt
+
+
+def timeit(function, repeat):
+    """Calls function repeat times after one warm-up call and returns
+    the minimum and median wall time of a call in seconds."""
+
+    function()
+    times = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times), float(np.median(times))
+
+
+def make_box(N, rho, cutoff, T, backend, method):
+    """Returns a Box, silencing its initialisation output. The velocities
+    are seeded so every run times the same state."""
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Box.Box(N, cutoff, rho, T, backend, method=method, seed=0)
+
+
+def run_box_cases(box, dt, repeat):
+    """Yields (case, min, median) timings of the force, energy and
+    integration hot paths of box."""
+
+    yield ('forces',) + timeit(lambda: box.get_forces(out=box.forces), repeat)
+    yield ('energies',) + timeit(box.get_energies, repeat)
+    box.get_forces_energy(out=box.forces)
+    buffer = [np.empty_like(box.forces)]
+    def step():
+        buffer[0] = box.step(dt, buffer[0])
+        box.enforce_pbc()
+    yield ('step',) + timeit(step, repeat)
+
+
+def run_analysis_cases(box, repeat):
+    """Yields (case, min, median) timings of the RDF and MSD on a
+    synthetic trajectory of random displacements from the box state."""
+
+    rng = np.random.default_rng(0)
+    frames = box.positions + np.cumsum(rng.normal(0, 0.01,
+                (MSD_FRAMES,) + box.positions.shape), axis=0)
+    frames = np.mod(frames, box.boxdim)
+    bins = np.arange(0, box.boxdim/2, 0.1)
+    yield ('rdf',) + timeit(lambda: RDF(frames, 0, RDF_FRAMES, bins, box.boxdim,
+                                        processes=1), repeat)
+    yield ('msd',) + timeit(lambda: MSD_FFT(frames, 0, MSD_FRAMES-1, box.boxdim), repeat)
+
+
+def run(sizes, states, backends, methods, repeat):
+    """Runs the benchmark sweep and returns a list of result dicts."""
+
+    results = []
+    for state in states:
+        rho, cutoff, T, dt = read_state(state)
+        for N in sizes:
+            for backend in backends:
+                if backend == 'cpp' and Box.accelerate_lib is None:
+                    continue
+                if backend == 'python' and N > PYTHON_MAX_N:
+                    continue
+                for method in methods:
+                    box = make_box(N, rho, cutoff, T, backend, method)
+                    for case, fastest, median in run_box_cases(box, dt, repeat):
+                        results.append(dict(state=state, N=N, backend=backend,
+                                            method=method, case=case,
+                                            seconds=fastest, median=median))
+                        print('%-11s N=%-6i %-7s %-9s %-9s %12.6f s' % (state, N,
+                              backend, method, case, fastest))
+            box = make_box(N, rho, cutoff, T, 'numpy', 'allpairs')
+            for case, fastest, median in run_analysis_cases(box, repeat):
+                results.append(dict(state=state, N=N, backend='numpy',
+                                    method='', case=case,
+                                    seconds=fastest, median=median))
+                print('%-11s N=%-6i %-7s %-9s %-9s %12.6f s' % (state, N,
+                      'numpy', '', case, fastest))
+
+    return results
+
+
+def machine_info():
+    """Returns a dict describing the machine and software versions."""
+
+    threads = None
+    if Box.accelerate_lib is not None:
+        threads = Box.accelerate_lib.c_getthreads()
+
+    return dict(platform=platform.platform(), processor=platform.processor(),
+                python=platform.python_version(), numpy=np.__version__,
+                cpus=os.cpu_count(), cpp_threads=threads,
+                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def compare(results, baseline, tolerance):
+    """Prints the ratio of each result to the matching baseline result
+    and returns the list of keys that are more than tolerance slower."""
+
+    reference = {tuple(r[k] for k in KEY): r['seconds'] for r in baseline}
+    regressions = []
+    print('\n%-11s %-7s %-7s %-9s %-9s %8s' % ('state', 'N', 'backend', 'method',
+                                              'case', 'ratio'))
+    for r in results:
+        key = tuple(r[k] for k in KEY)
+        if key not in reference:
+            continue
+        ratio = r['seconds']/reference[key]
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('%-11s %-7i %-7s %-9s %-9s %8.3f%s' % (key + (ratio, flag)))
+
+    return regressions
+
+
+def get_arguments(argv=None):
+    """ Parses the command line argv (sys.argv[1:] by default). """
+
+    def names(value):
+        return value.split(',')
+
+    def sizes(value):
+        return [int(n) for n in value.split(',')]
+
+    parser = argparse.ArgumentParser(prog='Benchmark.py',
+                description='Benchmark of the hot paths of the simulation.')
+    parser.add_argument('--sizes', type=sizes, default=[108, 256, 500],
+                        help='particle numbers, comma separated')
+    parser.add_argument('--states', type=names, default=['solid.txt', 'liquid.txt', 'gas.txt'],
+                        help='parameter files of the states, comma separated')
+    parser.add_argument('--backends', type=names, default=['python', 'cpp', 'numpy'],
+                        help='backends, comma separated')
+    parser.add_argument('--methods', type=names, default=['allpairs', 'cells'],
+                        help='pair search methods, comma separated')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per case')
+    parser.add_argument('--output', default='benchmark.json', help='JSON results file')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='JSON results to compare against, saved there if missing, '
+                             'empty for none')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown reported as a regression')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = get_arguments(argv)
+
+    results = run(options.sizes, options.states, options.backends, options.methods,
+                  options.repeat)
+    with open(options.output, 'w') as f:
+        json.dump({'machine': machine_info(), 'results': results}, f, indent=1)
+    print('Benchmark results written to ' + options.output)
+
+    if options.baseline and os.path.exists(options.baseline):
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+        # Timings only compare on the same kind of machine.
+        machine = machine_info()
+        if any(baseline['machine'][k] != machine[k] for k in ('processor', 'cpus')):
+            print('Note: the baseline was run on another machine (%s, %s cpus)'
+                  % (baseline['machine']['processor'], baseline['machine']['cpus']))
+        regressions = compare(results, baseline['results'], options.tolerance)
+        if regressions:
+            print('%i cases are more than %s slower than the baseline'
+                  % (len(regressions), options.tolerance))
+            sys.exit(1)
+        print('No regressions against ' + options.baseline)
+    elif options.baseline:
+        shutil.copyfile(options.output, options.baseline)
+        print('No baseline found, results saved as the baseline ' + options.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,85 @@
 """ * Authors: C. Kourris and Ethan van Woerkom
     * This module implements the Box class and
     * methods for an argon N-body simulation.
-    * A box object holds a list of N particles which are initialised given
+    * A box object holds the state of N particles which is initialised given
     * the temperature and density. It represents the entire system in which
     * the simulation runs.
+    * The state is stored as a structure of arrays, with one contiguous
+    * [N,3] narray each for positions, velocities and forces, so that the
+    * integration is done with whole-array in-place operations.
+    * In mixed precision the positions and velocities are float32 arrays,
+    * the pair interactions are evaluated in single precision and the
+    * forces and energies are summed in double precision.
 """
 
-from Particle3D import Particle3D
+from Particle3D import Particle3D, ParticleList
 import MDUtilities
 from Utilities import *
+from Neighbours import iter_cell_pairs, spatial_order, NeighbourList
+import NumpyKernels
+import Domains
+import Output
+import Trajectory
+import Checkpoint
+import Profiling
 import numpy as np
+import os
+import random
 import time
 import sys
-import accelerate_lib
+import Backends
+from Backends import accelerate_lib
+
+
+def choose_backend(backend=None):
+    """Returns the backend to run with: backend, or if None the C++
+    backend when accelerate_lib is compiled and otherwise NumPy. If the
+    C++ backend is asked for but not compiled, falls back to NumPy with
+    a warning."""
+
+    if backend is None:
+        return 'cpp' if accelerate_lib is not None else 'numpy'
+    if backend == 'cpp' and accelerate_lib is None:
+        print('accelerate_lib is not compiled, see README. Using the NumPy backend.\n')
+        return 'numpy'
+
+    return backend
 
 class Box:
     """ CLASS VARIABLES:
-    particles - List containing information about all particles.
+    positions, velocities, forces - [N,3]-dim float narrays of the state,
+                                    positions and velocities of dtype.
+    masses - [N]-dim float narray of particle masses.
+    particles - ParticleList of the ParticleView objects of the rows of
+                the arrays, created when indexed.
     boxdim - Dimension of box.
     LJ_cutoff - Lennard-Jones cutoff distance.
-    cppenabled - True for C++ acceleration, False for Python only.
+    backend - Name of the force and energy backend, see Backends: 'cpp'
+              for C++ acceleration, 'numpy' for the vectorised NumPy
+              kernels or 'python' for Python only.
+    kernels - Backends.Backend instance calculating the forces and
+              energies.
+    block - Number of pairs per block in the NumPy kernels.
+    threads - Number of threads used by the C++ kernels.
+    method - Pair search method, 'allpairs' to evaluate every pair,
+             'cells' to only evaluate pairs in the same or adjacent cells or
+             'verlet' to evaluate the pairs of a Verlet neighbour list.
+    neighbours - NeighbourList kept between steps if method is 'verlet'.
+    potential, virial - Potential energy and virial sum of r.F of the
+                        last call to get_forces_energy.
+    profiler - Profiling.Profiler of the running simulation, or a
+               NullProfiler.
+    table - Tables.PairTable of the pair potential, or None for the
+            analytic Lennard-Jones kernels.
+    order - [N]-dim int narray of the original number of the particle in
+            each row after the rows have been reordered, or None.
     """
 
-    def __init__(self, N, LJ_cutoff, rho, T, cpp):
+    METHODS = ('allpairs', 'cells', 'verlet')
+
+    def __init__(self, N, LJ_cutoff, rho, T, backend, method='allpairs', skin=0.3,
+                 block=NumpyKernels.DEFAULT_BLOCK, threads=None, table=None,
+                 dtype=np.float64, seed=None):
         """
         Initialises simulation box with given parameters using
         function from MDUtilities.py to set particle positions and velocities.
@@ -31,19 +88,61 @@ class Box:
             LJ_cutoff - Lennard Jones cutoff Distance
             rho - number density
             T - Initial temperature
-            cpp - Boolean indicating C++ acceleration or not
+            backend - Name of a registered backend, see Backends, or
+                      'auto' for the fastest one on this machine. True and
+                      False are accepted for 'cpp' and 'python'.
+            method - Pair search method, see METHODS
+            skin - Verlet neighbour list skin distance
+            block - Number of pairs per block in the NumPy kernels
+            threads - Number of C++ kernel threads, defaults to the
+                      OMP_NUM_THREADS environment variable or all cores
+            table - Tables.PairTable of a tabulated pair potential to use
+                    instead of Lennard-Jones, with the same cutoff
+            dtype - Float type of the positions and velocities, np.float32
+                    for mixed precision
+            seed - Seed of the numpy Generator of the initial velocities,
+                   by default drawn from the random module, so that
+                   random.seed also reproduces a run
         """
+        if backend is True or backend is False:
+            backend = 'cpp' if backend else 'python'
+        if backend != 'auto':
+            Backends.get(backend)
+        if method not in self.METHODS:
+            raise ValueError('Unknown force method: %s' % method)
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError('Positions must be float32 or float64, not %s' % dtype)
         print("Box initialised with T=%f, number density=%f. \n"%(T, rho))
-        # Initialise list of particles with zero position and velocity
-        # and label equal to their number
-        self.particles = [Particle3D(str(i)) for i in range(1,N+1)]
+        # Initialise particle arrays with zero position and velocity,
+        # and the sequence of particle views with label equal to their number
+        self.positions = np.zeros((N,3), dtype=dtype)
+        self.velocities = np.zeros((N,3), dtype=dtype)
+        self.forces = np.zeros((N,3))
+        self.masses = np.ones(N)
+        self.particles = ParticleList(self)
 
         self.LJ_cutoff = LJ_cutoff # Save LJ_cutoff distance.
-        self.cppenabled = cpp
-
-        # Set particle positions, get box dimensions:
-        self.boxdim = MDUtilities.set_initial_positions(rho, self.particles)[0]
-        MDUtilities.set_initial_velocities(T, self.particles) # Set velocities
+        self.block = block
+        self.method = method
+        self.neighbours = NeighbourList(LJ_cutoff, skin) if method == 'verlet' else None
+        self.table = table
+        self.potential, self.virial = 0, 0
+        self.profiler = Profiling.NullProfiler()
+        self.order = None
+
+        # Set particle positions, get box dimensions. The box dimension is
+        # a Python float, so that arithmetic with float32 positions stays
+        # in single precision.
+        self.boxdim = float(MDUtilities.set_initial_positions(rho, self.positions)[0])
+        rng = np.random.default_rng(random.getrandbits(128) if seed is None else seed)
+        MDUtilities.set_initial_velocities(T, self.velocities, rng) # Set velocities
+
+        # Bind the backend, with 'auto' timing all of them on this box first.
+        if backend == 'auto':
+            backend = Backends.autotune(self, threads)
+        self.backend = backend
+        self.kernels = Backends.get(backend)(self, threads)
 
         return None
 
@@ -51,96 +150,225 @@ class Box:
     def update_vel(self, forces, dt):
         """
         Conducts first order velocity update given
-        an narray of forces on all particles, using v = v + F*dt
+        an narray of forces on all particles, using v = v + F*dt/m
         """
 
-        for particle, force in zip(self.particles, forces):
-            particle.leap_velocity(dt, force)
+        self.velocities += (dt/self.masses)[:,None]*forces
         return None
 
 
     def update_pos(self, forces, dt):
         """
         Conducts second order position update given an narray
-        of forces on all particles, using x = x + v*dt + 0.5*F*dt^2.
+        of forces on all particles, using x = x + v*dt + 0.5*F*dt^2/m.
         """
 
-        for particle, force in zip(self.particles, forces):
-            particle.leap_position(dt, force)
+        self.positions += dt*self.velocities
+        self.positions += (0.5*dt**2/self.masses)[:,None]*forces
         return None
 
 
     def get_positions(self):
-        """ Returns [N,3]-dim narray of positions of all particles. """
+        """ Returns [N,3]-dim narray of positions of all particles.
+        This is the Box's own array, copy it to keep a snapshot. """
 
-        return np.array([p.position for p in self.particles])
+        return self.positions
 
 
     def get_velocities(self):
-        """ Returns [N,3]-dim narray of velocities of all particles."""
+        """ Returns [N,3]-dim narray of velocities of all particles.
+        This is the Box's own array, copy it to keep a snapshot. """
 
-        return np.array([p.velocity for p in self.particles])
+        return self.velocities
 
 
-    def get_forces(self):
-        """Returns [N,3]-dim narray of forces on all particles."""
+    def original_order(self, array):
+        """Returns the per particle narray array, e.g. the positions,
+        with its rows in the original order of the particles. This is
+        array itself if the rows have not been reordered."""
+
+        if self.order is None:
+            return array
+        ordered = np.empty_like(array)
+        ordered[self.order] = array
+
+        return ordered
+
+
+    def permute(self, perm):
+        """
+        Reorders the particles so that new row k holds old row perm[k].
+        The positions, velocities, forces and masses are permuted
+        together, the Verlet list is renumbered and the permutation is
+        added to self.order.
+        """
+
+        for array in (self.positions, self.velocities, self.forces, self.masses):
+            array[:] = array[perm]
+        self.order = perm if self.order is None else self.order[perm]
+        if self.neighbours is not None:
+            self.neighbours.permute(perm)
+
+        return None
+
+
+    def reorder(self):
+        """
+        Sorts the particles along a Morton space-filling curve through
+        the cells of side the cutoff, see Neighbours.spatial_order, so
+        that particles which interact are close together in memory.
+        """
+
+        self.permute(spatial_order(self.positions, self.boxdim, self.LJ_cutoff))
+
+        return None
+
+
+    def restore_order(self):
+        """ Puts the particles back in their original order. """
+
+        if self.order is not None:
+            self.permute(np.argsort(self.order))
+            self.order = None
+
+        return None
+
+
+    @property
+    def cppenabled(self):
+        """ True if the C++ acceleration backend is used. """
+
+        return self.backend == 'cpp'
+
+
+    @property
+    def mixed(self):
+        """ True if the positions and velocities are single precision. """
+
+        return self.positions.dtype == np.float32
+
+
+    def get_pair_blocks(self):
+        """
+        Returns an iterable of blocks of index narrays (i, j) of at most
+        block pairs whose interaction has to be evaluated, depending on
+        the pair search method.
+        """
+
+        if(self.method == 'verlet'):
+            self.neighbours.update(self.get_positions(), self.boxdim)
+            return NumpyKernels.split_blocks(self.neighbours.pairs_i,
+                                             self.neighbours.pairs_j, self.block)
+        if(self.method == 'cells'):
+            return (block for i, j in iter_cell_pairs(self.get_positions(),
+                                                      self.boxdim, self.LJ_cutoff)
+                    for block in NumpyKernels.split_blocks(i, j, self.block))
+
+        return NumpyKernels.allpairs_blocks(len(self.particles), self.block)
+
+
+    def pair_counts(self):
+        """
+        Returns the number of pairs evaluated by the pair search method
+        and the number of those within the cutoff. The Verlet list is
+        counted as it is, without checking whether it needs a rebuild.
+        """
+
+        if(self.method == 'verlet'):
+            blocks = NumpyKernels.split_blocks(self.neighbours.pairs_i,
+                                               self.neighbours.pairs_j, self.block)
+        else:
+            blocks = self.get_pair_blocks()
+        evaluated, within = 0, 0
+        for i, j in blocks:
+            r2 = NumpyKernels.pair_separations(self.positions, i, j, self.boxdim)[1]
+            evaluated += len(i)
+            within += int(np.count_nonzero(r2 < self.LJ_cutoff**2))
+
+        return evaluated, within
+
+
+    def get_pairs(self):
+        """
+        Returns an iterable of the (i, j) index pairs whose interaction
+        has to be evaluated, depending on the pair search method.
+        """
+
+        return (pair for i, j in self.get_pair_blocks() for pair in zip(i, j))
+
+
+    def get_forces(self, out=None):
+        """Returns [N,3]-dim narray of forces on all particles.
+        If out is given the forces are written into that narray instead
+        of a newly allocated one."""
 
         N = len(self.particles)
-        particle_forces = np.zeros( (N,3) ) # Initialises force output array.
-
-        # Use C++ version if cppenabled
-        if(self.cppenabled):
-            accelerate_lib.c_getforces(self.get_positions(), particle_forces,
-                        self.boxdim, self.LJ_cutoff)
-            return particle_forces
-
-        # Python calculation if cppenabled = False:
-        # Iterate over all i<j, then calculate
-        # force for each i, j combination
-        for i in range(N):
-            for j in range(i):
-                # Get force of particle i on j, respecting pbc and mic.
-                sep = Particle3D.pbc_sep(self.particles[i], self.particles[j], self.boxdim)
-                force = LJ_Force(sep, self.LJ_cutoff)
-                particle_forces[j] += force
-                particle_forces[i] += -force # Using Newtons 3rd law
+        # Initialises force output array.
+        if out is None:
+            particle_forces = np.zeros( (N,3) )
+        else:
+            particle_forces = out
+            particle_forces[:] = 0
 
-        return particle_forces
+        return self.kernels.forces(particle_forces)
 
     def get_energies(self):
         """Returns 1x3 array of Kinetic, Potential and Total energy at time t
         """
+
+        return self.kernels.energies()
+
+
+    def get_forces_energy(self, out=None):
+        """
+        Returns [N,3]-dim narray of forces on all particles, calculating
+        the potential energy and virial in the same sweep over the pairs.
+        These are saved in self.potential and self.virial. If out is given
+        the forces are written into that narray.
+        """
+
         N = len(self.particles)
+        particle_forces = np.zeros( (N,3) ) if out is None else out
+        particle_forces, self.potential, self.virial = self.kernels.forces_energy(
+                                                                    particle_forces)
+
+        return particle_forces
 
-        # Use C++ version if cppenabled
-        if(self.cppenabled):
-            energies = np.zeros(3) # Initialises Energy output array
-            accelerate_lib.c_getenergies(self.get_positions(), self.get_velocities(), \
-                  energies, self.boxdim, self.LJ_cutoff)
-            return np.array(energies)
 
-        # Python calculation if cppenabled = False:
-        pot = Total_PE(self.particles, self.LJ_cutoff, self.boxdim)
-        kin = Total_KE(self.get_velocities())
+    def kinetic_energy(self):
+        """ Returns the total kinetic energy of all particles. """
 
-        return np.array([pot, kin, pot+kin])
+        return 0.5*np.sum(self.masses*np.einsum('ij,ij->i', self.velocities,
+                                                 self.velocities))
+
+
+    def pressure(self, kinetic=None):
+        """
+        Returns the pressure from the virial theorem, P = (2*K + W)/(3*V),
+        using the virial W of the last call to get_forces_energy and the
+        kinetic energy K, which is calculated if not given.
+        """
+
+        if kinetic is None:
+            kinetic = self.kinetic_energy()
+
+        return (2*kinetic + self.virial)/(3*self.boxdim**3)
 
 
     def VMD_string(self, time):
         """
         Produces a string in the VMD format giving the state of the
-        current system, with Point = T. Uses the Particle3D.__str__ method.
+        current system, with Point = T, in the format of the
+        Particle3D.__str__ method.
         """
-        # First add preamble:
+        # Preamble:
         # N_data
         # Point = time
-        # ...
-        VMD_output_string = '%i\nPoint = %i\n' % (len(self.particles), time)
-        # Concatenate labels and positions for each particle
-        for p in self.particles:
-            VMD_output_string += "s"+str(p) + '\n'
+        # followed by s<label> x y z for each particle
+        labels = self.particles.labels
 
-        return VMD_output_string
+        return Output.vmd_frame(Output.vmd_format(labels), self.original_order(self.positions),
+                                time)
 
     def enforce_pbc(self):
         """
@@ -148,65 +376,231 @@ class Box:
         has strayed outside the box back into the box according to pbc.
         """
 
-        for particle in self.particles:
-            particle.position = np.mod(particle.position,self.boxdim)
+        np.mod(self.positions, self.boxdim, out=self.positions)
 
         return None
 
 
-    def simulate(self, outputfile, nsteps, dt):
+    def step(self, dt, old_forces):
+        """
+        Advances the box by one velocity Verlet step of size dt, starting
+        from the forces in self.forces. The new forces, potential energy
+        and virial are calculated into old_forces, which becomes
+        self.forces. Returns the previous forces array, to be passed as
+        the buffer of the next step.
+        """
+
+        # Updates positions
+        self.update_pos(self.forces, dt)
+        self.profiler.lap('integrate')
+        self.forces, old_forces = old_forces, self.forces
+        self.get_forces_energy(out=self.forces)
+        self.profiler.lap('forces')
+        # Update velocities with the average of old and new forces
+        self.update_vel(old_forces, 0.5*dt)
+        self.update_vel(self.forces, 0.5*dt)
+        self.profiler.lap('integrate')
+
+        return old_forces
+
+
+    def simulate(self, outputfile, nsteps, dt, stride=1, keep_positions=True,
+                 energyfile="energyfile.txt", precision=4, save_velocities=False,
+                 observers=(), checkpoint_interval=0, checkpointfile="checkpoint.npz",
+                 restart=None, profiler=None, timestep=None, reorder_interval=0):
         """
         Runs a Verlet n-body simulation on the initialised box for nsteps
-        with timestep dt, and returns [nsteps,N,3]-dim position
-        narray and a nsteps-length time narray.
+        with timestep dt, and returns [nframes,N,3]-dim position
+        narray and a nframes-length time narray, with a frame saved
+        every stride steps. With an adaptive timestep the size of each
+        step varies and the times of the frames are not evenly spaced.
+        The VMD frames and energies are written to file in chunks while
+        the simulation runs, the energies from a background thread, so
+        memory use does not depend on nsteps unless the positions are
+        kept.
+        If outputfile ends in .traj the frames are written in the binary
+        format of Trajectory.py instead of the VMD format.
         Params:
             outputfile - Name of the outputfile for the VMD data
             nsteps - Number of timesteps to run the simulation
             dt - Timestep size
+            stride - Number of steps between saved frames
+            keep_positions - If False no positions are kept in memory
+                             and None is returned instead
+            energyfile - Name of the outputfile for the energies, binary
+                         if it ends in .bin
+            precision - Bytes per float in a binary trajectory, 4 or 8
+            save_velocities - Whether a binary trajectory stores velocities
+            observers - Observers from Observers.py, each given the Box at
+                        the steps it samples to analyse the run as it goes
+            checkpoint_interval - Number of steps between checkpoints
+                                  written to checkpointfile, 0 for none
+            checkpointfile - Name of the checkpoint file, see Checkpoint.py
+            restart - Checkpoint state from Checkpoint.read to continue
+                      from. The run resumes at its step and appends to the
+                      output files, cut back to their length at that step.
+            profiler - Profiling.Profiler recording the time of each phase
+                       of the loop, the pairs evaluated and the bytes written
+            timestep - Timestep.AdaptiveTimestep choosing the size of each
+                       step, dt is then only the nominal timestep
+            reorder_interval - Number of steps between sorting the
+                               particles along a space-filling curve, see
+                               reorder, 0 for never. The output, observers
+                               and returned positions keep the original
+                               order, and the box is put back in it at the
+                               end.
         Returns:
-            positions - [nsteps,N,3]-dim position numpy array for all timestep
-            timelist - [N]-dim narray containing timestamps for each timestep.
+            positions - [nframes,N,3]-dim position numpy array of the frames
+                        of this call (from the restart step on), or None
+            timelist - [nframes]-dim narray containing timestamps for each frame.
         """
         starttime = time.process_time() # For simulation length timing purposes
-        # Initialisation of all the lists used throughout simulations.
-        timelist, VMD_list, positions, velocities = [], [], [], [];
-        KE, PE, TE = [], [], []
-
-        # Calculate initial forces.
-        forces = self.get_forces()
-        for t in range(nsteps):
-            positions.append(self.get_positions()) #Save position
+        first, now = 0, 0.0
+        if restart is not None:
+            Checkpoint.restore(self, restart)
+            Checkpoint.truncate_outputs(restart)
+            first, now = restart['step'], restart['time']
+            if timestep is not None:
+                timestep.dt = restart['step_size']
+        mode = 'a' if restart is not None else 'w'
+        frames = range(0, nsteps, stride)[-(-first//stride):] # Frames from first on
+        timelist = np.empty(len(frames))
+        start_time = now
+        positions = np.empty((len(frames),)+self.positions.shape, dtype=self.positions.dtype) \
+                    if keep_positions else None
+        if outputfile.endswith(Trajectory.EXTENSION):
+            vmd = Trajectory.TrajectoryWriter(outputfile, len(self.particles),
+                        self.boxdim, precision, save_velocities, mode=mode)
+        else:
+            vmd = Output.XYZWriter(outputfile, self.particles.labels, mode=mode)
+        # Energies are written by a background thread, as raw float64
+        # rows if energyfile ends in .bin.
+        energies = Output.AsyncRecordWriter(energyfile, 5, mode=mode,
+                        binary=energyfile.endswith(Output.BINARY_EXTENSION))
+
+        profiler = self.profiler = profiler or Profiling.NullProfiler()
+        sizes = [os.path.getsize(outputfile), os.path.getsize(energyfile)]
+        profiler.begin(first, nsteps, dt)
+
+        # Calculate initial forces and potential energy, old_forces is the
+        # buffer that holds the forces of the previous step. A restart
+        # continues with the checkpointed forces.
+        if restart is None:
+            self.get_forces_energy(out=self.forces)
+        old_forces = np.empty_like(self.forces)
+        profiler.lap('setup')
+        for t in range(first, nsteps):
+            if timestep is None:
+                now = t*dt
+            if checkpoint_interval and t % checkpoint_interval == 0 and t > first:
+                # Outputs are on disk up to this step before it is saved.
+                vmd.flush()
+                energies.sync()
+                Checkpoint.write(checkpointfile, self, t, dt, nsteps, stride,
+                                 {outputfile: os.path.getsize(outputfile),
+                                  energyfile: os.path.getsize(energyfile)},
+                                 now, dt if timestep is None else timestep.dt)
+                profiler.lap('checkpoint')
+            if profiler.enabled and (t % profiler.count_interval == 0 or t == first):
+                # Each count stands for the steps up to the next one.
+                covered = min((t//profiler.count_interval + 1)*profiler.count_interval,
+                              nsteps) - t
+                for name, count in zip(('pairs evaluated', 'pairs within cutoff'),
+                                       self.pair_counts()):
+                    profiler.count(name, count*covered)
+                profiler.lap('counting')
+            if reorder_interval and t % reorder_interval == 0:
+                self.reorder()
+                profiler.lap('reorder')
+            if t % stride == 0:
+                timelist[(t - frames.start)//stride] = now
+                if keep_positions: #Save position
+                    positions[(t - frames.start)//stride] = self.original_order(
+                                                                self.get_positions())
             self.enforce_pbc() # Enforce periodic boundary conditions.
-            velocities.append(self.get_velocities()) # Save velocities
-            timelist.append(t*dt) # Save time stamp
-            VMD_list.append(self.VMD_string(t)) # Save VMD data to temporary list
-
-            # Calculate and save energies in lists
-            energies = self.get_energies()
-            PE.append(energies[0])
-            KE.append(energies[1])
-            TE.append(energies[2])
-
-            # Updates positions
-            self.update_pos(forces, dt)
-            temp_forces = forces
-            forces = self.get_forces()
-            # Update velocities
-            self.update_vel(0.5*(temp_forces + forces), dt)
-
-        # Output VMD data to file
-        vmdstring = ''.join(VMD_list)
-        with open(outputfile, 'w') as out:
-            out.write(vmdstring)
-            print('Succesful VMD Data write to '+outputfile+'\n')
-
-        # Output energy data to file
-        write_output("energyfile.txt", timelist, PE, KE, TE)
-        print('Successful Energies write to energyfile.txt \n')
+            profiler.lap('pbc')
+            if t % stride == 0:
+                vmd.write(self.original_order(self.positions), t, now,
+                          self.original_order(self.velocities)) # Write frame
+                profiler.lap('output')
+            for observer in observers:
+                observer.observe(self, t, now)
+            profiler.lap('observers')
+
+            # Write energies and pressure, the potential energy and
+            # virial are those calculated together with the current forces.
+            kinetic = self.kinetic_energy()
+            energies.write(now, self.potential, kinetic, self.potential + kinetic,
+                           self.pressure(kinetic))
+            profiler.lap('energies')
+
+            if timestep is None:
+                old_forces = self.step(dt, old_forces)
+            else:
+                step_size, old_forces = timestep.advance(self, old_forces)
+                now += step_size
+            profiler.step_done(t)
+        profiler.end_progress()
+
+        # Write the remaining output to file
+        vmd.close()
+        print('Succesful VMD Data write to '+outputfile+'\n')
+        energies.close()
+        print('Successful Energies write to '+energyfile+' \n')
+        profiler.lap('output')
+        profiler.count('bytes written', os.path.getsize(outputfile) - sizes[0] +
+                       os.path.getsize(energyfile) - sizes[1])
+        if timestep is None:
+            now = nsteps*dt
+        profiler.end(now - start_time)
+        self.profiler = Profiling.NullProfiler()
+        self.restore_order()
 
         # Print simulation total runtime in seconds
         runtime = time.process_time() - starttime
         print('Simulate method ran for %f seconds\n'%runtime)
+        if(self.neighbours is not None):
+            print('Neighbour list was rebuilt %i times\n'%self.neighbours.rebuilds)
+        if(timestep is not None):
+            print(timestep.summary()+'\n')
+
 
+        return positions, timelist
 
-        return np.array(positions), np.array(timelist)
+
+    def simulate_domains(self, nsteps, dt, nworkers, energyfile="energyfile.txt"):
+        """
+        Runs a Verlet n-body simulation like simulate, but with the box
+        split into nworkers slabs that are integrated by separate worker
+        processes, see Domains.py. The Box state is updated to the final
+        state. Only the energies are written, to energyfile.
+        Params:
+            nsteps - Number of timesteps to run the simulation
+            dt - Timestep size
+            nworkers - Number of domains and worker processes
+            energyfile - Name of the outputfile for the energies, binary
+                         if it ends in .bin
+        Returns:
+            timelist - [nsteps]-dim narray containing timestamps for each timestep.
+        """
+        starttime = time.time()
+
+        energies = Domains.simulate_domains(self.positions, self.velocities, self.masses,
+                        self.boxdim, self.LJ_cutoff, dt, nsteps, nworkers, self.block,
+                        self.table)
+        PE, KE, virial = energies.T
+        timelist = dt*np.arange(nsteps)
+        P = (2*KE + virial)/(3*self.boxdim**3)
+
+        # The same records as those of simulate, written in one go.
+        energies = Output.AsyncRecordWriter(energyfile, 5,
+                        binary=energyfile.endswith(Output.BINARY_EXTENSION))
+        for record in zip(timelist, PE, KE, PE+KE, P):
+            energies.write(*record)
+        energies.close()
+        print('Successful Energies write to '+energyfile+' \n')
+
+        runtime = time.time() - starttime
+        print('Simulate method ran for %f seconds on %i domains\n'%(runtime, nworkers))
+
+        return timelist
@@ -0,0 +1,146 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements checkpoints of an argon N-body simulation.
+    * A checkpoint is a binary .npz file holding everything needed to
+    * continue a Box.simulate run bit for bit: the particle arrays, the
+    * forces, potential energy and virial of the current step, the
+    * neighbour list, the random number generator states, the run
+    * parameters and the lengths of the output files at the step.
+    * A checkpoint only restarts a box of the same precision and pair
+    * potential, as the run would otherwise not continue bit for bit.
+"""
+import hashlib
+import os
+import random
+import numpy as np
+
+EXTENSION = '.npz'
+
+
+def table_key(table):
+    """Returns a hash of the coefficients and grid of the Tables.PairTable
+    table, or '' for the analytic Lennard-Jones kernels."""
+
+    if table is None:
+        return ''
+    grid = np.array([table.s0, table.inv_h])
+
+    return hashlib.sha1(grid.tobytes() + np.ascontiguousarray(table.coeffs).tobytes()) \
+                  .hexdigest()
+
+
+def write(filename, box, step, dt, nsteps, stride, outputs, time=None, step_size=None):
+    """Writes a checkpoint of box at the start of step to filename. The
+    file is written under a temporary name and then renamed, so a run
+    killed while writing leaves the previous checkpoint intact.
+    Params:
+        box - Box being simulated
+        step - Step the simulation continues from
+        dt, nsteps, stride - Parameters of the simulate call
+        outputs - Dict of output file name to its length in bytes at step
+        time - Simulated time at step, defaults to step*dt
+        step_size - Size of the next step of an adaptive timestep,
+                    defaults to dt
+    """
+
+    py_version, py_state, py_gauss = random.getstate()
+    np_state = np.random.get_state()
+    state = dict(
+        step=step, dt=dt, nsteps=nsteps, stride=stride,
+        time=step*dt if time is None else time,
+        step_size=dt if step_size is None else step_size,
+        N=len(box.positions), boxdim=box.boxdim, LJ_cutoff=box.LJ_cutoff,
+        method=box.method, backend=box.backend,
+        dtype=box.positions.dtype.name, table=table_key(box.table),
+        positions=box.positions, velocities=box.velocities, forces=box.forces,
+        masses=box.masses, potential=box.potential, virial=box.virial,
+        output_names=np.array(list(outputs), dtype=str),
+        output_sizes=np.array(list(outputs.values()), dtype=np.int64),
+        py_version=py_version, py_state=np.array(py_state, dtype=np.uint64),
+        py_gauss=np.nan if py_gauss is None else py_gauss,
+        np_keys=np_state[1], np_pos=np_state[2], np_has_gauss=np_state[3],
+        np_gauss=np_state[4])
+    if box.neighbours is not None:
+        state.update(pairs_i=box.neighbours.pairs_i, pairs_j=box.neighbours.pairs_j,
+                     rebuilds=box.neighbours.rebuilds)
+        if box.neighbours.ref_positions is not None:
+            state.update(ref_positions=box.neighbours.ref_positions)
+    if box.order is not None:
+        state.update(order=box.order)
+
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(temporary, filename)
+
+    return None
+
+
+def read(filename):
+    """Returns the checkpoint in filename as a dict of its entries."""
+
+    with np.load(filename) as f:
+        state = {key: f[key] for key in f.files}
+    for key in ('step', 'nsteps', 'stride', 'N', 'py_version', 'np_pos', 'np_has_gauss'):
+        state[key] = int(state[key])
+    for key in ('method', 'backend'):
+        state[key] = str(state[key])
+    # Checkpoints from before mixed precision and tables are of double
+    # precision Lennard-Jones runs.
+    state['dtype'] = str(state.get('dtype', 'float64'))
+    state['table'] = str(state.get('table', ''))
+    # Checkpoints from before adaptive timesteps hold neither.
+    state['time'] = float(state.get('time', state['step']*state['dt']))
+    state['step_size'] = float(state.get('step_size', state['dt']))
+
+    return state
+
+
+def restore(box, state):
+    """Sets box and the random number generators to the checkpointed
+    state. The box must have been created with the same number of
+    particles, cutoff, pair search method, precision and pair potential."""
+
+    if (len(box.positions), box.LJ_cutoff, box.method) != \
+       (state['N'], state['LJ_cutoff'], state['method']):
+        raise ValueError('Checkpoint of N=%i, cutoff=%f, method %s does not match the box'
+                         % (state['N'], state['LJ_cutoff'], state['method']))
+    if box.positions.dtype.name != state['dtype']:
+        raise ValueError('Checkpoint of %s positions does not match the %s box, '
+                         'restart with the same --mixed' % (state['dtype'],
+                                                            box.positions.dtype.name))
+    if table_key(box.table) != state['table']:
+        raise ValueError('Checkpoint pair potential does not match the box, '
+                         'restart with the same --table and --potential')
+    box.boxdim = float(state['boxdim'])
+    box.positions[:] = state['positions']
+    box.velocities[:] = state['velocities']
+    box.forces[:] = state['forces']
+    box.masses[:] = state['masses']
+    box.potential, box.virial = float(state['potential']), float(state['virial'])
+    # The rows are in the order of the checkpoint, reordered or not.
+    box.order = state.get('order')
+    if box.neighbours is not None:
+        box.neighbours.pairs_i = np.ascontiguousarray(state['pairs_i'], dtype=np.intc)
+        box.neighbours.pairs_j = np.ascontiguousarray(state['pairs_j'], dtype=np.intc)
+        box.neighbours.rebuilds = int(state['rebuilds'])
+        box.neighbours.ref_positions = state.get('ref_positions')
+
+    gauss = float(state['py_gauss'])
+    random.setstate((state['py_version'], tuple(int(x) for x in state['py_state']),
+                     None if np.isnan(gauss) else gauss))
+    np.random.set_state(('MT19937', state['np_keys'], state['np_pos'],
+                         state['np_has_gauss'], float(state['np_gauss'])))
+
+    return None
+
+
+def truncate_outputs(state):
+    """Cuts the output files back to their lengths at the checkpoint,
+    dropping anything written after it, so the run can append to them."""
+
+    for name, size in zip(state['output_names'], state['output_sizes']):
+        if os.path.getsize(name) < size:
+            raise ValueError('%s is shorter than at the checkpoint' % name)
+        os.truncate(name, int(size))
+
+    return None
@@ -0,0 +1,219 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements a multiprocess spatial domain decomposition
+    * for an argon N-body simulation on a single machine.
+    * The periodic box is split along x into slabs, one per worker process.
+    * Each worker owns the atoms in its slab and every step exchanges the
+    * atoms within the cutoff of its slab edges (ghosts) and the atoms that
+    * crossed into another slab (migrants) with its two neighbours through
+    * shared-memory buffers. Forces are calculated with the NumPy kernels.
+"""
+import numpy as np
+import multiprocessing as mp
+import NumpyKernels
+from SharedArrays import SharedArray
+from Neighbours import iter_cell_pairs
+
+# Columns of the shared exchange buffers: ghosts hold id, x, y, z
+# and migrants hold id, x, y, z, vx, vy, vz.
+GHOST_COLS = 4
+MIGRANT_COLS = 7
+
+
+def slab_forces(positions, nowned, boxdim, cutoff, block, table=None):
+    """Calculates the forces on the first nowned of the given positions,
+    which are followed by the ghost positions. Pairs of two owned atoms
+    count fully towards the potential energy and virial, pairs of an owned
+    atom and a ghost by half, as they are also counted by the ghost's owner.
+    table is an optional Tables.PairTable to use instead of Lennard-Jones.
+    Returns:
+        forces - [nowned,3] forces on the owned atoms
+        potential, virial - this slab's share of the totals
+    """
+
+    forces = np.zeros_like(positions)
+    potential, virial = 0, 0
+    for i, j in iter_cell_pairs(positions, boxdim, cutoff):
+        owned_i, owned_j = i < nowned, j < nowned
+        for mask, weight in ((owned_i & owned_j, 1), (owned_i ^ owned_j, 0.5)):
+            blocks = NumpyKernels.split_blocks(i[mask], j[mask], block)
+            pot, vir = NumpyKernels.get_forces_energy(positions, blocks, boxdim,
+                                                      cutoff, forces, table)[1:]
+            potential += weight*pot
+            virial += weight*vir
+
+    return forces[:nowned], potential, virial
+
+
+def _worker(rank, nworkers, specs, boxdim, cutoff, dt, nsteps, block, barrier,
+            table=None):
+    """
+    Process entry point of worker rank, attaches to the shared arrays
+    described by specs, a dict of name: (shape, dtype, name), and runs
+    its slab with _run_slab.
+    """
+    shared = {key: SharedArray(*spec) for key, spec in specs.items()}
+    try:
+        _run_slab(rank, nworkers, {key: s.array for key, s in shared.items()},
+                  boxdim, cutoff, dt, nsteps, block, barrier, table)
+    except BaseException:
+        barrier.abort() # Release the other workers
+        raise
+    finally:
+        for s in shared.values():
+            try:
+                s.close()
+            except BufferError: # Still referenced by a traceback
+                pass
+
+    return None
+
+
+def _run_slab(rank, nworkers, arrays, boxdim, cutoff, dt, nsteps, block, barrier,
+              table=None):
+    """
+    Runs the slab of worker rank for nsteps. The shared arrays are:
+        positions, velocities - [N,3] initial and final global state
+        masses - [N] particle masses
+        ghosts, nghosts - [P,2,C,4] ghost buffers to the left (0) and
+                          right (1) neighbour and their [P,2] fill counts
+        migrants, nmigrants - [P,2,C,7] migrant buffers and counts
+        energies - [nsteps,P,3] potential, kinetic energy and virial of
+                   each slab at each step
+    """
+    width = boxdim/nworkers
+    lo, hi = rank*width, (rank+1)*width
+    left, right = (rank-1) % nworkers, (rank+1) % nworkers
+    capacity = arrays['ghosts'].shape[2]
+
+    # Take ownership of the atoms in this slab.
+    glob_pos = arrays['positions']
+    ids = np.nonzero((glob_pos[:,0] >= lo) & (glob_pos[:,0] < hi))[0]
+    pos = glob_pos[ids].copy()
+    vel = arrays['velocities'][ids].copy()
+    masses = arrays['masses']
+
+    def send(buffer, counts, side, rows):
+        """ Writes rows into this worker's buffer to side. """
+        if len(rows) > capacity:
+            raise RuntimeError('Domain exchange buffer overflow, '
+                               'use fewer workers or a larger box')
+        buffer[rank, side, :len(rows)] = rows
+        counts[rank, side] = len(rows)
+
+    def receive(buffer, counts):
+        """ Returns the rows sent to this worker by its neighbours. """
+        if nworkers == 1:
+            return buffer[rank, 0, :0]
+        rows = [buffer[left, 1, :counts[left, 1]],
+                buffer[right, 0, :counts[right, 0]]]
+        return np.concatenate(rows)
+
+    def exchange_forces():
+        """ Exchanges ghosts and returns forces, potential and virial. """
+        for side, near in ((0, pos[:,0] < lo + cutoff), (1, pos[:,0] >= hi - cutoff)):
+            send(arrays['ghosts'], arrays['nghosts'], side,
+                 np.column_stack((ids[near], pos[near])))
+        barrier.wait()
+        ghosts = receive(arrays['ghosts'], arrays['nghosts'])
+        # With two workers both edges face the same neighbour.
+        ghosts = ghosts[np.unique(ghosts[:,0], return_index=True)[1]]
+        return slab_forces(np.concatenate((pos, ghosts[:,1:])), len(pos),
+                           boxdim, cutoff, block, table)
+
+    forces, potential, virial = exchange_forces()
+    for t in range(nsteps):
+        kinetic = 0.5*np.sum(masses[ids]*np.einsum('ij,ij->i', vel, vel))
+        arrays['energies'][t, rank] = potential, kinetic, virial
+
+        # Velocity Verlet update, first half.
+        inv_m = 1/masses[ids][:,None]
+        pos += dt*vel + 0.5*dt**2*forces*inv_m
+        vel += 0.5*dt*forces*inv_m
+        np.mod(pos, boxdim, out=pos)
+
+        # Migrate atoms that left the slab to the neighbouring slab.
+        dest = np.minimum((pos[:,0]//width).astype(int), nworkers-1)
+        leaving = dest != rank
+        if np.any(leaving & (dest != left) & (dest != right)):
+            raise RuntimeError('Atom crossed more than one domain in one step')
+        for side, nbr in ((0, left), (1, right)):
+            go = leaving & (dest == nbr)
+            if side == 1 and left == right:
+                go[:] = False # Everything already sent to the left
+            send(arrays['migrants'], arrays['nmigrants'], side,
+                 np.column_stack((ids[go], pos[go], vel[go])))
+        barrier.wait()
+        arrived = receive(arrays['migrants'], arrays['nmigrants'])
+        ids = np.concatenate((ids[~leaving], arrived[:,0].astype(ids.dtype)))
+        pos = np.concatenate((pos[~leaving], arrived[:,1:4]))
+        vel = np.concatenate((vel[~leaving], arrived[:,4:7]))
+
+        # Second half with the new forces.
+        forces, potential, virial = exchange_forces()
+        vel += 0.5*dt*forces/masses[ids][:,None]
+
+    # Gather the final state.
+    glob_pos[ids] = pos
+    arrays['velocities'][ids] = vel
+
+    return None
+
+
+def simulate_domains(positions, velocities, masses, boxdim, cutoff, dt, nsteps,
+                     nworkers, block=NumpyKernels.DEFAULT_BLOCK, table=None):
+    """Runs a Verlet simulation of nsteps with timestep dt split over
+    nworkers slab domains, each in its own process. positions and
+    velocities are updated in place to the final state.
+    Params:
+        positions, velocities - [N,3] narrays of the initial state
+        masses - [N] narray of particle masses
+        boxdim - PBC box dimension
+        cutoff - Lennard Jones cutoff distance
+        dt, nsteps - Timestep size and number of steps
+        nworkers - Number of slabs and worker processes
+        block - Number of pairs per block in the NumPy kernels
+        table - Tables.PairTable to use instead of Lennard-Jones
+    Returns:
+        energies - [nsteps,3] narray of total potential energy, kinetic
+                   energy and virial at every step
+    """
+
+    if boxdim/nworkers < cutoff:
+        raise ValueError('Domains must be at least one cutoff wide, use at most %i workers'
+                         % max(1, int(boxdim/cutoff)))
+    N = len(positions)
+    # Expected atoms within one cutoff of a slab edge, with ample margin.
+    capacity = min(N, int(4*N*cutoff/boxdim) + 64)
+
+    shared = {'positions': SharedArray((N,3)), 'velocities': SharedArray((N,3)),
+              'masses': SharedArray((N,)),
+              'ghosts': SharedArray((nworkers, 2, capacity, GHOST_COLS)),
+              'nghosts': SharedArray((nworkers, 2), np.int64),
+              'migrants': SharedArray((nworkers, 2, capacity, MIGRANT_COLS)),
+              'nmigrants': SharedArray((nworkers, 2), np.int64),
+              'energies': SharedArray((nsteps, nworkers, 3))}
+    try:
+        shared['positions'].array[:] = np.mod(positions, boxdim)
+        shared['velocities'].array[:] = velocities
+        shared['masses'].array[:] = masses
+        specs = {key: s.spec() for key, s in shared.items()}
+
+        barrier = mp.Barrier(nworkers)
+        workers = [mp.Process(target=_worker, args=(rank, nworkers, specs, boxdim,
+                              cutoff, dt, nsteps, block, barrier, table))
+                   for rank in range(nworkers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if any(w.exitcode != 0 for w in workers):
+            raise RuntimeError('Domain decomposition worker failed')
+
+        positions[:] = shared['positions'].array
+        velocities[:] = shared['velocities'].array
+        energies = shared['energies'].array.sum(axis=1)
+    finally:
+        for s in shared.values():
+            s.close(unlink=True)
+
+    return energies
@@ -0,0 +1,227 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements a batch runner for ensembles and parameter
+    * sweeps of argon N-body simulations.
+    * Every combination of the given parameter files, swept parameter values
+    * and random seeds is a job. The jobs run in a pool of worker processes,
+    * the most expensive first so all cores stay busy until the end. Each job
+    * writes to its own directory. The energies, temperature and pressure
+    * are averaged over the second half of each run, and the RDF and MSD are
+    * calculated by observers during the run. The results of all jobs are
+    * gathered in one summary table.
+    * Usage:
+    * python3 Ensemble.py solid.txt liquid.txt gas.txt [--T=0.8,1.0,1.2]
+    *     [--rho=0.5,0.8] [--N=...] [--cutoff=...] [--dt=...] [--nsteps=...]
+    *     [--seeds=1] [--processes=4] [--outdir=ensemble]
+    *     [--backend=cpp] [--method=cells] and the other OPTIONS
+"""
+import argparse
+import contextlib
+import csv
+import itertools
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+import Box
+import Backends
+import NumpyKernels
+from Utilities import read_parameters, write_output, OPTIONAL_PARAMETERS
+from Observers import EnergyObserver, RDFObserver, MSDObserver
+from Timestep import AdaptiveTimestep
+
+# Names of the fixed parameters in the order of Utilities.read_parameters,
+# which can be swept with --name=value,value,...
+PARAMETERS = ('N', 'rho', 'cutoff', 'T', 'dt', 'nsteps')
+TYPES = (int, float, float, float, float, int)
+EQUILIBRATION = 0.5 # Fraction of each run left out of the averages
+RDF_BIN = 0.05 # RDF bin width
+SAMPLE_INTERVAL = 10 # Steps between RDF and MSD samples
+# Optional parameters of Utilities.OPTIONAL_PARAMETERS that run_job uses.
+OPTIONS = ('backend', 'method', 'skin', 'block', 'mixed', 'drift', 'displacement',
+           'dtmax', 'stride', 'reorder')
+
+
+def make_jobs(paramfiles, sweep, seeds, options):
+    """Returns the list of job dicts of every combination of parameter
+    file, swept values and seed. sweep maps parameter names to lists of
+    values; options are passed on to the Box. Options of the parameter
+    files that jobs do not use are ignored with a note."""
+
+    jobs = []
+    names = list(sweep)
+    for paramfile in paramfiles:
+        parameters, file_options = read_parameters(paramfile)
+        unused = [name for name in file_options if name not in OPTIONS]
+        if unused:
+            print('Ignoring %s of %s, not supported by ensemble jobs'
+                  % (', '.join(unused), paramfile))
+            file_options = {name: value for name, value in file_options.items()
+                            if name in OPTIONS}
+        for values in itertools.product(*(sweep[name] for name in names)):
+            params = dict(zip(PARAMETERS, parameters))
+            params.update(zip(names, values))
+            for seed in range(seeds):
+                label = '_'.join([os.path.splitext(os.path.basename(paramfile))[0]] +
+                                 ['%s%s' % item for item in zip(names, values)] +
+                                 ['s%i' % seed])
+                jobs.append(dict(name=label, paramfile=paramfile, seed=seed,
+                                 params=params, options=dict(file_options, **options)))
+
+    return jobs
+
+
+def cost(job):
+    """Returns a rough relative cost of job, used to start the most
+    expensive jobs first."""
+
+    p = job['params']
+    pairs = p['N']**2 if job['options'].get('method', 'allpairs') == 'allpairs' \
+            else p['N']*p['rho']*p['cutoff']**3
+
+    return pairs*p['nsteps']
+
+
+def run_job(job):
+    """Runs the simulation of job in its directory and returns its row
+    of the summary table. Runs in a worker process."""
+
+    os.makedirs(job['dir'], exist_ok=True)
+    p, options = job['params'], job['options']
+    path = lambda name: os.path.join(job['dir'], name)
+    start = time.time()
+    with open(path('log.txt'), 'w') as log, contextlib.redirect_stdout(log):
+        box = Box.Box(p['N'], p['cutoff'], p['rho'], p['T'], options.get('backend', 'numpy'),
+                      method=options.get('method', 'allpairs'),
+                      skin=options.get('skin', 0.3), threads=1, seed=job['seed'],
+                      block=options.get('block', NumpyKernels.DEFAULT_BLOCK),
+                      dtype=np.float32 if options.get('mixed') else np.float64)
+
+        # Analyse the second half of the run during the simulation.
+        first = int(EQUILIBRATION*p['nsteps'])
+        samples = (p['nsteps'] - first - 1)//SAMPLE_INTERVAL
+        energy = EnergyObserver(1, first)
+        rdf = RDFObserver(np.arange(0, box.boxdim/2, RDF_BIN), SAMPLE_INTERVAL, first)
+        msd = MSDObserver(samples//2, SAMPLE_INTERVAL, max(samples//20, 1), first)
+        timestep = None
+        if options.get('drift'):
+            timestep = AdaptiveTimestep(p['dt'], options['drift'],
+                            options.get('displacement', 0.05), dt_max=options.get('dtmax'))
+        box.simulate(path('trajectory.traj'), p['nsteps'], p['dt'],
+                     stride=options.get('stride', 100), keep_positions=False,
+                     energyfile=path('energyfile.txt'), observers=[energy, rdf, msd],
+                     timestep=timestep, reorder_interval=options.get('reorder', 0))
+
+    rdf_values, rdf_positions = rdf.result()
+    rdf_values /= p['rho']
+    write_output(path('RDF_output.txt'), rdf_positions, rdf_values)
+    lagtimes, msd_values = msd.result()
+    write_output(path('MSD_output.txt'), lagtimes, msd_values)
+    fit = slice(len(lagtimes)//10, None)
+    diffusion = np.polyfit(lagtimes[fit], msd_values[fit], 1)[0]/6 \
+                if len(lagtimes[fit]) > 1 else np.nan
+
+    mean, std = energy.result()
+    peak = np.argmax(rdf_values)
+    row = dict(name=job['name'], seed=job['seed'])
+    row.update(p)
+    row.update({'<%s>' % name: value for name, value in mean.items()})
+    row.update({'std %s' % name: value for name, value in std.items()})
+    row.update({'diffusion': diffusion, 'rdf peak r': rdf_positions[peak],
+                'rdf peak g': rdf_values[peak], 'seconds': time.time() - start})
+
+    return row
+
+
+def run(jobs, outdir, processes=None):
+    """Runs jobs in a pool of processes, each in a directory under outdir,
+    and writes the summary table to outdir/summary.csv. Returns the rows
+    of the table in the order of jobs."""
+
+    for job in jobs:
+        job['dir'] = os.path.join(outdir, job['name'])
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    order = sorted(range(len(jobs)), key=lambda k: -cost(jobs[k]))
+    rows = {}
+    with mp.Pool(processes) as pool:
+        results = pool.imap_unordered(_indexed_job, [(k, jobs[k]) for k in order])
+        for done, (k, row) in enumerate(results, 1):
+            rows[k] = row
+            print('[%i/%i] %s finished in %.1f s' % (done, len(jobs), row['name'],
+                                                   row['seconds']))
+    rows = [rows[k] for k in range(len(jobs))]
+
+    with open(os.path.join(outdir, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return rows
+
+
+def _indexed_job(item):
+    """ Pool task running job k, returning k with the result. """
+
+    k, job = item
+
+    return k, run_job(job)
+
+
+def print_summary(rows):
+    """ Prints the main columns of the summary table. """
+
+    columns = ('name', '<temperature>', '<pressure>', '<total>', 'std total',
+               'diffusion', 'rdf peak r', 'rdf peak g')
+    width = max(len(row['name']) for row in rows)
+    print('%-*s ' % (width, columns[0]) + ' '.join('%14s' % c for c in columns[1:]))
+    for row in rows:
+        print('%-*s ' % (width, row['name']) +
+              ' '.join('%14.5g' % row[c] for c in columns[1:]))
+
+    return None
+
+
+def get_arguments(argv=None):
+    """Parses the command line argv (sys.argv[1:] by default) and returns
+    the parameter files, the dict of swept values by parameter name, the
+    number of seeds, processes and output directory, and the dict of
+    options passed on to the jobs, see OPTIONS."""
+
+    parser = argparse.ArgumentParser(prog='Ensemble.py',
+                description='Ensembles and parameter sweeps of simulations.',
+                epilog='e.g. Ensemble.py liquid.txt --T=0.8,1.0,1.2 --seeds=2 --processes=4')
+    parser.add_argument('paramfiles', nargs='+', help='parameter files')
+    for name, kind in zip(PARAMETERS, TYPES):
+        parser.add_argument('--' + name, type=lambda value, kind=kind:
+                            [kind(v) for v in value.split(',')],
+                            default=argparse.SUPPRESS, help='values of %s, comma separated' % name)
+    parser.add_argument('--seeds', type=int, default=1, help='random seeds per combination')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='worker processes, 0 for one per core')
+    parser.add_argument('--outdir', default='ensemble', help='output directory')
+    for label, (name, kind) in OPTIONAL_PARAMETERS.items():
+        if name in OPTIONS:
+            choices = list(Backends.REGISTRY) + ['auto'] if name == 'backend' else None
+            parser.add_argument('--' + name, type=kind, choices=choices,
+                                default=argparse.SUPPRESS, help=label)
+    arguments = vars(parser.parse_intermixed_args(argv))
+
+    sweep = {name: arguments.pop(name) for name in PARAMETERS if name in arguments}
+    paramfiles, seeds = arguments.pop('paramfiles'), arguments.pop('seeds')
+    processes, outdir = arguments.pop('processes') or None, arguments.pop('outdir')
+
+    return paramfiles, sweep, seeds, processes, outdir, arguments
+
+
+def main(argv=None):
+    paramfiles, sweep, seeds, processes, outdir, options = get_arguments(argv)
+    options['backend'] = Box.choose_backend(options.get('backend'))
+
+    jobs = make_jobs(paramfiles, sweep, seeds, options)
+    os.makedirs(outdir, exist_ok=True)
+    print('Running %i jobs' % len(jobs))
+    rows = run(jobs, outdir, processes)
+    print_summary(rows)
+    print('Summary written to ' + os.path.join(outdir, 'summary.csv'))
+
+if __name__ == '__main__':
+    main()
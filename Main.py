@@ -1,84 +1,221 @@
 """ * Authors: C. Kourris and Ethan van Woerkom
     * This module implements the Main function and
     * program for an argon N-body simulation.
+    * By default only the simulation is run. The MSD and RDF are calculated
+    * with --analysis, and also plotted with --plot. The analysis code,
+    * observers, timestep control, tables and matplotlib are only imported
+    * when they are used.
 """
+import os
 import numpy as np
-import sys
-from Box import *
-from Particle3D import Particle3D
-from Utilities import *
-from MDUtilities import *
-import matplotlib.pyplot as plt
-import time
-
-def main():
-    # Read parameter and output file names from sys.argv
-    parameters, outfile, cpp = get_arguments()
+from Box import Box, choose_backend
+from Utilities import get_arguments
+import NumpyKernels
+import Trajectory
+import Checkpoint
+import Profiling
+
+def main(argv=None):
+    # Read parameters, output file name and options from the command line.
+    parameters, outfile, backend, options = get_arguments(argv)
+    plot = bool(options.get('plot') or options.get('show'))
+    analysis = bool(options.get('analysis') or plot)
+
+    # A restart continues the run from a checkpoint and appends to its output.
+    # An automatic backend keeps the one of the checkpointed run, so that
+    # the run continues bit for bit.
+    restart = None
+    if options.get('restart'):
+        restart = Checkpoint.read(options['restart'])
+        if restart['dt'] != parameters[4] or restart['stride'] != options.get('stride', 1):
+            raise Exception('Timestep and stride must match those of the checkpoint')
+        if backend == 'auto':
+            backend = restart['backend']
+
+    # A tabulated pair potential replaces the analytic Lennard-Jones kernels.
+    table = None
+    if options.get('table') or options.get('potential'):
+        import Tables
+        table = Tables.make_table(parameters[2], options.get('table', 0),
+                                  options.get('potential'))
 
     # Create simulation Box. See design document for details.
-    Simba = Box(parameters[0], parameters[2], parameters[1], parameters[3], cpp)
+    Simba = Box(parameters[0], parameters[2], parameters[1], parameters[3],
+                choose_backend(backend),
+                method=options.get('method', 'allpairs'),
+                skin=options.get('skin', 0.3),
+                block=options.get('block', NumpyKernels.DEFAULT_BLOCK),
+                threads=options.get('threads'),
+                table=table,
+                dtype=np.float32 if options.get('mixed') else np.float64,
+                seed=options.get('seed'))
+
+    # Define MSD and RDF parameters as indices of the frames saved every
+    # stride steps. The MSD uses the last 30% of the run and the RDF the
+    # last 5%, clamped so that short runs still have a window.
+    stride = options.get('stride', 1)
+    last = (parameters[5]-1)//stride # Index of the last frame
+    if analysis and last < 2:
+        raise Exception('The analysis needs at least three frames')
+    msd_start = min(max(7*parameters[5]//10//stride, 1), last-1) # Need >= 1
+    msd_end = last # Need > msd_start and < n_steps
+    rdf_bins = np.arange(0,int(Simba.boxdim),0.1) # Creates RDF bins
+    rdf_start = min(max(95*parameters[5]//100//stride, 1), last-1) # Need > 0
+    rdf_end = last # Need < n_steps
+
+    # Without kept positions or a binary trajectory the MSD and RDF are
+    # calculated during the run by observers. The MSD uses a time origin
+    # every 100 frames, the same windows and sampling as the frames.
+    keep = options.get('keep', int(analysis))
+    observers = {}
+    if analysis and not keep and not outfile.endswith(Trajectory.EXTENSION):
+        from Observers import MSDObserver, RDFObserver
+        observers = {'MSD': MSDObserver(msd_end-msd_start, stride, 100,
+                                        msd_start*stride, msd_end*stride+1),
+                     'RDF': RDFObserver(rdf_bins, stride, rdf_start*stride, rdf_end*stride)}
+
+    # With an energy drift tolerance the timestep adapts to the state,
+    # starting from the one in the parameter file.
+    timestep = None
+    if options.get('drift'):
+        import Timestep
+        timestep = Timestep.AdaptiveTimestep(parameters[4], options['drift'],
+                        options.get('displacement', 0.05), dt_max=options.get('dtmax'))
+
+    # Profiling of the simulation loop, reported to a JSON or CSV file,
+    # and a live progress line every so many seconds.
+    profiler = None
+    if options.get('profile') or options.get('progress'):
+        profiler = Profiling.Profiler(progress=options.get('progress', 0))
 
     # Performs simulation and saves positions and timelist.
-    position_list, timelist = Simba.simulate(outfile, parameters[5], parameters[4])
+    # With domain decomposition only the energies are available.
+    if options.get('domains'):
+        timelist = Simba.simulate_domains(parameters[5], parameters[4], options['domains'])
+        position_list, observers = None, {}
+    else:
+        position_list, timelist = Simba.simulate(outfile, parameters[5], parameters[4],
+                        stride=stride,
+                        keep_positions=bool(keep),
+                        precision=options.get('precision', 4),
+                        save_velocities=bool(options.get('velocities', 0)),
+                        observers=observers.values(),
+                        checkpoint_interval=options.get('checkpoint', 0),
+                        checkpointfile=options.get('checkpointfile', 'checkpoint.npz'),
+                        restart=restart, profiler=profiler, timestep=timestep,
+                        reorder_interval=options.get('reorder', 0))
+        if profiler is not None:
+            print(profiler.summary() + '\n')
+        if options.get('profile'):
+            profiler.write(options['profile'])
+        # After a restart the frames before it are read back from the output.
+        if analysis and restart is not None and position_list is not None:
+            from Utilities import get_output
+            timelist = parameters[4]*np.arange(0, parameters[5], stride)
+            if timestep is not None: # Frame times from the energy file
+                timelist = np.loadtxt('energyfile.txt', usecols=[0])[::stride]
+            position_list = None if outfile.endswith(Trajectory.EXTENSION) \
+                            else get_output(outfile, parameters[0])
+        # A binary trajectory can be analysed without keeping the positions.
+        if analysis and position_list is None and outfile.endswith(Trajectory.EXTENSION):
+            position_list = Trajectory.Trajectory(outfile).positions
 
     # If you only want to load data to test the observable use the following
     # command and comment the one directly above. In that case specify the outfile:
     #outfile = "vmdoutput.xyz"
-    #position_list = np.array(get_output(outfile, parameters[0]))
+    #position_list = get_output(outfile, parameters[0])
     #timelist = parameters[4]*np.arange(parameters[5])
+    # or for a binary trajectory, which is read lazily:
+    #outfile = "trajectory.traj"
+    #position_list = Trajectory.Trajectory(outfile).positions
+    #timelist = Trajectory.Trajectory(outfile).times
 
-    # Define MSD and RDF parameters
-    msd_start = 7000 # Need something >= 1
-    msd_end = 9999 # Need something > msd_start and < n_steps
-    rdf_bins = np.arange(0,int(Simba.boxdim),0.1) # Creates RDF bins
-    rdf_start = 9500 # Need > 0
-    rdf_end = 9999 # Need < n_steps
-
-    # The code below will create and save a MSD plot from time msd_start to msd_end.
-    print("Calculating the Mean Square Displacement function\n")
-    MSD_arr = MSD(position_list, msd_start, msd_end, Simba.boxdim)
-    #fig = plt.figure(figsize=(3, 6))
-    write_output("MSD_output.txt", timelist[msd_start - 1:msd_end]-timelist[msd_start-1], MSD_arr)
-    plt.figure(1)
-    plt.plot(timelist[msd_start - 1:msd_end], MSD_arr)
-    #plt.title("Mean Square Displacement")
-    plt.xlabel("Time $\\rightarrow$", fontsize=12, fontstyle="italic")
-    plt.ylabel("MSD(t)/$\\sigma^{2}$ $\\rightarrow$", fontsize=12, fontstyle="italic")
-    #plt.show()
-    plt.savefig('Plots/MSD_gas.png')
-
-    # The code below will create and save an RDF plot from time msd_start to msd_end.
-    print("Calculating the Radial Distribution function\n")
-    rdf_arr, rdf_bins = RDF(position_list, rdf_start, rdf_end, rdf_bins, Simba.boxdim)
-    rdf_arr/=parameters[1]
-    write_output("RDF_output.txt", rdf_bins, rdf_arr)
-    plt.figure(2)
-    plt.plot(rdf_bins,rdf_arr)
-    #plt.title("Radial Distribution Function")
-    plt.xlabel("Distance/$\\sigma$ $\\rightarrow$", fontsize=12, fontstyle="italic")
-    plt.ylabel("g(r) $\\rightarrow$", fontsize=12, fontstyle="italic")
-    #plt.show()
-    plt.savefig('Plots/RDF_gas.png')
+    if not analysis:
+        print("Simulation has been successful.")
+        return None
+
+    from Utilities import write_output, MSD_FFT, RDF, Resample
+
+    # matplotlib is only imported when plots are made. Without --show
+    # the plots are only saved, which needs no display.
+    plt = None
+    if plot:
+        import matplotlib
+        if not options.get('show'):
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        os.makedirs('Plots', exist_ok=True)
+
+    if position_list is not None or observers:
+        # The code below will create and save a MSD plot from time msd_start to msd_end.
+        print("Calculating the Mean Square Displacement function\n")
+        if observers:
+            lagtimes, MSD_arr = observers['MSD'].result()
+        elif timestep is not None:
+            # Unevenly spaced frames are interpolated onto even times.
+            resampled, lagtimes = Resample(position_list, timelist, msd_start, msd_end,
+                                           Simba.boxdim)
+            MSD_arr = MSD_FFT(resampled, 0, len(lagtimes)-1, Simba.boxdim, unwrapped=True)
+        else:
+            MSD_arr = MSD_FFT(position_list, msd_start, msd_end, Simba.boxdim)
+            lagtimes = timelist[msd_start:msd_end+1]-timelist[msd_start]
+        # Diffusion coefficient from the slope MSD = 6Dt over the later lags,
+        # which have enough time origins to be well averaged, and at least
+        # two lags for short runs.
+        fit = slice(len(lagtimes)//10, max(len(lagtimes)//2, len(lagtimes)//10 + 2))
+        print("Diffusion coefficient: ", np.polyfit(lagtimes[fit], MSD_arr[fit], 1)[0]/6)
+        #fig = plt.figure(figsize=(3, 6))
+        write_output("MSD_output.txt", lagtimes, MSD_arr)
+        if plt is not None:
+            plt.figure(1)
+            plt.plot(lagtimes, MSD_arr)
+            #plt.title("Mean Square Displacement")
+            plt.xlabel("Time $\\rightarrow$", fontsize=12, fontstyle="italic")
+            plt.ylabel("MSD(t)/$\\sigma^{2}$ $\\rightarrow$", fontsize=12, fontstyle="italic")
+            #plt.show()
+            plt.savefig('Plots/MSD_gas.png')
+
+        # The code below will create and save an RDF plot from time msd_start to msd_end.
+        print("Calculating the Radial Distribution function\n")
+        if observers:
+            rdf_arr, rdf_bins = observers['RDF'].result()
+        else:
+            rdf_arr, rdf_bins = RDF(position_list, rdf_start, rdf_end, rdf_bins, Simba.boxdim,
+                                    times=None if timestep is None else timelist)
+        rdf_arr/=parameters[1]
+        write_output("RDF_output.txt", rdf_bins, rdf_arr)
+        if plt is not None:
+            plt.figure(2)
+            plt.plot(rdf_bins,rdf_arr)
+            #plt.title("Radial Distribution Function")
+            plt.xlabel("Distance/$\\sigma$ $\\rightarrow$", fontsize=12, fontstyle="italic")
+            plt.ylabel("g(r) $\\rightarrow$", fontsize=12, fontstyle="italic")
+            #plt.show()
+            plt.savefig('Plots/RDF_gas.png')
 
     # The code below will create and save an energy plot, displaying the potential
     # kinetic and total energies throughout the simulation.
-    print("Plotting energy functions\n")
     timelist, PE, KE, TE = np.loadtxt('energyfile.txt', usecols=[0,1,2,3], unpack=True)#,dtype=float)
-    plt.figure(3)
-    plt.plot(timelist,KE)
-    plt.plot(timelist,PE)
-    plt.plot(timelist,TE)
-    #plt.title("Energy as a function of time")
-    plt.xlabel("Time $\\rightarrow$", fontsize=12, fontstyle="italic")
-    plt.ylabel("Energy $\\rightarrow$", fontsize=12, fontstyle="italic")
-    plt.legend(['KE','PE','TE'])
+    if plt is not None:
+        print("Plotting energy functions\n")
+        plt.figure(3)
+        plt.plot(timelist,KE)
+        plt.plot(timelist,PE)
+        plt.plot(timelist,TE)
+        #plt.title("Energy as a function of time")
+        plt.xlabel("Time $\\rightarrow$", fontsize=12, fontstyle="italic")
+        plt.ylabel("Energy $\\rightarrow$", fontsize=12, fontstyle="italic")
+        plt.legend(['KE','PE','TE'])
+
+        plt.savefig('Plots/E.png')
 
-    plt.savefig('Plots/E.png')
+        if options.get('show'):
+            plt.show()
 
-    plt.show()
+    print("Post Simulation Fitted Temperature: ", np.mean(KE)/(1.5*parameters[0]))
+    print("All results saved in directory. Simulation has been successful.")
 
-    print("Post Simulation Fitted Temperature: ", np.mean(KE)/(1.5*len(Simba.particles)))
-    print("All plots saved in directory. Simulation has been successful.")
+    return None
 
 if __name__ == '__main__':
     main()
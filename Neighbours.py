@@ -0,0 +1,214 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements the cell-list binning and the Verlet
+    * neighbour list used to find candidate interaction pairs for an
+    * argon N-body simulation.
+    * The periodic box is divided into ncell^3 cubic cells of side >= cutoff,
+    * so any pair within the cutoff lies in the same or in adjacent cells.
+"""
+import itertools
+import numpy as np
+
+# Cell offsets forming half of the 27-cell neighbourhood. Together with the
+# cell itself (0,0,0) every pair of adjacent cells is visited exactly once.
+HALF_SHELL = [(0,0,0)] + [o for o in itertools.product((-1,0,1), repeat=3)
+                          if o > (0,0,0)]
+
+
+def cells_per_side(boxdim, cutoff):
+    """Returns the number of cells along each box dimension such that the
+    side of a cell is at least the cutoff distance."""
+
+    return int(boxdim/cutoff)
+
+
+def cell_indices(positions, boxdim, ncell):
+    """Given an [N,3]-dimensional narray of positions, returns an [N]-dim
+    narray of the flat index of the cell containing each particle.
+    Positions outside the box are first mapped back in according to pbc.
+    """
+
+    cells = np.floor(np.mod(positions, boxdim)*(ncell/boxdim)).astype(np.intp)
+    cells = np.minimum(cells, ncell-1) # Guard against rounding up to boxdim
+
+    return (cells[:,0]*ncell + cells[:,1])*ncell + cells[:,2]
+
+
+def iter_cell_pairs(positions, boxdim, cutoff):
+    """Yields the candidate interaction pairs of a configuration as blocks
+    of two index narrays (i, j), one block per half-shell cell offset.
+    Each unordered pair of particles that lie in the same or in adjacent
+    cells is listed once. Boxes with fewer than three cells per side fall
+    back to all i>j pairs, as the neighbouring cells would otherwise be
+    visited more than once.
+    Params:
+        positions - [N,3] position array
+        boxdim - PBC box dimension
+        cutoff - Lennard Jones cutoff distance
+    Yields:
+        i, j - index arrays of candidate pairs
+    """
+
+    N = len(positions)
+    ncell = cells_per_side(boxdim, cutoff)
+    if ncell < 3:
+        yield np.tril_indices(N, -1)
+        return
+
+    # Sort the particles by cell and lay them out in a padded table
+    # members[cell, slot], with -1 marking the empty slots.
+    flat = cell_indices(positions, boxdim, ncell)
+    order = np.argsort(flat, kind='stable')
+    counts = np.bincount(flat, minlength=ncell**3)
+    starts = np.cumsum(counts) - counts
+    slots = np.arange(N) - starts[flat[order]]
+    members = -np.ones((ncell**3, counts.max()), dtype=np.intp)
+    members[flat[order], slots] = order
+
+    grid = np.indices((ncell, ncell, ncell)).reshape(3, -1).T
+    first = members[:, :, None]
+    for offset in HALF_SHELL:
+        nbr = np.mod(grid + offset, ncell)
+        second = members[(nbr[:,0]*ncell + nbr[:,1])*ncell + nbr[:,2]][:, None, :]
+        mask = (first >= 0) & (second >= 0)
+        if offset == (0,0,0):
+            # Within one cell only take every pair once.
+            mask &= np.triu(np.ones(mask.shape[1:], dtype=bool), 1)
+        yield (np.broadcast_to(first, mask.shape)[mask],
+               np.broadcast_to(second, mask.shape)[mask])
+
+
+def cell_pairs(positions, boxdim, cutoff):
+    """Returns all candidate interaction pairs found by iter_cell_pairs
+    as two [P]-dim index narrays (i, j)."""
+
+    blocks = list(iter_cell_pairs(positions, boxdim, cutoff))
+
+    return (np.concatenate([i for i, j in blocks]),
+            np.concatenate([j for i, j in blocks]))
+
+
+def morton_keys(cells, bits):
+    """Returns the [N]-dim narray of the Morton (Z-order) keys of an
+    [N,3]-dim narray of integer cell coordinates below 2^bits, made by
+    interleaving the bits of the three coordinates."""
+
+    keys = np.zeros(len(cells), dtype=np.int64)
+    for b in range(bits):
+        for d in range(3):
+            keys |= ((cells[:, d] >> b) & 1) << (3*b + 2 - d)
+
+    return keys
+
+
+def spatial_order(positions, boxdim, cutoff):
+    """Returns the [N]-dim permutation narray that sorts the particles by
+    the Morton key of their cell, with cells of side at least cutoff as
+    in iter_cell_pairs. Particles in the same or nearby cells are then
+    close together in memory. The sort is stable, so particles keep
+    their relative order within a cell."""
+
+    ncell = max(cells_per_side(boxdim, cutoff), 1)
+    cells = np.floor(np.mod(positions, boxdim)*(ncell/boxdim)).astype(np.int64)
+    cells = np.minimum(cells, ncell-1) # Guard against rounding up to boxdim
+
+    return np.argsort(morton_keys(cells, max(int(ncell-1).bit_length(), 1)), kind='stable')
+
+
+def mic_displacement(new, old, boxdim):
+    """Returns the [N,3]-dim narray of displacements from old to new
+    positions according to the minimum image convention."""
+
+    return np.mod(np.mod(new - old, boxdim) + boxdim/2, boxdim) - boxdim/2
+
+
+class NeighbourList:
+    """ CLASS VARIABLES:
+    cutoff - Lennard-Jones cutoff distance.
+    skin - Extra distance beyond the cutoff included in the list.
+    pairs_i, pairs_j - [P]-dim int narrays of the listed pairs.
+    ref_positions - Positions at which the list was last built.
+    rebuilds - Number of times the list has been built.
+
+    The list holds every pair within cutoff+skin. It stays valid until a
+    particle has moved more than half the skin since the last build, as
+    only then can a pair from outside the list come within the cutoff.
+    """
+
+    def __init__(self, cutoff, skin):
+        """
+        Initialises an empty neighbour list.
+        Param:
+            cutoff - Lennard Jones cutoff Distance
+            skin - Skin distance added to the cutoff
+        """
+        self.cutoff = cutoff
+        self.skin = skin
+        self.pairs_i = np.zeros(0, dtype=np.intc)
+        self.pairs_j = np.zeros(0, dtype=np.intc)
+        self.ref_positions = None
+        self.rebuilds = 0
+
+        return None
+
+
+    def build(self, positions, boxdim):
+        """
+        Builds the list from an [N,3]-dim narray of positions using the
+        cell-list candidates, keeping the pairs within cutoff+skin.
+        """
+
+        rlist = self.cutoff + self.skin
+        i, j = cell_pairs(positions, boxdim, rlist)
+        sep = mic_displacement(positions[j], positions[i], boxdim)
+        inside = np.einsum('ij,ij->i', sep, sep) < rlist**2
+
+        self.pairs_i = np.ascontiguousarray(i[inside], dtype=np.intc)
+        self.pairs_j = np.ascontiguousarray(j[inside], dtype=np.intc)
+        self.ref_positions = np.array(positions)
+        self.rebuilds += 1
+
+        return None
+
+
+    def needs_rebuild(self, positions, boxdim):
+        """
+        Returns True if the list has not been built yet, or if the largest
+        displacement since the last build exceeds half the skin.
+        """
+
+        if self.ref_positions is None or len(positions) != len(self.ref_positions):
+            return True
+        disp = mic_displacement(positions, self.ref_positions, boxdim)
+
+        return np.max(np.einsum('ij,ij->i', disp, disp)) > (self.skin/2)**2
+
+
+    def update(self, positions, boxdim):
+        """
+        Rebuilds the list if necessary, returns True if it was rebuilt.
+        """
+
+        if self.needs_rebuild(positions, boxdim):
+            self.build(positions, boxdim)
+            return True
+
+        return False
+
+
+    def permute(self, perm):
+        """
+        Renumbers the list after the particles have been reordered so
+        that new particle k is old particle perm[k]. The pairs are sorted
+        by their new first index, and the list stays valid as before.
+        """
+
+        inverse = np.empty_like(perm)
+        inverse[perm] = np.arange(len(perm))
+        pairs_i, pairs_j = inverse[self.pairs_i], inverse[self.pairs_j]
+        order = np.argsort(pairs_i, kind='stable')
+        self.pairs_i = np.ascontiguousarray(pairs_i[order], dtype=np.intc)
+        self.pairs_j = np.ascontiguousarray(pairs_j[order], dtype=np.intc)
+        if self.ref_positions is not None:
+            self.ref_positions = self.ref_positions[perm]
+
+        return None
@@ -0,0 +1,136 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements vectorised NumPy versions of the force and
+    * energy calculations for an argon N-body simulation, for machines on
+    * which the C++ acceleration library cannot be compiled.
+    * Pairs are processed in blocks of at most block pairs, so the size of
+    * the temporary arrays, and with it the peak memory, stays bounded
+    * however large N is.
+    * Float32 positions are evaluated in single precision, with the forces
+    * and energies summed in double precision.
+"""
+import numpy as np
+
+DEFAULT_BLOCK = 65536 # Default number of pairs per block
+
+
+def allpairs_blocks(N, block=DEFAULT_BLOCK):
+    """Yields all pairs i>j of N particles as index narrays (i, j), in
+    blocks of consecutive rows i holding at most block pairs (or a single
+    row if that row alone is longer)."""
+
+    start = 1
+    while start < N:
+        # Row i holds the i pairs (i, 0) ... (i, i-1).
+        stop, npairs = start+1, start
+        while stop < N and npairs + stop <= block:
+            npairs += stop
+            stop += 1
+        rows = np.arange(start, stop)
+        i = np.repeat(rows, rows)
+        j = np.arange(len(i)) - np.repeat(np.cumsum(rows) - rows, rows)
+        yield i, j
+        start = stop
+
+
+def split_blocks(i, j, block=DEFAULT_BLOCK):
+    """Yields the pair index narrays (i, j) in slices of block pairs."""
+
+    for start in range(0, len(i), block):
+        yield i[start:start+block], j[start:start+block]
+
+
+def pair_separations(positions, i, j, boxdim):
+    """Returns the [P,3]-dim narray of minimum image separation vectors
+    from particles i to particles j and the [P]-dim narray of their
+    squared lengths."""
+
+    sep = positions[j] - positions[i]
+    sep -= boxdim*np.floor(sep/boxdim + 0.5) # Maps into [-boxdim/2, boxdim/2)
+
+    return sep, np.einsum('ij,ij->i', sep, sep)
+
+
+def get_forces(positions, blocks, boxdim, cutoff, out, table=None):
+    """Adds the Lennard-Jones forces of all pairs in blocks to out.
+    Params:
+        positions - [N,3] position array
+        blocks - iterable of pair index arrays (i, j)
+        boxdim - PBC box dimension
+        cutoff - Lennard Jones cutoff distance
+        out - [N,3] array the forces are added to
+        table - Tables.PairTable to use instead of Lennard-Jones
+    Returns:
+        out
+    """
+
+    for i, j in blocks:
+        sep, r2 = pair_separations(positions, i, j, boxdim)
+        inside = r2 < cutoff**2
+        if table is None:
+            sep, inv2 = sep[inside], 1/r2[inside]
+            inv6 = inv2**3
+            # F = 48*(r^-14 - 0.5*r^-8)*sep is the force of i on j.
+            force = (48*inv2*inv6*(inv6-0.5))[:,None]*sep
+        else:
+            force = table.evaluate(r2[inside])[0][:,None]*sep[inside]
+        force = force.astype(out.dtype, copy=False) # Summed in double precision
+        np.add.at(out, j[inside], force)
+        np.add.at(out, i[inside], -force) # Using Newtons 3rd law
+
+    return out
+
+
+def get_forces_energy(positions, blocks, boxdim, cutoff, out, table=None):
+    """Adds the Lennard-Jones forces of all pairs in blocks to out and
+    returns out, the total shifted potential energy and the virial sum
+    of r.F in a single pass, with arguments as for get_forces."""
+
+    shift = 4*(cutoff**-12 - cutoff**-6) # Makes potential(cutoff) = 0
+    energy, virial = 0, 0
+    for i, j in blocks:
+        sep, r2 = pair_separations(positions, i, j, boxdim)
+        inside = r2 < cutoff**2
+        sep, r2 = sep[inside], r2[inside]
+        if table is None:
+            inv2 = 1/r2
+            inv6 = inv2**3
+            fscalar = 48*inv2*inv6*(inv6-0.5)
+            energy += np.sum(4*inv6*(inv6-1), dtype=np.float64) - shift*len(inv6)
+        else:
+            fscalar, potential = table.evaluate(r2)
+            energy += np.sum(potential)
+        force = fscalar[:,None]*sep
+        force = force.astype(out.dtype, copy=False) # Summed in double precision
+        np.add.at(out, j[inside], force)
+        np.add.at(out, i[inside], -force) # Using Newtons 3rd law
+        virial += np.sum(fscalar*r2, dtype=np.float64)
+
+    return out, energy, virial
+
+
+def get_potential(positions, blocks, boxdim, cutoff, table=None):
+    """Returns the total shifted Lennard-Jones potential energy of all
+    pairs in blocks, with arguments as for get_forces."""
+
+    shift = 4*(cutoff**-12 - cutoff**-6) # Makes potential(cutoff) = 0
+    energy = 0
+    for i, j in blocks:
+        r2 = pair_separations(positions, i, j, boxdim)[1]
+        if table is not None:
+            energy += np.sum(table.evaluate(r2[r2 < cutoff**2])[1])
+            continue
+        inv6 = 1/r2[r2 < cutoff**2]**3
+        energy += np.sum(4*inv6*(inv6-1), dtype=np.float64) - shift*len(inv6)
+
+    return energy
+
+
+def get_energies(positions, velocities, masses, blocks, boxdim, cutoff, table=None):
+    """Returns the narray of potential, kinetic and total energy, with
+    velocities and masses as [N,3] and [N] arrays and the remaining
+    arguments as for get_forces."""
+
+    pot = get_potential(positions, blocks, boxdim, cutoff, table)
+    kin = 0.5*np.sum(masses*np.einsum('ij,ij->i', velocities, velocities))
+
+    return np.array([pot, kin, pot+kin])
@@ -0,0 +1,313 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements observers that analyse an argon N-body
+    * simulation while it runs. Observers are passed to Box.simulate, which
+    * hands each of them the Box every interval steps within their window
+    * of steps. They accumulate their observable incrementally, so the
+    * analysis is available without keeping the trajectory.
+"""
+import collections
+import numpy as np
+from Utilities import Pair_histogram
+
+
+class Observer:
+    """ CLASS VARIABLES:
+    interval - Number of steps between samples.
+    start, end - Window of steps [start, end) that is sampled.
+    samples - Number of samples taken so far.
+
+    Base class of the observers. Subclasses implement sample and result.
+    """
+
+    def __init__(self, interval=1, start=0, end=None):
+        """
+        Param:
+            interval - Number of steps between samples
+            start, end - First and last (exclusive) step sampled, end
+                         defaults to the end of the run
+        """
+        self.interval = interval
+        self.start = start
+        self.end = end
+        self.samples = 0
+
+        return None
+
+
+    def wants(self, t):
+        """ True if step t is to be sampled. """
+
+        return t >= self.start and (self.end is None or t < self.end) and \
+               (t - self.start) % self.interval == 0
+
+
+    def observe(self, box, t, time):
+        """ Samples the box at step t and the given time if wanted. """
+
+        if self.wants(t):
+            self.sample(box, t, time)
+            self.samples += 1
+
+        return None
+
+
+    def sample(self, box, t, time):
+        """ Updates the observable with the current state of box. """
+
+        raise NotImplementedError
+
+
+    def result(self):
+        """ Returns the observable accumulated so far. """
+
+        raise NotImplementedError
+
+
+class AverageObserver(Observer):
+    """ CLASS VARIABLES:
+    sums, squares - Weighted sums of the values and of their squares.
+    weights - Sum of the weights.
+    pending - (values, time) of the last sample, which is added once the
+              time of the next sample is known.
+
+    Base class of observers that average values of the state over time.
+    Each sample is weighted by the time until the next sample, the last by
+    the time since the one before, so the averages are time averages also
+    when the timestep varies. Subclasses implement values.
+    """
+
+    def __init__(self, size, interval=1, start=0, end=None):
+        """
+        Param:
+            size - Length of the narray of values
+        Other parameters as Observer.
+        """
+        Observer.__init__(self, interval, start, end)
+        self.sums = np.zeros(size)
+        self.squares = np.zeros(size)
+        self.weights = 0
+        self.pending = None
+
+        return None
+
+
+    def sample(self, box, t, time):
+        if self.pending is not None:
+            self.last_weight = time - self.pending[1]
+            self.add(self.pending[0], self.last_weight)
+        self.pending = (self.values(box), time)
+
+        return None
+
+
+    def add(self, values, weight):
+        """ Adds values with weight to the sums. """
+
+        self.sums += weight*values
+        self.squares += weight*values**2
+        self.weights += weight
+
+        return None
+
+
+    def values(self, box):
+        """ Returns the narray of values averaged. """
+
+        raise NotImplementedError
+
+
+    def averages(self):
+        """ Returns the narrays of the time averages of the values and of
+        their squares. """
+
+        sums, squares, weights = self.sums, self.squares, self.weights
+        if self.pending is not None:
+            weight = self.last_weight if self.samples > 1 else 1
+            sums = sums + weight*self.pending[0]
+            squares = squares + weight*self.pending[0]**2
+            weights = weights + weight
+        if weights == 0:
+            return sums, squares
+
+        return sums/weights, squares/weights
+
+
+class EnergyObserver(AverageObserver):
+    """
+    Averages the energies, temperature and pressure over time. The
+    potential energy and virial are those calculated by Box.simulate
+    together with the forces of the current step.
+    """
+
+    NAMES = ('potential', 'kinetic', 'total', 'temperature', 'pressure')
+
+    def __init__(self, interval=1, start=0, end=None):
+        AverageObserver.__init__(self, len(self.NAMES), interval, start, end)
+
+        return None
+
+
+    def values(self, box):
+        kinetic = box.kinetic_energy()
+
+        return np.array([box.potential, kinetic, box.potential + kinetic,
+                         kinetic/(1.5*len(box.positions)), box.pressure(kinetic)])
+
+
+    def result(self):
+        """ Returns dicts of the mean and standard deviation of each
+        quantity in NAMES. """
+
+        mean, squares = self.averages()
+        std = np.sqrt(np.maximum(squares - mean**2, 0))
+
+        return dict(zip(self.NAMES, mean)), dict(zip(self.NAMES, std))
+
+
+class RDFObserver(AverageObserver):
+    """ CLASS VARIABLES:
+    bins - narray of the histogram bin edges.
+    N - Number of particles.
+
+    Averages the radial distribution function histogram over time,
+    normalised as Utilities.RDF.
+    """
+
+    def __init__(self, bins, interval=1, start=0, end=None):
+        bins = np.asarray(bins, dtype=float)
+        AverageObserver.__init__(self, len(bins)-1, interval, start, end)
+        self.bins = bins
+        self.N = 0
+
+        return None
+
+
+    def values(self, box):
+        self.N = len(box.positions)
+
+        return Pair_histogram(box.positions, self.bins, box.boxdim)
+
+
+    def result(self):
+        """ Returns the RDF values and the positions they are evaluated at,
+        as Utilities.RDF. """
+
+        bins = self.bins
+        radial_density_histogram = self.averages()[0]/(self.N/2)
+        volumes = 4*np.pi*((bins[:-1]+bins[1:])/2)**2*(bins[1]-bins[0])
+        rdf_positions = (bins[:-1]+bins[1:])/2
+
+        return radial_density_histogram/volumes, rdf_positions
+
+
+class WindowObserver(Observer):
+    """ CLASS VARIABLES:
+    window - Largest lag in samples.
+    origin_interval - Number of samples between time origins.
+    origins - Deque of (sample index, value) of the live time origins.
+    sums, counts - [window+1] narrays of the summed correlation at each
+                   lag and the number of origins contributing.
+    times - [window+1] narray of the summed time of each lag, whose mean
+            over the origins is the lag time if the timestep varies.
+
+    Base class of time correlation functions averaged over multiple time
+    origins. A new origin is stored every origin_interval samples and
+    dropped once it is more than window samples old, so memory depends on
+    the window and not on the length of the run.
+    Subclasses implement value and correlate.
+    """
+
+    def __init__(self, window, interval=1, origin_interval=1, start=0, end=None):
+        """
+        Param:
+            window - Largest lag in samples
+            origin_interval - Number of samples between time origins
+        Other parameters as Observer.
+        """
+        Observer.__init__(self, interval, start, end)
+        self.window = window
+        self.origin_interval = origin_interval
+        self.origins = collections.deque()
+        self.sums = np.zeros(window+1)
+        self.counts = np.zeros(window+1, dtype=np.int64)
+        self.times = np.zeros(window+1)
+
+        return None
+
+
+    def sample(self, box, t, time):
+        value = self.value(box)
+        k = self.samples
+        if k % self.origin_interval == 0:
+            self.origins.append((k, time, value.copy()))
+        while k - self.origins[0][0] > self.window:
+            self.origins.popleft()
+        for k0, time0, origin in self.origins:
+            self.sums[k-k0] += self.correlate(value, origin)
+            self.counts[k-k0] += 1
+            self.times[k-k0] += time - time0
+
+        return None
+
+
+    def value(self, box):
+        """ Returns the narray correlated at each sample. """
+
+        raise NotImplementedError
+
+
+    def correlate(self, value, origin):
+        """ Returns the correlation of value with an origin value. """
+
+        raise NotImplementedError
+
+
+    def result(self):
+        """ Returns the lag times and the correlation function at the
+        lags reached so far. """
+
+        reached = self.counts > 0
+
+        return (self.times[reached]/self.counts[reached],
+                self.sums[reached]/self.counts[reached])
+
+
+class MSDObserver(WindowObserver):
+    """ CLASS VARIABLES:
+    unwrapped - [N,3] narray of the positions followed across the
+                periodic boundaries.
+    wrapped - [N,3] narray of the box positions at the last sample.
+
+    Mean square displacement as a function of lag time. Particles must
+    not move more than half a box between samples.
+    """
+
+    def value(self, box):
+        positions = box.original_order(box.positions)
+        if self.samples == 0:
+            self.unwrapped = np.array(positions, dtype=float)
+        else:
+            step = positions - self.wrapped
+            step -= box.boxdim*np.floor(step/box.boxdim + 0.5)
+            self.unwrapped += step
+        self.wrapped = np.array(positions, dtype=float)
+
+        return self.unwrapped
+
+
+    def correlate(self, value, origin):
+        return np.einsum('ij,ij->', value - origin, value - origin)/len(value)
+
+
+class VACFObserver(WindowObserver):
+    """
+    Velocity autocorrelation function <v(t0).v(t0+t)> as a function of
+    lag time.
+    """
+
+    def value(self, box):
+        return box.original_order(box.velocities)
+
+
+    def correlate(self, value, origin):
+        return np.einsum('ij,ij->', value, origin)/len(value)
@@ -0,0 +1,252 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements the streaming output of an argon N-body
+    * simulation. Writers format each record as it is produced and write
+    * to disk in chunks of a fixed size, so the memory used for output does
+    * not grow with the number of steps.
+    * Numerical records can also be collected in a preallocated buffer and
+    * written by a background thread, off the critical path of the run.
+"""
+import queue
+import threading
+import numpy as np
+
+DEFAULT_CHUNK = 4*2**20 # Buffered characters before a write to disk
+BINARY_EXTENSION = '.bin' # Extension of binary record files
+
+
+class ChunkedWriter:
+    """ CLASS VARIABLES:
+    file - Open output file.
+    chunk - Number of buffered characters that triggers a write.
+    buffer - List of strings not yet written.
+    size - Number of characters in buffer.
+    written - Number of characters written so far.
+    """
+
+    def __init__(self, filename, chunk=DEFAULT_CHUNK, mode='w'):
+        """
+        Opens filename for writing, or appending if mode is 'a'.
+        """
+        self.file = open(filename, mode)
+        self.chunk = chunk
+        self.buffer = []
+        self.size = 0
+        self.written = 0
+
+        return None
+
+
+    def add(self, string):
+        """ Buffers string, writing the buffer once it exceeds chunk. """
+
+        self.buffer.append(string)
+        self.size += len(string)
+        if self.size >= self.chunk:
+            self.flush()
+
+        return None
+
+
+    def flush(self):
+        """ Writes the buffered strings to the file. """
+
+        self.file.write(''.join(self.buffer))
+        self.file.flush()
+        self.written += self.size
+        self.buffer, self.size = [], 0
+
+        return None
+
+
+    def close(self):
+        """ Writes any remaining output and closes the file. """
+
+        self.flush()
+        self.file.close()
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class XYZWriter(ChunkedWriter):
+    """ CLASS VARIABLES:
+    frame_format - Format string of the particle lines of one frame.
+
+    Writes frames in the VMD xyz format used by Box.VMD_string.
+    """
+
+    def __init__(self, filename, labels, chunk=DEFAULT_CHUNK, mode='w'):
+        """
+        Opens filename for frames of particles with the given labels.
+        """
+        ChunkedWriter.__init__(self, filename, chunk, mode)
+        self.frame_format = vmd_format(labels)
+
+        return None
+
+
+    def write(self, positions, point, time=None, velocities=None):
+        """
+        Buffers the frame of [N,3] positions labelled Point = point. The
+        time and velocities are not part of the format and are ignored.
+        """
+
+        self.add(vmd_frame(self.frame_format, positions, point))
+
+        return None
+
+
+class AsyncRecordWriter:
+    """ CLASS VARIABLES:
+    file - Open output file, written only by the background thread.
+    binary - True to write raw float64 rows, False for text lines.
+    buffer - [capacity,ncols] float narray being filled.
+    count - Number of rows filled in buffer.
+    pending - Queue of (buffer, count) to be written by the thread.
+    free - Queue of buffers that have been written and can be refilled.
+    thread - Background writer thread.
+    error - Exception raised in the thread, raised again by the caller.
+    written - Number of rows written so far.
+
+    Collects records of ncols numbers in a preallocated buffer. A full
+    buffer is passed to a background thread which writes it in one go and
+    flushes it to disk, while the records of the following steps are put
+    in a second buffer. Text files hold one line per record of its values
+    formatted with '%f', each followed by a space, as written by
+    Utilities.write_output. Binary files hold the rows as little-endian
+    float64 and are read with np.fromfile(filename).reshape(-1, ncols).
+    """
+
+    def __init__(self, filename, ncols, binary=False, capacity=1024, mode='w'):
+        """
+        Opens filename for writing, or appending if mode is 'a'.
+        Param:
+            ncols - Number of values per record
+            binary - Write raw float64 rows instead of text
+            capacity - Number of records per buffer
+        """
+        self.binary = binary
+        self.file = open(filename, mode + ('b' if binary else ''))
+        self.buffer = np.empty((capacity, ncols))
+        self.count = 0
+        self.pending = queue.Queue()
+        self.free = queue.Queue()
+        self.free.put(np.empty_like(self.buffer)) # Double buffering
+        self.error = None
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        return None
+
+
+    def _run(self):
+        """ Writes the pending buffers until None is received. """
+
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                break
+            buffer, count = item
+            try:
+                if self.error is None:
+                    if self.binary:
+                        self.file.write(buffer[:count].astype('<f8').tobytes())
+                    else:
+                        np.savetxt(self.file, buffer[:count], fmt='%f', newline=' \n')
+                    self.file.flush()
+                    self.written += count
+            except Exception as error: # Raised again in the calling thread
+                self.error = error
+            self.free.put(buffer)
+            self.pending.task_done()
+
+        return None
+
+
+    def _check(self):
+        """ Raises the error of the background thread, if any. """
+
+        if self.error is not None:
+            raise self.error
+
+        return None
+
+
+    def write(self, *values):
+        """ Adds a record, passing the buffer to the thread once full. """
+
+        self.buffer[self.count] = values
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+        return None
+
+
+    def flush(self):
+        """ Passes the filled part of the buffer to the writer thread and
+        continues in a free buffer, waiting for one if the thread is
+        still writing both. """
+
+        self._check()
+        if self.count:
+            self.pending.put((self.buffer, self.count))
+            self.buffer, self.count = self.free.get(), 0
+
+        return None
+
+
+    def sync(self):
+        """ Writes all records so far to disk and waits until done. """
+
+        self.flush()
+        self.pending.join()
+        self._check()
+
+        return None
+
+
+    def close(self):
+        """ Writes the remaining records, stops the thread and closes the file. """
+
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+        self.file.close()
+        self._check()
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def vmd_format(labels):
+    """Returns the format string of the particle lines of a VMD frame,
+    to be filled with the flattened [N,3] positions."""
+
+    return ''.join('s%s %%f %%f %%f\n' % label for label in labels)
+
+
+def vmd_frame(frame_format, positions, point):
+    """Returns the VMD string of a frame of [N,3] positions:
+    N
+    Point = point
+    s<label> x y z
+    ...
+    """
+
+    return '%i\nPoint = %i\n' % (len(positions), point) + \
+           frame_format % tuple(positions.ravel())
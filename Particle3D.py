@@ -104,6 +104,106 @@ class Particle3D(object):
 
         return mic_separation_vector
 
+
+class ParticleView(Particle3D):
+    """
+    Particle3D whose position, velocity and mass live in row index of the
+    positions, velocities and masses arrays of an owner (e.g. a Box).
+    Reading returns a view of that row and assigning writes into it, so
+    the owner's arrays and the particle always agree.
+
+    Properties:
+    owner - object holding the positions, velocities and masses arrays
+    index - row of the particle in those arrays
+    label - a string describing the type of the particle
+    """
+
+    def __init__(self, owner, index, label=''):
+        """
+        Initialise a view of particle index of owner
+
+        :param owner: object holding the particle arrays
+        :param index: row of the particle as int
+        :param label: label as string
+        """
+
+        self.owner = owner
+        self.index = index
+        self.label = label
+
+    @property
+    def position(self):
+        return self.owner.positions[self.index]
+
+    @position.setter
+    def position(self, value):
+        self.owner.positions[self.index] = value
+
+    @property
+    def velocity(self):
+        return self.owner.velocities[self.index]
+
+    @velocity.setter
+    def velocity(self, value):
+        self.owner.velocities[self.index] = value
+
+    @property
+    def mass(self):
+        return self.owner.masses[self.index]
+
+    @mass.setter
+    def mass(self, value):
+        self.owner.masses[self.index] = value
+
+
+class ParticleList(object):
+    """
+    Sequence of the ParticleView objects of the rows of an owner's arrays.
+    The views are created when indexed, so no object is kept per particle.
+    The label of each particle is its original number, counting from 1.
+    If the owner has reordered its rows, its order narray gives the
+    original number of the particle in each row.
+
+    Properties:
+    owner - object holding the positions, velocities and masses arrays
+    labels - list of the labels of all particles in their original order
+    """
+
+    def __init__(self, owner):
+        """
+        Initialise the sequence of the particles of owner
+
+        :param owner: object holding the particle arrays
+        """
+
+        self.owner = owner
+
+    def __len__(self):
+        return len(self.owner.positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('particle index out of range')
+        return ParticleView(self.owner, index, self.label(index))
+
+    def __iter__(self):
+        return (ParticleView(self.owner, i, self.label(i)) for i in range(len(self)))
+
+    def label(self, index):
+        """ Returns the label of the particle in row index. """
+
+        order = getattr(self.owner, 'order', None)
+        return str((index if order is None else int(order[index])) + 1)
+
+    @property
+    def labels(self):
+        return [str(i+1) for i in range(len(self))]
+
 """
 p1 = Particle3D("s1", np.array([1,2,4]), np.array([0,0,0]), 1)
 p2 = Particle3D("s2", np.array([4,4,4]), np.array([0,0,0]), 1)
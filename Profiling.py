@@ -0,0 +1,207 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements the instrumentation of an argon N-body
+    * simulation. A Profiler passed to Box.simulate records the wall and
+    * CPU time of each phase of the simulation loop, counts the pairs
+    * evaluated and within the cutoff and the bytes written, and reports the
+    * throughput as JSON or CSV and optionally as a live progress line.
+    * Without a profiler the loop uses NullProfiler, whose methods do
+    * nothing, so the instrumentation costs a few no-op calls per step.
+"""
+import csv
+import json
+import sys
+import time
+
+ARGON_TAU_PS = 2.156 # LJ time unit sigma*sqrt(m/epsilon) of argon in ps
+
+
+class NullProfiler:
+    """
+    Profiler that records nothing, used when profiling is off.
+    """
+
+    enabled = False
+
+    def begin(self, first, nsteps, dt):
+        pass
+
+    def lap(self, name):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def step_done(self, t):
+        pass
+
+    def end_progress(self):
+        pass
+
+    def end(self, simulated=None):
+        pass
+
+
+class Profiler(NullProfiler):
+    """ CLASS VARIABLES:
+    phases - Dict of phase name to [wall time, CPU time, calls].
+    counters - Dict of counter name to total.
+    progress - Seconds between progress lines, 0 for none.
+    progress_open - True while a progress line is waiting for its newline.
+    count_interval - Steps between counts of the pairs in the cutoff.
+    steps - Number of steps run.
+    dt - Timestep size, or mean timestep size after the run.
+
+    Records the time spent in each phase of the simulation loop. Each call
+    to lap(name) adds the time since the previous lap to the phase name.
+    """
+
+    enabled = True
+
+    def __init__(self, progress=0, count_interval=100, stream=sys.stderr):
+        """
+        Param:
+            progress - Seconds between live progress lines, 0 for none
+            count_interval - Steps between counts of the pairs evaluated
+                             and within the cutoff
+            stream - Stream the progress lines are written to
+        """
+        self.phases = {}
+        self.counters = {}
+        self.progress = progress
+        self.progress_open = False
+        self.count_interval = count_interval
+        self.stream = stream
+        self.steps = 0
+        self.dt = 0
+
+        return None
+
+
+    def begin(self, first, nsteps, dt):
+        """ Starts timing a run of steps first to nsteps. """
+
+        self.first, self.nsteps, self.dt = first, nsteps, dt
+        self.start_wall = self.last_wall = self.last_print = time.perf_counter()
+        self.start_cpu = self.last_cpu = time.process_time()
+
+        return None
+
+
+    def lap(self, name):
+        """ Adds the time since the last lap to phase name. """
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        phase = self.phases.setdefault(name, [0, 0, 0])
+        phase[0] += wall - self.last_wall
+        phase[1] += cpu - self.last_cpu
+        phase[2] += 1
+        self.last_wall, self.last_cpu = wall, cpu
+
+        return None
+
+
+    def count(self, name, value):
+        """ Adds value to counter name. """
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+        return None
+
+
+    def step_done(self, t):
+        """ Counts step t as done, printing a progress line if due. """
+
+        self.steps += 1
+        if self.progress and self.last_wall - self.last_print >= self.progress:
+            self.last_print = self.last_wall
+            rate = self.steps/(self.last_wall - self.start_wall)
+            self.stream.write('\rStep %i/%i, %.1f steps/s, %.0f s left   ' %
+                              (t+1, self.nsteps, rate, (self.nsteps-t-1)/rate))
+            self.stream.flush()
+            self.progress_open = True
+
+        return None
+
+
+    def end_progress(self):
+        """ Ends the progress line, so that later output starts on a new
+        line. """
+
+        if self.progress_open:
+            self.stream.write('\n')
+            self.stream.flush()
+            self.progress_open = False
+
+        return None
+
+
+    def end(self, simulated=None):
+        """ Stops timing the run. simulated is the simulated time of the
+        run, from which the mean timestep is found if it varied. """
+
+        if simulated is not None and self.steps:
+            self.dt = simulated/self.steps
+        self.wall = time.perf_counter() - self.start_wall
+        self.cpu = time.process_time() - self.start_cpu
+        self.end_progress()
+
+        return None
+
+
+    def report(self):
+        """ Returns a dict with the phase times, counters and throughput. """
+
+        rate = self.steps/self.wall if self.wall else 0
+        per_day = rate*self.dt*86400 # LJ time units per day
+        pairs = self.counters.get('pairs evaluated', 0)
+
+        return {'steps': self.steps, 'wall': self.wall, 'cpu': self.cpu,
+                'steps_per_second': rate, 'tau_per_day': per_day,
+                'ns_per_day': per_day*ARGON_TAU_PS/1000,
+                'pairs_within_cutoff_fraction':
+                    self.counters.get('pairs within cutoff', 0)/pairs if pairs else None,
+                'phases': {name: {'wall': wall, 'cpu': cpu, 'calls': calls,
+                                  'fraction': wall/self.wall if self.wall else 0}
+                           for name, (wall, cpu, calls) in self.phases.items()},
+                'counters': dict(self.counters)}
+
+
+    def write(self, filename):
+        """ Writes the report to filename, as CSV if it ends in .csv and
+        as JSON otherwise. """
+
+        report = self.report()
+        with open(filename, 'w', newline='') as f:
+            if not filename.endswith('.csv'):
+                json.dump(report, f, indent=1)
+                return None
+            writer = csv.writer(f)
+            writer.writerow(['phase', 'wall', 'cpu', 'calls', 'fraction'])
+            for name, phase in report['phases'].items():
+                writer.writerow([name, phase['wall'], phase['cpu'], phase['calls'],
+                                 phase['fraction']])
+            writer.writerow([])
+            writer.writerow(['quantity', 'value'])
+            for name, value in report.items():
+                if name not in ('phases', 'counters'):
+                    writer.writerow([name, value])
+            for name, value in report['counters'].items():
+                writer.writerow([name, value])
+
+        return None
+
+
+    def summary(self):
+        """ Returns a short text summary of the report. """
+
+        report = self.report()
+        lines = ['%-12s %10s %10s %7s' % ('phase', 'wall/s', 'cpu/s', '%')]
+        for name, phase in sorted(report['phases'].items(), key=lambda p: -p[1]['wall']):
+            lines.append('%-12s %10.4f %10.4f %7.2f' % (name, phase['wall'], phase['cpu'],
+                                                        100*phase['fraction']))
+        lines.append('%.1f steps/s, %.3g ns/day (argon)' % (report['steps_per_second'],
+                                                           report['ns_per_day']))
+        for name, value in report['counters'].items():
+            lines.append('%s: %i' % (name, value))
+
+        return '\n'.join(lines)
@@ -0,0 +1,51 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements narrays in named shared memory blocks, which
+    * the worker processes of an argon N-body simulation attach to by
+    * name. They are used by the domain decomposition in Domains.py and
+    * the parallel trajectory reader in Trajectory.py.
+"""
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedArray:
+    """ CLASS VARIABLES:
+    shm - SharedMemory block holding the data.
+    array - narray view of the block.
+
+    A float64 or int64 narray in a named shared memory block that worker
+    processes attach to by name.
+    """
+
+    def __init__(self, shape, dtype=np.float64, name=None):
+        """
+        Creates a zeroed shared array, or attaches to the existing block
+        name if given.
+        """
+        size = int(np.prod(shape))*np.dtype(dtype).itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        if name is None:
+            self.array[...] = 0
+
+        return None
+
+
+    def spec(self):
+        """ Returns the (shape, dtype, name) needed to attach to the array. """
+
+        return self.array.shape, self.array.dtype, self.shm.name
+
+
+    def close(self, unlink=False):
+        """ Detaches from the block, and frees it if unlink is True. """
+
+        del self.array
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+        return None
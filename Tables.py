@@ -0,0 +1,217 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements tabulated pair potentials for an argon N-body
+    * simulation. The potential energy and the force divided by r are
+    * tabulated once on a uniform grid in r^2 up to the cutoff, and pairs are
+    * evaluated by cubic Hermite interpolation within their grid interval, so
+    * no square roots or powers are needed. Any pair potential U(r) can be
+    * tabulated, not only Lennard-Jones. The accuracy is set by the number of
+    * grid points and can be measured against the analytic kernel with:
+    * python3 Tables.py [--points=500,1000,2000,4000] [--nsteps=2000]
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import numpy as np
+from Box import Box
+import Backends
+
+DEFAULT_POINTS = 2000 # Default number of table intervals
+DEFAULT_RMIN = 0.5 # Default smallest tabulated distance
+
+
+def lj_energy(r):
+    """ Unshifted Lennard-Jones potential 4*(r^-12 - r^-6). """
+    return 4*(r**-12 - r**-6)
+
+def lj_force(r):
+    """ Lennard-Jones force magnitude -dU/dr = 48*(r^-13 - 0.5*r^-7). """
+    return 48*(r**-13 - 0.5*r**-7)
+
+
+def hermite(values, slopes):
+    """Returns the [n,4] narray of the coefficients c0..c3 of the cubic
+    c0 + c1*t + c2*t^2 + c3*t^3, t in [0,1), on each of the n intervals
+    between n+1 grid values with the given slopes per interval width."""
+
+    p0, p1, m0, m1 = values[:-1], values[1:], slopes[:-1], slopes[1:]
+
+    return np.column_stack((p0, m0, 3*(p1-p0) - 2*m0 - m1, 2*(p0-p1) + m0 + m1))
+
+
+def central_difference(function, x, dx):
+    """ Returns the fourth order central difference derivative of
+    function at x with steps dx. """
+
+    return (8*(function(x + dx) - function(x - dx)) -
+            (function(x + 2*dx) - function(x - 2*dx)))/(12*dx)
+
+
+class PairTable:
+    """ CLASS VARIABLES:
+    cutoff - Cutoff distance, the table ends at cutoff^2.
+    s0, inv_h - Start of the r^2 grid and inverse interval width.
+    coeffs - [n,8] float narray, per interval the cubic coefficients of
+             the shifted potential energy followed by those of the force
+             divided by r, both as functions of r^2.
+
+    A pair potential tabulated on n intervals of r^2. The energy is
+    shifted so that it is zero at the cutoff, as the analytic LJ kernels.
+    Distances below sqrt(s0) are extrapolated from the first interval.
+    """
+
+    def __init__(self, energy=lj_energy, cutoff=2.5, npoints=DEFAULT_POINTS,
+                 force=None, rmin=DEFAULT_RMIN):
+        """
+        Tabulates a pair potential.
+        Param:
+            energy - Vectorised function of r returning the potential U(r)
+            cutoff - Cutoff distance
+            npoints - Number of grid intervals
+            force - Vectorised function of r returning -dU/dr, by default
+                    found by central differences of energy
+            rmin - Smallest tabulated distance
+        """
+        if force is None:
+            force = lambda r: -central_difference(energy, r, 1e-3*r)
+        self.cutoff = cutoff
+        self.s0 = rmin**2
+        h = (cutoff**2 - self.s0)/npoints
+        self.inv_h = 1/h
+        s = self.s0 + h*np.arange(npoints+1)
+        r = np.sqrt(s)
+
+        # Force over r, f(s), and its slope from central differences in s.
+        f = lambda s: force(np.sqrt(s))/np.sqrt(s)
+        fvalues = f(s)
+        fslopes = central_difference(f, s, 1e-3*h)
+        # dU/ds = dU/dr/(2r) = -f/2.
+        uvalues = energy(r) - energy(cutoff)
+        uslopes = -fvalues/2
+
+        self.coeffs = np.ascontiguousarray(np.hstack((hermite(uvalues, h*uslopes),
+                                                      hermite(fvalues, h*fslopes))))
+
+        return None
+
+
+    @classmethod
+    def lennard_jones(cls, cutoff, npoints=DEFAULT_POINTS, rmin=DEFAULT_RMIN):
+        """ Returns the table of the Lennard-Jones potential. """
+
+        return cls(lj_energy, cutoff, npoints, lj_force, rmin)
+
+
+    @property
+    def npoints(self):
+        return len(self.coeffs)
+
+
+    def evaluate(self, r2):
+        """Returns the narrays of the force divided by r and the shifted
+        potential energy at the squared distances r2, all within the
+        cutoff."""
+
+        x = (np.asarray(r2) - self.s0)*self.inv_h
+        k = np.clip(x.astype(np.intp), 0, self.npoints-1)
+        t = (x - k)[..., None]
+        c = self.coeffs[k]
+        # Horner evaluation of both cubics at once.
+        values = ((c[..., [3,7]]*t + c[..., [2,6]])*t + c[..., [1,5]])*t + c[..., [0,4]]
+
+        return values[..., 1], values[..., 0]
+
+
+    def max_error(self, energy=lj_energy, force=lj_force, rmin=0.9, samples=100000):
+        """Returns the largest absolute errors of the energy and of the
+        force magnitude between rmin and the cutoff, against the given
+        analytic functions."""
+
+        r = np.linspace(rmin, self.cutoff, samples, endpoint=False)
+        fscalar, u = self.evaluate(r**2)
+
+        return (np.max(np.abs(u - (energy(r) - energy(self.cutoff)))),
+                np.max(np.abs(fscalar*r - force(r))))
+
+
+def load_potential(name):
+    """ Returns the function named by 'module:function', e.g. Tables:lj_energy. """
+
+    module, _, function = name.partition(':')
+    if not function:
+        raise ValueError('Pair potential must be given as module:function, not ' + name)
+
+    return getattr(importlib.import_module(module), function)
+
+
+def make_table(cutoff, npoints=0, potential=None):
+    """Returns the PairTable of the options of Main.py: the potential
+    function named by 'module:function', or Lennard-Jones if None,
+    tabulated on npoints intervals (DEFAULT_POINTS if 0). Returns None
+    if neither is given, for the analytic Lennard-Jones kernels."""
+
+    if not npoints and not potential:
+        return None
+    npoints = npoints or DEFAULT_POINTS
+    if potential is None:
+        return PairTable.lennard_jones(cutoff, npoints)
+
+    return PairTable(load_potential(potential), cutoff, npoints)
+
+
+def energy_drift(table, N=256, rho=0.8, T=1.0, cutoff=2.5, dt=0.005, nsteps=2000,
+                 backend='numpy', method='cells', seed=0):
+    """Runs nsteps of velocity Verlet from the same seeded initial state
+    with the table (or the analytic kernel if table is None) and returns
+    the total energy drift |E(t) - E(0)|/|E(0)| at the end of the run and
+    the largest one along the way."""
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        box = Box(N, cutoff, rho, T, backend, method=method, table=table, seed=seed)
+    box.get_forces_energy(out=box.forces)
+    buffer = np.empty_like(box.forces)
+    energies = np.empty(nsteps+1)
+    energies[0] = box.potential + box.kinetic_energy()
+    for t in range(nsteps):
+        buffer = box.step(dt, buffer)
+        box.enforce_pbc()
+        energies[t+1] = box.potential + box.kinetic_energy()
+    drift = np.abs(energies - energies[0])/abs(energies[0])
+
+    return drift[-1], drift.max()
+
+
+def get_arguments(argv=None):
+    """ Parses the command line argv (sys.argv[1:] by default). """
+
+    parser = argparse.ArgumentParser(prog='Tables.py',
+                description='Accuracy and energy drift of the Lennard-Jones table.')
+    parser.add_argument('--points', type=lambda value: [int(n) for n in value.split(',')],
+                        default=[500, 1000, 2000, 4000],
+                        help='numbers of table intervals, comma separated')
+    parser.add_argument('--nsteps', type=int, default=2000, help='steps of the drift runs')
+    parser.add_argument('--N', type=int, default=256, help='number of particles')
+    parser.add_argument('--rho', type=float, default=0.8, help='number density')
+    parser.add_argument('--T', type=float, default=1.0, help='initial temperature')
+    parser.add_argument('--backend', default='numpy', choices=list(Backends.REGISTRY),
+                        help='force and energy backend')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = get_arguments(argv)
+    kwargs = dict(N=options.N, rho=options.rho, T=options.T, nsteps=options.nsteps,
+                  backend=options.backend)
+
+    print('%8s %12s %12s %12s %12s' % ('points', 'max dU', 'max dF',
+                                       'final drift', 'max drift'))
+    print('%8s %12s %12s %12.3e %12.3e' % (('analytic', '', '') +
+                                           energy_drift(None, **kwargs)))
+    for npoints in options.points:
+        table = PairTable.lennard_jones(2.5, npoints)
+        print('%8i %12.3e %12.3e %12.3e %12.3e' % ((npoints,) + table.max_error() +
+                                                   energy_drift(table, **kwargs)))
+
+if __name__ == '__main__':
+    main()
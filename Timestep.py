@@ -0,0 +1,108 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements adaptive timestepping for an argon N-body
+    * simulation. An AdaptiveTimestep passed to Box.simulate chooses the
+    * size of every velocity Verlet step: the largest step that moves no
+    * particle further than a given distance and changes the total energy
+    * per particle by no more than a given tolerance. A step that changes
+    * the energy too much is undone and retried with half the size. After
+    * each accepted step the size grows towards the largest safe value,
+    * using that the energy error of a single Verlet step scales as dt^3.
+"""
+import numpy as np
+
+
+class AdaptiveTimestep:
+    """ CLASS VARIABLES:
+    dt - Size of the next step.
+    drift - Largest change of the total energy per particle in one step.
+    max_displacement - Largest distance a particle may move in one step.
+    dt_min, dt_max - Bounds of the step size.
+    growth - Largest factor by which the step size grows after a step.
+    safety - Factor below the estimated largest step that is taken.
+    accepted, rejected - Number of steps taken and undone.
+    smallest, largest - Smallest and largest step size taken.
+    """
+
+    def __init__(self, dt, drift=1e-4, max_displacement=0.05, dt_min=None, dt_max=None,
+                 growth=1.25, safety=0.8):
+        """
+        Param:
+            dt - Initial step size
+            drift - Tolerance of the change of the total energy per
+                    particle in one step, in units of epsilon
+            max_displacement - Largest distance a particle may move in
+                               one step, in units of sigma
+            dt_min, dt_max - Bounds of the step size, default to dt/1000
+                             and 10*dt
+            growth - Largest factor by which the step size grows per step
+            safety - Factor below the estimated largest step that is taken
+        """
+        self.dt = dt
+        self.drift = drift
+        self.max_displacement = max_displacement
+        self.dt_min = dt/1000 if dt_min is None else dt_min
+        self.dt_max = 10*dt if dt_max is None else dt_max
+        self.growth = growth
+        self.safety = safety
+        self.accepted, self.rejected = 0, 0
+        self.smallest, self.largest = np.inf, 0
+
+        return None
+
+
+    def displacement_limit(self, box):
+        """Returns the largest step size for which no particle of box moves
+        more than max_displacement, from |v|*dt + |F/m|*dt^2/2."""
+
+        speed = np.sqrt(np.max(np.einsum('ij,ij->i', box.velocities, box.velocities)))
+        accel = np.sqrt(np.max(np.einsum('ij,ij->i', box.forces, box.forces)/box.masses**2))
+        if speed == 0 and accel == 0:
+            return np.inf
+
+        # The root of accel*dt^2/2 + speed*dt = d, in a form without cancellation.
+        return 2*self.max_displacement/(speed + np.sqrt(speed**2 +
+                                                        2*accel*self.max_displacement))
+
+
+    def advance(self, box, old_forces):
+        """
+        Advances box by one velocity Verlet step with Box.step, of the
+        largest size within the tolerances. old_forces is the force
+        buffer as for Box.step.
+        Returns:
+            dt - Size of the step taken
+            old_forces - Buffer to be passed to the next step
+        """
+
+        N = len(box.positions)
+        dt = max(min(self.dt, self.displacement_limit(box)), self.dt_min)
+        energy = box.potential + box.kinetic_energy()
+        positions, velocities = box.positions.copy(), box.velocities.copy()
+        potential, virial = box.potential, box.virial
+        while True:
+            old_forces = box.step(dt, old_forces)
+            error = abs(box.potential + box.kinetic_energy() - energy)/N
+            if error <= self.drift or dt <= self.dt_min:
+                break
+            # Undo the step, Box.step returned the unchanged old forces.
+            box.positions[:] = positions
+            box.velocities[:] = velocities
+            box.forces, old_forces = old_forces, box.forces
+            box.potential, box.virial = potential, virial
+            self.rejected += 1
+            dt = max(dt/2, self.dt_min)
+
+        self.accepted += 1
+        self.smallest, self.largest = min(self.smallest, dt), max(self.largest, dt)
+        factor = self.growth if error == 0 else \
+                 min(self.growth, self.safety*(self.drift/error)**(1/3))
+        self.dt = min(max(dt*factor, self.dt_min), self.dt_max)
+
+        return dt, old_forces
+
+
+    def summary(self):
+        """ Returns a one line summary of the steps taken. """
+
+        return ('Adaptive timestep: %i steps, %i undone, dt from %g to %g'
+                % (self.accepted, self.rejected, self.smallest, self.largest))
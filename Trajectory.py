@@ -0,0 +1,409 @@
+""" * Authors: C. Kourris and Ethan van Woerkom
+    * This module implements a compact binary trajectory format for an
+    * argon N-body simulation, and conversion to and from VMD .xyz files.
+    * A file holds a fixed 64 byte header followed by fixed size frame
+    * records, so it can be opened with np.memmap and any range of frames
+    * sliced without reading the rest of the file. VMD .xyz files are
+    * read through a cached index of their frame offsets.
+    * Usage as a converter:
+    * python3 Trajectory.py vmdoutput.xyz trajectory.traj boxdim
+    * python3 Trajectory.py trajectory.traj vmdoutput.xyz
+"""
+import os
+import struct
+import sys
+import numpy as np
+import multiprocessing as mp
+from Output import XYZWriter
+from SharedArrays import SharedArray
+
+MAGIC = b'LJTRAJ\x00\x00'
+VERSION = 1
+# Header: magic, version, bytes per float, velocities flag, N, boxdim,
+# padded to HEADER_SIZE bytes.
+HEADER_FORMAT = '<8sIIIQd'
+HEADER_SIZE = 64
+EXTENSION = '.traj'
+INDEX_EXTENSION = '.idx' # Cached frame index of a VMD .xyz file
+PARALLEL_FRAMES = 64 # Frames parsed per task when reading .xyz files
+
+
+def frame_dtype(N, precision=4, velocities=False):
+    """Returns the numpy record dtype of one frame of N particles with
+    floats of precision bytes (4 or 8): the step number, time, positions
+    and optionally velocities."""
+
+    floats = np.float32 if precision == 4 else np.float64
+    fields = [('step', '<i8'), ('time', '<f8'), ('positions', floats, (N,3))]
+    if velocities:
+        fields.append(('velocities', floats, (N,3)))
+
+    return np.dtype(fields)
+
+
+class TrajectoryWriter:
+    """ CLASS VARIABLES:
+    file - Open binary output file.
+    record - Record array of a single frame used to convert each frame.
+    written - Number of bytes written so far.
+
+    Writes frames of a binary trajectory, with the same write interface
+    as Output.XYZWriter.
+    """
+
+    def __init__(self, filename, N, boxdim, precision=4, velocities=False,
+                 chunk=4*2**20, mode='w'):
+        """
+        Opens filename and writes the header, or opens it for appending
+        frames if mode is 'a', in which case the header must match.
+        Param:
+            N - number of particles
+            boxdim - PBC box dimension
+            precision - Bytes per float of the stored frames, 4 or 8
+            velocities - Whether velocities are stored too
+            chunk - Size of the write buffer in bytes
+        """
+        if precision not in (4, 8):
+            raise ValueError('Trajectory precision must be 4 or 8 bytes')
+        self.record = np.zeros(1, dtype=frame_dtype(N, precision, velocities))
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, precision,
+                             int(velocities), N, boxdim).ljust(HEADER_SIZE, b'\0')
+        if mode == 'a':
+            with open(filename, 'rb') as f:
+                if f.read(HEADER_SIZE)[:struct.calcsize(HEADER_FORMAT)] != \
+                   header[:struct.calcsize(HEADER_FORMAT)]:
+                    raise ValueError('Cannot append to %s, header differs' % filename)
+            self.file = open(filename, 'ab', buffering=chunk)
+        else:
+            self.file = open(filename, 'wb', buffering=chunk)
+            self.file.write(header)
+        self.written = HEADER_SIZE if mode != 'a' else 0
+
+        return None
+
+
+    def write(self, positions, point, time=None, velocities=None):
+        """
+        Writes a frame of [N,3] positions at step point and the given time
+        (defaults to point), with the [N,3] velocities if they are stored.
+        """
+
+        self.record['step'] = point
+        self.record['time'] = point if time is None else time
+        self.record['positions'] = positions
+        if velocities is not None and 'velocities' in self.record.dtype.names:
+            self.record['velocities'] = velocities
+        self.file.write(self.record.tobytes())
+        self.written += self.record.nbytes
+
+        return None
+
+
+    def flush(self):
+        """ Writes buffered frames to disk. """
+
+        self.file.flush()
+
+        return None
+
+
+    def close(self):
+        """ Writes any remaining frames and closes the file. """
+
+        self.file.close()
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Trajectory:
+    """ CLASS VARIABLES:
+    N - Number of particles.
+    boxdim - PBC box dimension.
+    frames - Memory mapped record array of all complete frames.
+
+    A binary trajectory file opened for lazy reading. The positions,
+    velocities, times and steps are memory mapped views, so slicing a
+    range of frames only reads those frames from disk.
+    """
+
+    def __init__(self, filename):
+        """ Opens filename and maps its frames. """
+
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            f.seek(0, 2)
+            size = f.tell()
+        magic, version, precision, velocities, self.N, self.boxdim = \
+            struct.unpack(HEADER_FORMAT, header[:struct.calcsize(HEADER_FORMAT)])
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a trajectory file of version %i' % (filename, VERSION))
+
+        dtype = frame_dtype(self.N, precision, bool(velocities))
+        # An interrupted run may have left an incomplete last frame.
+        nframes = (size - HEADER_SIZE)//dtype.itemsize
+        if nframes == 0: # Empty files cannot be mapped
+            self.frames = np.zeros(0, dtype=dtype)
+        else:
+            self.frames = np.memmap(filename, dtype=dtype, mode='r',
+                                    offset=HEADER_SIZE, shape=(nframes,))
+
+        return None
+
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def positions(self):
+        """ [T,N,3] view of the positions of all frames. """
+        return self.frames['positions']
+
+    @property
+    def velocities(self):
+        """ [T,N,3] view of the velocities of all frames, or None. """
+        if 'velocities' not in self.frames.dtype.names:
+            return None
+        return self.frames['velocities']
+
+    @property
+    def times(self):
+        """ [T] narray of the times of all frames. """
+        return np.array(self.frames['time'])
+
+    @property
+    def steps(self):
+        """ [T] narray of the step numbers of all frames. """
+        return np.array(self.frames['step'])
+
+
+class XYZTrajectory:
+    """ CLASS VARIABLES:
+    filename - Name of the VMD .xyz file.
+    N - Number of particles.
+    offsets - [T+1] narray of the byte offsets of the frame starts,
+              followed by the end of the last complete frame.
+    labels - List of the N particle labels.
+
+    A VMD .xyz file opened for indexed reading. The byte offset of every
+    frame is found once and cached next to the file in filename.idx, so
+    single frames can be read by index or iterated lazily, and ranges of
+    frames parsed in parallel into a preallocated array.
+    """
+
+    def __init__(self, filename, cache=True):
+        """ Opens filename, reading or building its frame index. """
+
+        self.filename = filename
+        stat = os.stat(filename)
+        index = filename + INDEX_EXTENSION
+        try:
+            with np.load(index) as cached:
+                if (cached['size'], cached['mtime']) != (stat.st_size, stat.st_mtime_ns):
+                    raise ValueError('Stale index')
+                self.N, self.offsets = int(cached['N']), cached['offsets']
+        except (OSError, ValueError, KeyError):
+            self.N, self.offsets = index_xyz(filename)
+            if cache:
+                try:
+                    with open(index, 'wb') as f:
+                        np.savez(f, N=self.N, offsets=self.offsets,
+                                 size=stat.st_size, mtime=stat.st_mtime_ns)
+                except OSError: # Read-only directory, index is not cached
+                    pass
+        self.labels = [label.decode()[1:] for label in
+                       self._read(0, 1)[:,0]] if len(self) else []
+
+        return None
+
+
+    def _read(self, start, end):
+        """ Returns the [(end-start)*N,4] narray of bytes tokens of the
+        particle lines of frames start to end exclusive. """
+
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offsets[start])
+            data = f.read(self.offsets[end] - self.offsets[start])
+        lines = data.split(b'\n')
+        # Drop the count and comment lines of each frame.
+        rows = [line.split() for k in range(end-start)
+                for line in lines[k*(self.N+2)+2:(k+1)*(self.N+2)]]
+
+        return np.array(rows)[:,:4]
+
+
+    def read_frames(self, start=0, end=None, out=None, processes=None):
+        """
+        Returns the [T,N,3] positions of frames start to end exclusive,
+        parsed into out if given. Long ranges are split between a pool of
+        processes (default: one per core) that parse directly into a
+        shared array. If out is a SharedArray the processes write into it
+        and its array is returned. Otherwise they write into a temporary
+        SharedArray, which is then copied into out, so the frames are held
+        twice for a moment.
+        """
+
+        end = len(self) if end is None else end
+        nframes = max(end - start, 0)
+        shared = out if isinstance(out, SharedArray) else None
+        if shared is not None:
+            out = shared.array
+        if out is None:
+            out = np.empty((nframes, self.N, 3))
+        processes = processes or os.cpu_count() or 1
+        processes = min(processes, nframes//PARALLEL_FRAMES)
+        if processes <= 1:
+            for k in range(start, end, PARALLEL_FRAMES):
+                stop = min(k + PARALLEL_FRAMES, end)
+                out[k-start:stop-start] = self._read(k, stop)[:,1:].astype(float) \
+                                            .reshape(stop-k, self.N, 3)
+            return out
+
+        temporary = shared is None
+        if temporary:
+            shared = SharedArray(out.shape)
+        try:
+            bounds = np.linspace(start, end, 4*processes+1).astype(int)
+            jobs = [(self.filename, self.N, self.offsets[a:b+1], a-start, shared.spec())
+                    for a, b in zip(bounds[:-1], bounds[1:])]
+            with mp.Pool(processes) as pool:
+                pool.map(_parse_xyz, jobs)
+            if temporary:
+                out[...] = shared.array
+        finally:
+            if temporary:
+                shared.close(unlink=True)
+
+        return out
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """ [N,3] positions of frame index, or [T,N,3] of a slice. """
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            if step != 1:
+                return np.array([self[k] for k in range(start, end, step)])
+            return self.read_frames(start, end)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Frame index out of range')
+        return self._read(index, index+1)[:,1:].astype(float)
+
+    def __iter__(self):
+        """ Yields the [N,3] positions of each frame, reading lazily. """
+        for k in range(len(self)):
+            yield self[k]
+
+    @property
+    def points(self):
+        """ [T] narray of the Point numbers of all frames. """
+        points = np.empty(len(self), dtype=np.int64)
+        with open(self.filename, 'rb') as f:
+            for k, offset in enumerate(self.offsets[:-1]):
+                f.seek(offset)
+                f.readline()
+                points[k] = int(f.readline().split(b'=')[1])
+        return points
+
+
+def index_xyz(filename, chunk=2**26):
+    """Scans the VMD .xyz file filename in chunks of bytes for its line
+    starts. Every frame is a count line, a comment line and N particle
+    lines, so the frame starts are every (N+2)th line start; each is
+    checked to hold the particle count. Returns N and the [T+1] narray of
+    frame offsets, ending with the end of the last complete frame."""
+
+    starts = [np.zeros(1, dtype=np.int64)]
+    with open(filename, 'rb') as f:
+        position = 0
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+            starts.append(newlines + position + 1)
+            position += len(data)
+        starts = np.concatenate(starts)
+        # A file ending in a newline has no line after its last line start.
+        starts = starts[starts < position] if len(starts) > 1 else starts[:0]
+        if not len(starts):
+            return 0, np.zeros(1, dtype=np.int64)
+        f.seek(0)
+        N = int(f.readline())
+
+        line_starts = np.append(starts, position)
+        nframes = (len(line_starts) - 1)//(N+2)
+        offsets = line_starts[::N+2][:nframes+1]
+        count = b'%i' % N
+        for offset in offsets[:-1]:
+            f.seek(offset)
+            if f.readline().strip() != count:
+                raise ValueError('%s: frame at byte %i does not hold %i particles'
+                                 % (filename, offset, N))
+
+    return N, offsets
+
+
+def _parse_xyz(job):
+    """ Pool task parsing the frames at the given offsets of a VMD file
+    into the rows from first on of a shared [T,N,3] array. """
+
+    filename, N, offsets, first, spec = job
+    shared = SharedArray(*spec)
+    try:
+        reader = XYZTrajectory.__new__(XYZTrajectory)
+        reader.filename, reader.N, reader.offsets = filename, N, offsets
+        reader.read_frames(0, len(offsets)-1, shared.array[first:first+len(offsets)-1],
+                           processes=1)
+    finally:
+        shared.close()
+
+    return None
+
+
+def xyz_to_traj(xyzfile, trajfile, boxdim, precision=4, dt=1):
+    """Converts the VMD .xyz file xyzfile to the binary trajectory trajfile,
+    with frame times of point*dt. Returns the number of frames."""
+
+    xyz = XYZTrajectory(xyzfile)
+    with TrajectoryWriter(trajfile, xyz.N, boxdim, precision) as writer:
+        for point, positions in zip(xyz.points, xyz):
+            writer.write(positions, point, point*dt)
+
+    return len(xyz)
+
+
+def traj_to_xyz(trajfile, xyzfile, labels=None):
+    """Converts the binary trajectory trajfile to the VMD .xyz file xyzfile,
+    with particle labels 1 to N unless given. Returns the number of frames."""
+
+    traj = Trajectory(trajfile)
+    if labels is None:
+        labels = [str(i) for i in range(1, traj.N+1)]
+    with XYZWriter(xyzfile, labels) as writer:
+        for frame in traj.frames:
+            writer.write(frame['positions'], frame['step'])
+
+    return len(traj)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and not sys.argv[1].endswith(EXTENSION):
+        print('%i frames converted' % xyz_to_traj(sys.argv[1], sys.argv[2], float(sys.argv[3])))
+    elif len(sys.argv) == 3 and sys.argv[1].endswith(EXTENSION):
+        print('%i frames converted' % traj_to_xyz(sys.argv[1], sys.argv[2]))
+    else:
+        print("Give an input and output file, and the box dimension for .xyz input, e.g.:")
+        print("Trajectory.py vmdoutput.xyz trajectory.traj 6.0")
+        print("Trajectory.py trajectory.traj vmdoutput.xyz")
+        raise Exception('Wrong arguments')
@@ -2,50 +2,174 @@
     * This module implements various functions
     * for an argon N-body simulation.
 """
+import argparse
 import numpy as np
+import multiprocessing as mp
+import os
 import sys
 from Particle3D import Particle3D
-
-def get_arguments():
-    """"The program is called with two filenames as input. The first one
-    contains the simulation parameters. The second one is the name of
-    the file to which the VMD output will be written.
-    This function parses those inputs and returns a list with the
-    contents of the first file
-    and a string with the name of the second file."""
-
-    if (len(sys.argv) > 4) or (len(sys.argv) < 3):
-        print("Wrong number of arguments, give two (and -a for acceleration), e.g.:")
-        print("Main.py parameters.txt vmdoutput.xyz -a")
-        raise Exception('Wrong arguments')
-
-    cpp = True if ('-a' in sys.argv) else False
-    paramfilename = sys.argv[1]
-    VMDfile = sys.argv[2]
-    # Now get parameters individually:
-    paramfile = open(paramfilename, 'r')
-    lines = paramfile.readlines()
-    N = int(lines[1])
-    rho = float(lines[3])
-    LJ_cutoff = float(lines[5])
-    T = float(lines[7])
-    dt = float(lines[9])
-    nsteps = int(lines[11])
-
-    return [N, rho, LJ_cutoff, T, dt, nsteps], VMDfile, cpp
-
-
-def LJ_Potential(vector, cutoff):
+from Neighbours import iter_cell_pairs
+import NumpyKernels
+from Trajectory import XYZTrajectory
+
+# The six fixed parameters of a parameter file, given as label/value line
+# pairs in this order. Maps the label to the parameter name and type.
+FIXED_PARAMETERS = {
+    "Nparticles": ("N", int),
+    "Reduced Density": ("rho", float),
+    "LJ Cutoff Distance": ("cutoff", float),
+    "Reduced Temperature": ("T", float),
+    "Reduced timestep": ("dt", float),
+    "Simulation steps": ("nsteps", int),
+}
+
+# Optional parameters which may follow the six fixed entries of a parameter
+# file as further label/value line pairs. Maps the label to the option name and
+# type. Every option can also be given on the command line as --name=value.
+OPTIONAL_PARAMETERS = {
+    "Force method": ("method", str),
+    "Neighbour skin": ("skin", float),
+    "Backend": ("backend", str),
+    "Pair block size": ("block", int),
+    "Threads": ("threads", int),
+    "Domains": ("domains", int),
+    "Output stride": ("stride", int),
+    "Keep positions": ("keep", int),
+    "Trajectory precision": ("precision", int),
+    "Trajectory velocities": ("velocities", int),
+    "Checkpoint interval": ("checkpoint", int),
+    "Checkpoint file": ("checkpointfile", str),
+    "Restart": ("restart", str),
+    "Profile report": ("profile", str),
+    "Progress interval": ("progress", float),
+    "Table points": ("table", int),
+    "Pair potential": ("potential", str),
+    "Energy drift": ("drift", float),
+    "Max displacement": ("displacement", float),
+    "Max timestep": ("dtmax", float),
+    "Mixed precision": ("mixed", int),
+    "Random seed": ("seed", int),
+    "Reorder interval": ("reorder", int),
+    "Analysis": ("analysis", int),
+    "Plots": ("plot", int),
+    "Show plots": ("show", int),
+}
+
+# Options which may be given on the command line without a value to set them to 1.
+SWITCHES = ('keep', 'velocities', 'mixed', 'analysis', 'plot', 'show')
+
+# Extensions of the output files of Main.py, VMD and binary trajectories.
+OUTPUT_EXTENSIONS = ('.xyz', '.traj')
+
+
+def get_arguments(argv=None):
+    """Parses the command line argv (sys.argv[1:] by default) of Main.py:
+    an optional parameter file, an optional output file for the VMD
+    frames (vmdoutput.xyz by default) and options, in any order. A
+    single file name ending in one of OUTPUT_EXTENSIONS is the output
+    file. Any fixed or optional
+    parameter can be given as --name=value and overrides the parameter
+    file, so that runs need no parameter file at all. -a selects the C++
+    backend and -n the NumPy backend.
+    Returns the list of the six fixed parameters, the output file name,
+    the backend (None if not given) and the dictionary of optional
+    parameters."""
+
+    import Backends # Imported here as Backends imports this module
+    backends = list(Backends.REGISTRY) + ['auto']
+
+    parser = argparse.ArgumentParser(prog='Main.py',
+                description='Lennard-Jones N-body simulation of argon.',
+                epilog='e.g. Main.py liquid.txt vmdoutput.xyz -a --method=cells --nsteps=2000')
+    parser.add_argument('paramfile', nargs='?', help='parameter file')
+    parser.add_argument('outfile', nargs='?', default='vmdoutput.xyz',
+                        help='output file of the frames, .xyz or .traj')
+    parser.add_argument('-a', dest='backend', action='store_const', const='cpp',
+                        default=argparse.SUPPRESS, help='use the C++ backend')
+    parser.add_argument('-n', dest='backend', action='store_const', const='numpy',
+                        default=argparse.SUPPRESS, help='use the NumPy backend')
+    for label, (name, kind) in list(FIXED_PARAMETERS.items()) + list(OPTIONAL_PARAMETERS.items()):
+        switch = dict(nargs='?', const=1) if name in SWITCHES else {}
+        if name == 'backend':
+            switch['choices'] = backends
+        parser.add_argument('--' + name, type=kind, default=argparse.SUPPRESS, help=label,
+                            **switch)
+    arguments = vars(parser.parse_intermixed_args(argv))
+
+    paramfile, outfile = arguments.pop('paramfile'), arguments.pop('outfile')
+    # A single trajectory file name is the output of a run without a parameter file.
+    if paramfile is not None and paramfile.endswith(OUTPUT_EXTENSIONS) and \
+       outfile == parser.get_default('outfile'):
+        paramfile, outfile = None, paramfile
+    values = read_parameter_file(paramfile) if paramfile is not None else {}
+    values.update(arguments)
+    missing = [label for label, (name, kind) in FIXED_PARAMETERS.items() if name not in values]
+    if missing:
+        parser.error('missing parameters, give a parameter file or --%s'
+                     % ' --'.join(FIXED_PARAMETERS[label][0] for label in missing))
+
+    parameters = [values.pop(name) for name, kind in FIXED_PARAMETERS.values()]
+    backend = values.pop('backend', None)
+    if backend is not None and backend not in backends:
+        parser.error('unknown backend %s in %s, choose from %s'
+                     % (backend, paramfile, ', '.join(backends)))
+
+    return parameters, outfile, backend, values
+
+
+def read_parameter_file(paramfilename):
+    """Reads the label/value line pairs of a parameter file and returns
+    the dictionary of the values by parameter name, see FIXED_PARAMETERS
+    and OPTIONAL_PARAMETERS. Blank lines are skipped. Unknown labels of
+    the first six pairs are taken as the fixed parameters in order."""
+
+    with open(paramfilename, 'r') as paramfile:
+        lines = [line.strip() for line in paramfile if line.strip()]
+    fixed = list(FIXED_PARAMETERS.values())
+
+    values = {}
+    for k, (label, value) in enumerate(zip(lines[0::2], lines[1::2])):
+        if label in FIXED_PARAMETERS:
+            name, kind = FIXED_PARAMETERS[label]
+        elif label in OPTIONAL_PARAMETERS:
+            name, kind = OPTIONAL_PARAMETERS[label]
+        elif k < len(fixed):
+            name, kind = fixed[k]
+        else:
+            raise Exception('Unknown parameter: ' + label)
+        values[name] = kind(value)
+
+    return values
+
+
+def read_parameters(paramfilename):
+    """Reads a parameter file and returns the list of the six fixed
+    parameters [N, rho, LJ_cutoff, T, dt, nsteps] and the dictionary of
+    the optional parameters that follow them, see OPTIONAL_PARAMETERS."""
+
+    values = read_parameter_file(paramfilename)
+    for label, (name, kind) in FIXED_PARAMETERS.items():
+        if name not in values:
+            raise Exception('Missing parameter: ' + label)
+
+    return [values.pop(name) for name, kind in FIXED_PARAMETERS.values()], values
+
+
+def LJ_Potential(vector, cutoff, table=None):
     """"This function calculates the Lennard-Jones potential for a
     particle separated by the vector in distance,
     using a given cutoff distance. It returns a scalar.
     Params:
         vector - Separation vector of two particles
         cutoff - Lennard Jones cutoff distance
+        table - Tables.PairTable to use instead of Lennard-Jones
     Returns:
         potential - potential energy scalar
     """
 
+    if table is not None:
+        r2 = np.dot(vector, vector)
+        return float(table.evaluate(r2)[1]) if r2 < cutoff**2 else 0
     r = np.linalg.norm(vector)
 
     # Calculate LJ potential, setting zero if outside cutoff radius
@@ -59,17 +183,21 @@ def LJ_Potential(vector, cutoff):
     return potential
 
 
-def LJ_Force(vector, cutoff):
+def LJ_Force(vector, cutoff, table=None):
     """This function calculates the Lennard-Jones force vector for a
     particle separated by the vector in distance,
     using a given cutoff distance. It returns an narray.
     Params:
         vector - Separation vector of two particles
         cutoff - Lennard Jones cutoff distance
+        table - Tables.PairTable to use instead of Lennard-Jones
     Returns:
         force - force vector
     """
 
+    if table is not None:
+        r2 = np.dot(vector, vector)
+        return table.evaluate(r2)[0]*vector if r2 < cutoff**2 else 0
     r = np.linalg.norm(vector)
     # Calculate LJ force, setting zero if outside cutoff radius.
     force = 48*(r**-14-0.5*r**-8)*vector if (r < cutoff) else 0
@@ -77,7 +205,7 @@ def LJ_Force(vector, cutoff):
     return force
 
 
-def Total_PE(particles, cutoff, boxdim):
+def Total_PE(particles, cutoff, boxdim, pairs=None, table=None):
     """This function returns the total calculated potential energy
     for a set of system positions given by an [N, 3]-dimensional
     narray, using a given LJ cutoff.
@@ -85,16 +213,20 @@ def Total_PE(particles, cutoff, boxdim):
         particles - [N, 3]-dimensional narray of all particle positions
         cutoff - Lennard Jones cutoff distance
         boxdim - Box dimension
+        pairs - Optional iterable of (i, j) index pairs to sum over,
+                defaults to all pairs i>j
+        table - Tables.PairTable to use instead of Lennard-Jones
     Returns:
         energy - potential energy scalar
     """
     N = len(particles)
+    if pairs is None:
+        pairs = ((i, j) for i in range(N) for j in range(i))
     energy = 0
-    for i in range(N):
-        for j in range(i):
-            # Find mutual potential for the interaction between particle i and j
-            sep = Particle3D.pbc_sep(particles[i], particles[j], boxdim)
-            energy += LJ_Potential(sep, cutoff)
+    for i, j in pairs:
+        # Find mutual potential for the interaction between particle i and j
+        sep = Particle3D.pbc_sep(particles[i], particles[j], boxdim)
+        energy += LJ_Potential(sep, cutoff, table)
 
     return energy
 
@@ -109,6 +241,28 @@ def Total_KE(velocities):
     return 0.5*mass*squares
 
 
+def Pair_histogram(pos, bins, boxdim):
+    """Given a [N,3]-dimensional narray of system positions, returns the
+    histogram of the minimum image distances of all particle pairs over
+    the given bins. Only pairs in the same or adjacent cells of a cell
+    list with cells of side bins[-1] are visited, in bounded blocks.
+    Params:
+        pos - [N,3] position array (for a single timestep)
+        bins - narray indicating the binning edges of the histogram
+        boxdim - PBC box dimension
+    Returns:
+        counts - [len(bins)-1] int narray of pair counts in each bin
+    """
+
+    counts = np.zeros(len(bins)-1, dtype=np.int64)
+    for i, j in iter_cell_pairs(pos, boxdim, bins[-1]):
+        for bi, bj in NumpyKernels.split_blocks(i, j):
+            r2 = NumpyKernels.pair_separations(pos, bi, bj, boxdim)[1]
+            counts += np.histogram(np.sqrt(r2), bins=bins)[0]
+
+    return counts
+
+
 def Bin_particles(pos, bins, boxdim):
     """Given a [N,3]-dimensional narray of system positions, this will
     calculate the distance between all particle pairs and bin these
@@ -122,37 +276,69 @@ def Bin_particles(pos, bins, boxdim):
         bin_entries - array with number of particles in each bin
     """
 
-    N = len(pos)
-    sep_arr = []
-    for i in range(N):
-        for j in range(i):
-            # Find distance between all pairs of points and append to array
-            arrow = pos[i] - pos[j]
-            rem = np.mod(arrow,boxdim) # The image in the first cube
-            mic_separation_vector = np.mod(rem+boxdim/2,boxdim)-boxdim/2
-            sep_arr.append(np.linalg.norm(mic_separation_vector))
+    return Pair_histogram(pos, bins, boxdim)/(len(pos)/2)
+
 
-    bin_entries = np.histogram(sep_arr, bins = bins)[0]/(N/2)
+def _histogram_frames(args):
+    """ Pool task returning the summed pair histogram of a block of frames,
+    weighted by the given frame weights if not None. """
 
-    return bin_entries
+    pos, bins, boxdim, weights = args
+    if weights is None:
+        return sum(Pair_histogram(cpos, bins, boxdim) for cpos in pos)
 
+    return sum(w*Pair_histogram(cpos, bins, boxdim) for cpos, w in zip(pos, weights))
 
-def RDF(pos, start, end, bins, boxdim):
+
+def Frame_weights(times):
+    """Given the narray of the times of a sequence of frames, returns the
+    narray of their weights in a time average, the time until the next
+    frame (until the previous one for the last frame), normalised to a
+    mean of 1. Evenly spaced frames all have weight 1."""
+
+    times = np.asarray(times, dtype=float)
+    if len(times) < 2:
+        return np.ones(len(times))
+    spans = np.diff(times)
+    weights = np.append(spans, spans[-1])
+
+    return weights/np.mean(weights)
+
+
+def RDF(pos, start, end, bins, boxdim, processes=None, times=None):
     """Given a [T, N,3]-dimensional narray of system positions indexed
     by time, this will calculate the radial density function histogram
     averaged from time start to end exclusive using the given bins.
+    The pair histograms are accumulated over the frames, which are shared
+    out in blocks to a pool of processes.
     Params:
         pos - [T,N,3] position array of all particles at all times
         start,end - Range of pos over which to calculate RDF
         bins - narray indicating the binning edges of the histogram
         boxdim - PBC box dimension
+        processes - Number of processes, defaults to one per core
+        times - Times of the frames of pos if they are not evenly spaced,
+                each frame is then weighted by the time until the next
     Returns:
         radial_density_histogram - Values of RDF
         rdf_positions - Position at which RDF is evaluated
     """
-    data = [Bin_particles(cpos, bins, boxdim) for cpos in pos[start:end]]
+    bins = np.asarray(bins, dtype=float)
+    frames = range(start, min(end, len(pos)))
+    processes = min(processes or os.cpu_count() or 1, len(frames))
+    # Blocks of frames small enough to balance the load between processes.
+    bounds = np.linspace(frames.start, frames.stop, 4*processes+1).astype(int)
+    weights = None if times is None else Frame_weights(times[frames.start:frames.stop])
+    tasks = [(np.asarray(pos[a:b]), bins, boxdim,
+              None if weights is None else weights[a-frames.start:b-frames.start])
+             for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    if processes > 1:
+        with mp.Pool(processes) as pool:
+            counts = sum(pool.imap_unordered(_histogram_frames, tasks))
+    else:
+        counts = sum(map(_histogram_frames, tasks))
 
-    radial_density_histogram = sum(data)/len(data)
+    radial_density_histogram = counts/(len(pos[0])/2)/len(frames)
     volumes = 4*np.pi*((bins[:-1]+bins[1:])/2)**2*(bins[1]-bins[0])
     radial_density_histogram = radial_density_histogram/volumes
     rdf_positions = (bins[:-1]+bins[1:])/2
@@ -188,30 +374,115 @@ def MSD(pos, start, end, boxdim):
 
     return mean_square_displacement
 
-def get_output(outfile, N):
+def Unwrap(pos, boxdim):
+    """Given a [T,N,3]-dimensional narray of positions in the periodic box,
+    returns the [T,N,3] float narray of unwrapped positions, which follow
+    the particles across the box boundaries. The frames must be close
+    enough that no particle moves more than half a box between them.
+    Params:
+        pos - [T,N,3] position array of all particles at all times
+        boxdim - PBC box dimension
+    Returns:
+        unwrapped - [T,N,3] array of continuous positions
+    """
+
+    unwrapped = np.array(pos, dtype=float)
+    steps = np.diff(unwrapped, axis=0)
+    steps -= boxdim*np.floor(steps/boxdim + 0.5) # Minimum image displacements
+    unwrapped[1:] = unwrapped[0] + np.cumsum(steps, axis=0)
+
+    return unwrapped
+
+
+def MSD_FFT(pos, start, end, boxdim, unwrapped=False, block=1024):
+    """Given a [T, N,3]-dimensional narray of system positions indexed
+    by time, this will calculate the mean square displacement for the
+    system from time start to end inclusive as a function of the lag time,
+    averaged over all particles and all time origins in the range.
+    The positions are unwrapped first, so the MSD keeps growing beyond
+    half the box, and the average over origins uses the FFT algorithm
+    MSD(m) = S1(m) - 2*S2(m), where S2 is the autocorrelation of the
+    positions, in O(T log T) per particle.
+    Params:
+        pos - [T,N,3] position array of all particles at all times
+        start,end - Range of pos over which to calculate MSD is [start,end]
+        boxdim - PBC box dimension
+        unwrapped - True if pos already holds unwrapped positions
+        block - Number of particles transformed at once
+    Returns:
+        mean_square_displacement - [end-start+1] narray of the MSD at lags
+                                   0 to end-start frames
+    """
+
+    T = end - start + 1
+    N = len(pos[start])
+    lags = T - np.arange(T) # Number of time origins of each lag
+    total = np.zeros(T)
+    for first in range(0, N, block):
+        x = np.asarray(pos[start:end+1, first:first+block], dtype=float)
+        if not unwrapped:
+            x = Unwrap(x, boxdim)
+        x -= x[0] # Keeps the products small relative to their difference
+
+        # S1(m) = sum over origins of |x(k+m)|^2 + |x(k)|^2.
+        D = np.einsum('tij,tij->t', x, x)
+        S1 = 2*D.sum() - np.concatenate(([0], np.cumsum(D)[:-1])) \
+                       - np.concatenate(([0], np.cumsum(D[::-1])[:-1]))
+        # S2(m) = sum over origins of x(k+m).x(k) from the FFT.
+        F = np.fft.rfft(x, n=2*T, axis=0)
+        S2 = np.fft.irfft(F*F.conj(), n=2*T, axis=0)[:T].sum(axis=(1,2))
+        total += S1 - 2*S2
+
+    mean_square_displacement = total/lags/N
+
+    return mean_square_displacement
+
+
+def Resample(pos, times, start, end, boxdim):
+    """Given a [T, N,3]-dimensional narray of system positions at the
+    unevenly spaced times, such as those of a run with an adaptive
+    timestep, returns the unwrapped positions of frames start to end
+    inclusive linearly interpolated onto evenly spaced times, as needed
+    by MSD_FFT with unwrapped=True.
+    Params:
+        pos - [T,N,3] position array of all particles at all times
+        times - [T] narray of the times of the frames
+        start,end - Range of pos to resample is [start,end]
+        boxdim - PBC box dimension
+    Returns:
+        resampled - [end-start+1,N,3] narray of unwrapped positions
+        lagtimes - [end-start+1] narray of the even times from times[start]
+    """
+
+    times = np.asarray(times[start:end+1], dtype=float) - times[start]
+    x = Unwrap(pos[start:end+1], boxdim)
+    lagtimes = np.linspace(0, times[-1], len(times))
+    k = np.clip(np.searchsorted(times, lagtimes, side='right'), 1, len(times)-1)
+    w = ((lagtimes - times[k-1])/(times[k] - times[k-1]))[:,None,None]
+
+    return (1-w)*x[k-1] + w*x[k], lagtimes
+
+
+def get_output(outfile, N=None, start=0, end=None, processes=None):
     """This function reads the positions from the output specified for VMD and
     creates an array that holds the positions of all the N elements at each
     timestep. It serves as a way to do calculations without running the simulation.
+    The frames are located with a cached index (see Trajectory.XYZTrajectory)
+    and parsed in parallel.
     Params:
         outfile - name of output file
-        N - number of particles
+        N - number of particles, checked against the file if given
+        start,end - Range of frames to read, defaults to all
+        processes - Number of parsing processes, defaults to one per core
     Returns:
         position_list - [T,N,3] array of all the positions
     """
 
-    # Read file and ignore the text
-    with open(outfile, 'r') as f:
-         position_list = np.array([line.strip().split() for line in f if not \
-         (line.startswith(('P')) or line.startswith((str(N))))])
-
-    # Process and split into elements of N position lists for each timestep.
-    position_list = np.split(position_list, len(position_list)/N)
-
-    # Make str values into float
-    for i in range(len(position_list)):
-        position_list[i] = np.array(position_list[i][:,[1,2,3]],float)
+    xyz = XYZTrajectory(outfile)
+    if N is not None and xyz.N != N:
+        raise ValueError('%s holds %i particles, not %i' % (outfile, xyz.N, N))
 
-    return position_list
+    return xyz.read_frames(start, end, processes=processes)
 
 
 def write_output(*args):
@@ -221,12 +492,4 @@ def write_output(*args):
     """
 
     outfile = args[0]
-    iters = len(args[1])
-    N = len(args)
-    with open(outfile, "w") as out:
-        for t in range(0,iters):
-            str = ''
-            for i in range(1,N):
-                str += "%f "% (args[i][t])
-            str += '\n'
-            out.write(str)
+    np.savetxt(outfile, np.column_stack(args[1:]), fmt='%f', newline=' \n')
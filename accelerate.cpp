@@ -3,17 +3,143 @@
     * accelerated functions and is imported as a library
     * into the Python code.
     * Note: Compilation might be necessary. See README file
+    * The kernels are multi-threaded with OpenMP when compiled with it,
+    * see compilec.py. Each thread accumulates forces in its own array,
+    * kept between calls, which are zeroed and summed in parallel.
+    * The single sweep force and energy kernels are templates on the type
+    * of the positions: with float positions the pairs are evaluated in
+    * single precision, and the forces and energies are still summed in
+    * double precision.
 */
 
 #include <math.h>
+#include <vector>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 using namespace std;
 
-double mod(double num, double div){
+
+void setthreads(int nthreads){
+    // Sets the number of threads used by the kernels, if compiled with OpenMP.
+
+#ifdef _OPENMP
+    if(nthreads > 0) omp_set_num_threads(nthreads);
+#endif
+    return;
+}
+
+
+int getthreads(){
+    // Returns the number of threads used by the kernels.
+
+#ifdef _OPENMP
+    return omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+
+// Force accumulators of the threads other than the first, (N,3) each. Kept
+// between calls and only regrown when N or the number of threads grows.
+static vector<double> thread_forces;
+
+
+void reserveforces(int N){
+    // Makes thread_forces large enough for N particles. Called outside of
+    // the parallel regions.
+
+    size_t size = (size_t)(getthreads()-1)*3*N;
+    if(thread_forces.size() < size) thread_forces.resize(size);
+    return;
+}
+
+
+double* threadforces(double* out_array, int N){
+    /* Zeroes and returns the force accumulator of the calling thread, called
+     * inside a parallel region. Thread 0 adds directly to out_array, every
+     * other thread t to its own (N,3) slice t-1 of thread_forces, so that
+     * the Newton's third law updates never race.
+     */
+
+    double* own = out_array;
+#ifdef _OPENMP
+    int t = omp_get_thread_num();
+    if(t > 0) own = thread_forces.data() + (size_t)(t-1)*3*N;
+#endif
+    for(int k = 0; k < 3*N; k++) own[k] = 0;
+
+    return own;
+}
+
+
+void reduceforces(double* out_array, int N){
+    /* Adds the force accumulators of the other threads of the team to
+     * out_array, shared out over the team. Called inside the parallel
+     * region after the pair loop, whose implicit barrier ensures all
+     * accumulators are complete.
+     */
+
+    int nlocal = 0;
+#ifdef _OPENMP
+    nlocal = omp_get_num_threads()-1;
+#endif
+    if(nlocal == 0) return;
+    #pragma omp for
+    for(int k = 0; k < 3*N; k++){
+        for(int t = 0; t < nlocal; t++) out_array[k] += thread_forces[(size_t)t*3*N + k];
+    }
+
+    return;
+}
+
+// Tabulated pair potential set by settable, used instead of Lennard-Jones
+// when table_n > 0. Per interval of r^2, table_coeffs holds the cubic
+// coefficients of the shifted energy followed by those of the force over r.
+static const double* table_coeffs = 0;
+static int table_n = 0;
+static double table_s0 = 0, table_inv_h = 0;
+
+
+void settable(double* coeffs, int n, double s0, double inv_h){
+    /* Sets the tabulated pair potential of n intervals of r^2 starting at
+     * s0 with inverse width inv_h, see Tables.py. n = 0 goes back to the
+     * Lennard-Jones kernels. coeffs must stay allocated while in use.
+     */
+
+    table_coeffs = coeffs;
+    table_n = n;
+    table_s0 = s0;
+    table_inv_h = inv_h;
+    return;
+}
+
+
+double tablepair(double r2, double* fscalar){
+    /* Interpolates the tabulated potential at squared distance r2, writes
+     * the force divided by r to fscalar and returns the shifted energy.
+     */
+
+    double x = (r2-table_s0)*table_inv_h;
+    int k = (int)x;
+    if(k < 0 || x < 0) k = 0;
+    if(k > table_n-1) k = table_n-1;
+    double t = x-k;
+    const double* c = table_coeffs + (size_t)k*8;
+    *fscalar = ((c[7]*t + c[6])*t + c[5])*t + c[4];
+
+    return ((c[3]*t + c[2])*t + c[1])*t + c[0];
+}
+
+
+template<typename real>
+real mod(real num, real div){
     // Implements a mod function for floating point numbers that always maps
     // to the range [0,div).
 
-    double res = fmod(num, div);
+    real res = fmod(num, div);
     return (res >= 0) ? res : res+div;
 }
 
@@ -33,6 +159,13 @@ void force(double* p1, double* p2, double* output, double boxdim, double cutoff)
     for(int i = 0; i < 3; i++) sep[i] = mod(sep[i], boxdim);
     for(int i = 0; i < 3; i++) sep[i] = mod(sep[i]+boxdim/2, boxdim) - boxdim/2;
 
+    if(table_n > 0){
+        double r2 = sep[0]*sep[0] + sep[1]*sep[1] + sep[2]*sep[2], fscalar = 0;
+        if(r2 < cutoff*cutoff) tablepair(r2, &fscalar);
+        for(int i = 0; i < 3; i++) output[i] = fscalar*sep[i];
+        return;
+    }
+
     // Calculate distance between particles.
     double r = sqrt(pow(sep[0], 2) + pow(sep[1], 2) + pow(sep[2], 2));
 
@@ -59,6 +192,11 @@ double potential(double* p1, double* p2, double boxdim, double cutoff){
     for(int i = 0; i < 3; i++) sep[i] = mod(sep[i], boxdim);
     for(int i = 0; i < 3; i++) sep[i] = mod(sep[i]+boxdim/2, boxdim) - boxdim/2;
 
+    if(table_n > 0){
+        double r2 = sep[0]*sep[0] + sep[1]*sep[1] + sep[2]*sep[2], fscalar;
+        return (r2 < cutoff*cutoff) ? tablepair(r2, &fscalar) : 0;
+    }
+
     // Calculate distance between particles.
     double r = sqrt(pow(sep[0], 2) + pow(sep[1], 2) + pow(sep[2], 2));
 
@@ -83,7 +221,24 @@ double KE(double* v){ //, double* out){
 }
 
 
-void addvector(double* invec, double* outvec, bool negative){
+template<typename real>
+real mic(real sep, real boxdim){
+    // Returns the minimum image of the separation component sep.
+
+    return mod(mod(sep, boxdim)+boxdim/2, boxdim) - boxdim/2;
+}
+
+
+template<>
+float mic(float sep, float boxdim){
+    // Minimum image in single precision by rounding, without the slow fmod.
+
+    return sep - boxdim*floorf(sep/boxdim + 0.5f);
+}
+
+
+template<typename real>
+void addvector(real* invec, double* outvec, bool negative){
   /* Adds the vector invec of length 3 to outvec of length 3. Both are arrays.
    * The parameter negative determines the sign of the addition. If True invec
    * is subtracted from outvec.
@@ -106,18 +261,23 @@ void getforces(double* in_array, double* out_array, int N, double boxdim, double
    * cutoff: double representing the LJ cutoff distance
    */
 
-    //Set output numpy array to zero
-    for(int i = 0; i<3*N; i++) out_array[i]=0;
-    // Setup temporary force vector;
-    double forcevar[3];
+    // Setup force accumulators of the threads other than the first.
+    reserveforces(N);
 
     // Calculate all forces by iterating over unique i, j pairs
-    for(int i = 0; i<N; i++){
-        for(int j = 0; j < i; j++){
-            force(in_array+i*3, in_array+j*3, forcevar, boxdim, cutoff);
-            addvector(forcevar, out_array+j*3, 0);
-            addvector(forcevar, out_array+i*3, 1); // F_reaction = -F_action
+    #pragma omp parallel
+    {
+        double forcevar[3];
+        double* own = threadforces(out_array, N);
+        #pragma omp for schedule(dynamic, 16)
+        for(int i = 0; i<N; i++){
+            for(int j = 0; j < i; j++){
+                force(in_array+i*3, in_array+j*3, forcevar, boxdim, cutoff);
+                addvector(forcevar, own+j*3, 0);
+                addvector(forcevar, own+i*3, 1); // F_reaction = -F_action
+            }
         }
+        reduceforces(out_array, N);
     }
 
     return;
@@ -142,6 +302,7 @@ void getenergies(double* pos_array, double* v_array, double* out_array,
     double poten = 0;
 
     // Calculate Potential energy for all pairs of particles
+    #pragma omp parallel for reduction(+:poten) schedule(dynamic, 16)
     for (int i = 0; i<N; i++){
       for (int j = 0; j < i; j++){
         poten += potential(pos_array+i*3, pos_array+j*3, boxdim, cutoff);
@@ -149,6 +310,7 @@ void getenergies(double* pos_array, double* v_array, double* out_array,
     }
 
     // Calculate Kinetic energy for all particles.
+    #pragma omp parallel for reduction(+:kinetic)
     for (int i = 0; i<N; i++){
         kinetic += KE(v_array+i*3);
     }
@@ -160,3 +322,423 @@ void getenergies(double* pos_array, double* v_array, double* out_array,
 
     return;
 }
+
+
+template<typename real>
+int buildcells(const real* pos_array, int N, double boxdim, double cutoff,
+                vector<int>& head, vector<int>& next){
+    /* Bins N particles into a linked cell list of ncell^3 cells of side
+     * >= cutoff and returns ncell. head[c] holds the first particle of cell c,
+     * next[i] the particle following i in its cell, -1 ends a cell.
+     * Returns 0 without binning if there are fewer than 3 cells per side.
+     */
+
+    int ncell = (int)(boxdim/cutoff);
+    if(ncell < 3) return 0;
+
+    head.assign(ncell*ncell*ncell, -1);
+    next.assign(N, -1);
+    for(int i = 0; i < N; i++){
+        int c[3];
+        for(int k = 0; k < 3; k++){
+            c[k] = (int)(mod((double)pos_array[i*3+k], boxdim)*ncell/boxdim);
+            if(c[k] >= ncell) c[k] = ncell-1; // Guard against rounding up
+        }
+        int cell = (c[0]*ncell + c[1])*ncell + c[2];
+        next[i] = head[cell];
+        head[cell] = i;
+    }
+
+    return ncell;
+}
+
+
+int neighbourcell(int cell, int offset, int ncell){
+    /* Returns the flat index of the cell at the given half-shell offset
+     * (0 to 13, 0 being the cell itself) from cell, respecting pbc.
+     */
+
+    static const int shell[14][3] = {{0,0,0}, {0,0,1}, {0,1,-1}, {0,1,0},
+        {0,1,1}, {1,-1,-1}, {1,-1,0}, {1,-1,1}, {1,0,-1}, {1,0,0}, {1,0,1},
+        {1,1,-1}, {1,1,0}, {1,1,1}};
+
+    int c[3] = {cell/(ncell*ncell), (cell/ncell)%ncell, cell%ncell};
+    for(int k = 0; k < 3; k++) c[k] = (c[k] + shell[offset][k] + ncell)%ncell;
+
+    return (c[0]*ncell + c[1])*ncell + c[2];
+}
+
+
+void getforces_cells(double* in_array, double* out_array, int N, double boxdim, double cutoff){
+    /* Calculates the forces between N particles using a linked cell list and
+     * writes the results to out_array. Only pairs in the same or adjacent
+     * cells are evaluated. Arguments as for getforces.
+     */
+
+    vector<int> head, next;
+    int ncell = buildcells(in_array, N, boxdim, cutoff, head, next);
+    if(ncell == 0){
+        getforces(in_array, out_array, N, boxdim, cutoff);
+        return;
+    }
+
+    reserveforces(N);
+
+    // Visit every cell and its 13 forward neighbours once.
+    #pragma omp parallel
+    {
+        double forcevar[3];
+        double* own = threadforces(out_array, N);
+        #pragma omp for schedule(dynamic, 4)
+        for(int cell = 0; cell < ncell*ncell*ncell; cell++){
+            for(int i = head[cell]; i >= 0; i = next[i]){
+                for(int offset = 0; offset < 14; offset++){
+                    // Within the own cell only take particles after i.
+                    int j = offset ? head[neighbourcell(cell, offset, ncell)] : next[i];
+                    for(; j >= 0; j = next[j]){
+                        force(in_array+i*3, in_array+j*3, forcevar, boxdim, cutoff);
+                        addvector(forcevar, own+j*3, 0);
+                        addvector(forcevar, own+i*3, 1); // F_reaction = -F_action
+                    }
+                }
+            }
+        }
+        reduceforces(out_array, N);
+    }
+
+    return;
+}
+
+
+void getenergies_cells(double* pos_array, double* v_array, double* out_array,
+                  int N, double boxdim, double cutoff){
+    /* Calculates the potential, kinetic and total energy between N particles
+     * using a linked cell list and writes the results to out_array.
+     * Arguments as for getenergies.
+     */
+
+    vector<int> head, next;
+    int ncell = buildcells(pos_array, N, boxdim, cutoff, head, next);
+    if(ncell == 0){
+        getenergies(pos_array, v_array, out_array, N, boxdim, cutoff);
+        return;
+    }
+
+    double kinetic = 0;
+    double poten = 0;
+
+    // Calculate Potential energy for all pairs in the same or adjacent cells
+    #pragma omp parallel for reduction(+:poten) schedule(dynamic, 4)
+    for(int cell = 0; cell < ncell*ncell*ncell; cell++){
+        for(int i = head[cell]; i >= 0; i = next[i]){
+            for(int offset = 0; offset < 14; offset++){
+                int j = offset ? head[neighbourcell(cell, offset, ncell)] : next[i];
+                for(; j >= 0; j = next[j]){
+                    poten += potential(pos_array+i*3, pos_array+j*3, boxdim, cutoff);
+                }
+            }
+        }
+    }
+
+    #pragma omp parallel for reduction(+:kinetic)
+    for (int i = 0; i<N; i++){
+        kinetic += KE(v_array+i*3);
+    }
+
+    out_array[0] = poten;
+    out_array[1] = kinetic;
+    out_array[2] = poten+kinetic;
+
+    return;
+}
+
+
+void getforces_list(double* in_array, double* out_array, int N, int* pairs_i,
+                    int* pairs_j, int npairs, double boxdim, double cutoff){
+    /* Calculates the forces between N particles over the npairs pairs of a
+     * neighbour list and writes the results to out_array.
+     * Param:
+     * pairs_i, pairs_j: Arrays of length npairs holding the pair indices.
+     * Other arguments as for getforces.
+     */
+
+    reserveforces(N);
+
+    #pragma omp parallel
+    {
+        double forcevar[3];
+        double* own = threadforces(out_array, N);
+        #pragma omp for
+        for(int p = 0; p < npairs; p++){
+            int i = pairs_i[p], j = pairs_j[p];
+            force(in_array+i*3, in_array+j*3, forcevar, boxdim, cutoff);
+            addvector(forcevar, own+j*3, 0);
+            addvector(forcevar, own+i*3, 1); // F_reaction = -F_action
+        }
+        reduceforces(out_array, N);
+    }
+
+    return;
+}
+
+
+void getenergies_list(double* pos_array, double* v_array, double* out_array,
+                      int N, int* pairs_i, int* pairs_j, int npairs,
+                      double boxdim, double cutoff){
+    /* Calculates the potential, kinetic and total energy between N particles
+     * over the npairs pairs of a neighbour list and writes the results to
+     * out_array. Arguments as for getenergies and getforces_list.
+     */
+
+    double kinetic = 0;
+    double poten = 0;
+
+    #pragma omp parallel for reduction(+:poten)
+    for(int p = 0; p < npairs; p++){
+        poten += potential(pos_array+pairs_i[p]*3, pos_array+pairs_j[p]*3, boxdim, cutoff);
+    }
+
+    #pragma omp parallel for reduction(+:kinetic)
+    for (int i = 0; i<N; i++){
+        kinetic += KE(v_array+i*3);
+    }
+
+    out_array[0] = poten;
+    out_array[1] = kinetic;
+    out_array[2] = poten+kinetic;
+
+    return;
+}
+
+
+template<typename real>
+real pairforce(const real* p1, const real* p2, real* output, real boxdim,
+               real cutoff, real shift, double* virial){
+    /* Calculates force, potential energy and virial of a pair of particles
+     * in a single evaluation, in the precision of real. Writes the force on
+     * p2 to output, adds the pair virial r.F to virial and returns the
+     * potential energy.
+     * Param:
+     * p1, p2: Arrays of length 3 representing the position vectors
+     * output: Array of length 3 where output vector is to be written.
+     * boxdim: real representing dimensions of PBC box.
+     * cutoff: real representing the LJ cutoff distance
+     * shift: potential at the cutoff, subtracted so that V(cutoff) = 0
+     * virial: pointer to the virial accumulator
+     */
+
+    // Calculates the MIC separation vector and stores it in sep.
+    real sep[3];
+    for(int i = 0; i < 3; i++) sep[i] = mic(p2[i]-p1[i], boxdim);
+
+    real r2 = sep[0]*sep[0] + sep[1]*sep[1] + sep[2]*sep[2];
+    if(r2 >= cutoff*cutoff){
+        for(int i = 0; i < 3; i++) output[i] = 0;
+        return 0;
+    }
+
+    if(table_n > 0){
+        double fscalar, energy = tablepair(r2, &fscalar);
+        for(int i = 0; i < 3; i++) output[i] = (real)fscalar*sep[i];
+        *virial += fscalar*r2;
+        return (real)energy;
+    }
+
+    // 48*(r^-14-0.5*r^-8) and 4*(r^-12-r^-6) from powers of 1/r^2.
+    real inv2 = 1/r2;
+    real inv6 = inv2*inv2*inv2;
+    real fscalar = 48*inv2*inv6*(inv6-(real)0.5);
+    for(int i = 0; i < 3; i++) output[i] = fscalar*sep[i];
+    *virial += fscalar*r2;
+
+    return 4*inv6*(inv6-1) - shift;
+}
+
+
+double cutoffshift(double cutoff){
+    // Returns the unshifted LJ potential at the cutoff distance.
+
+    return 4*(pow(cutoff,-12)-pow(cutoff,-6));
+}
+
+
+template<typename real>
+void forcesenergy(const real* in_array, double* out_array, double* energy_array,
+                  int N, double boxdim, double cutoff){
+    /* Calculates the forces between N particles together with their total
+     * potential energy and virial in a single sweep over all pairs.
+     * Param:
+     * in_array: Array of dimensions (N,3) that holds the positions of N particles.
+     * out_array: Array of dimensions (N,3) in which the forces are written.
+     * energy_array: Array of length 2 to which the potential energy and
+     *               the virial sum of r.F are written, in that order.
+     * N: Number of particles.
+     * boxdim: double representing dimensions of PBC box.
+     * cutoff: double representing the LJ cutoff distance
+     */
+
+    reserveforces(N);
+    double poten = 0, virial = 0;
+    real box = (real)boxdim, cut = (real)cutoff, shift = (real)cutoffshift(cutoff);
+
+    #pragma omp parallel reduction(+:poten, virial)
+    {
+        real forcevar[3];
+        double* own = threadforces(out_array, N);
+        #pragma omp for schedule(dynamic, 16)
+        for(int i = 0; i<N; i++){
+            for(int j = 0; j < i; j++){
+                poten += pairforce(in_array+i*3, in_array+j*3, forcevar, box,
+                                   cut, shift, &virial);
+                addvector(forcevar, own+j*3, 0);
+                addvector(forcevar, own+i*3, 1); // F_reaction = -F_action
+            }
+        }
+        reduceforces(out_array, N);
+    }
+
+    energy_array[0] = poten;
+    energy_array[1] = virial;
+
+    return;
+}
+
+
+template<typename real>
+void forcesenergy_cells(const real* in_array, double* out_array, double* energy_array,
+                        int N, double boxdim, double cutoff){
+    /* Calculates the forces, potential energy and virial of N particles in
+     * a single sweep using a linked cell list. Arguments as for
+     * forcesenergy.
+     */
+
+    vector<int> head, next;
+    int ncell = buildcells(in_array, N, boxdim, cutoff, head, next);
+    if(ncell == 0){
+        forcesenergy(in_array, out_array, energy_array, N, boxdim, cutoff);
+        return;
+    }
+
+    reserveforces(N);
+    double poten = 0, virial = 0;
+    real box = (real)boxdim, cut = (real)cutoff, shift = (real)cutoffshift(cutoff);
+
+    #pragma omp parallel reduction(+:poten, virial)
+    {
+        real forcevar[3];
+        double* own = threadforces(out_array, N);
+        #pragma omp for schedule(dynamic, 4)
+        for(int cell = 0; cell < ncell*ncell*ncell; cell++){
+            for(int i = head[cell]; i >= 0; i = next[i]){
+                for(int offset = 0; offset < 14; offset++){
+                    int j = offset ? head[neighbourcell(cell, offset, ncell)] : next[i];
+                    for(; j >= 0; j = next[j]){
+                        poten += pairforce(in_array+i*3, in_array+j*3, forcevar, box,
+                                           cut, shift, &virial);
+                        addvector(forcevar, own+j*3, 0);
+                        addvector(forcevar, own+i*3, 1); // F_reaction = -F_action
+                    }
+                }
+            }
+        }
+        reduceforces(out_array, N);
+    }
+
+    energy_array[0] = poten;
+    energy_array[1] = virial;
+
+    return;
+}
+
+
+template<typename real>
+void forcesenergy_list(const real* in_array, double* out_array, double* energy_array,
+                       int N, int* pairs_i, int* pairs_j, int npairs,
+                       double boxdim, double cutoff){
+    /* Calculates the forces, potential energy and virial of N particles in
+     * a single sweep over the npairs pairs of a neighbour list. Arguments
+     * as for forcesenergy and getforces_list.
+     */
+
+    reserveforces(N);
+    double poten = 0, virial = 0;
+    real box = (real)boxdim, cut = (real)cutoff, shift = (real)cutoffshift(cutoff);
+
+    #pragma omp parallel reduction(+:poten, virial)
+    {
+        real forcevar[3];
+        double* own = threadforces(out_array, N);
+        #pragma omp for
+        for(int p = 0; p < npairs; p++){
+            int i = pairs_i[p], j = pairs_j[p];
+            poten += pairforce(in_array+i*3, in_array+j*3, forcevar, box,
+                               cut, shift, &virial);
+            addvector(forcevar, own+j*3, 0);
+            addvector(forcevar, own+i*3, 1); // F_reaction = -F_action
+        }
+        reduceforces(out_array, N);
+    }
+
+    energy_array[0] = poten;
+    energy_array[1] = virial;
+
+    return;
+}
+
+
+void getforcesenergy(double* in_array, double* out_array, double* energy_array,
+                     int N, double boxdim, double cutoff){
+    // Double precision forcesenergy, see above.
+
+    forcesenergy(in_array, out_array, energy_array, N, boxdim, cutoff);
+    return;
+}
+
+
+void getforcesenergy_cells(double* in_array, double* out_array, double* energy_array,
+                           int N, double boxdim, double cutoff){
+    // Double precision forcesenergy_cells, see above.
+
+    forcesenergy_cells(in_array, out_array, energy_array, N, boxdim, cutoff);
+    return;
+}
+
+
+void getforcesenergy_list(double* in_array, double* out_array, double* energy_array,
+                          int N, int* pairs_i, int* pairs_j, int npairs,
+                          double boxdim, double cutoff){
+    // Double precision forcesenergy_list, see above.
+
+    forcesenergy_list(in_array, out_array, energy_array, N, pairs_i, pairs_j, npairs,
+                      boxdim, cutoff);
+    return;
+}
+
+
+void getforcesenergy_f(float* in_array, double* out_array, double* energy_array,
+                       int N, double boxdim, double cutoff){
+    // Mixed precision forcesenergy of float positions, see above.
+
+    forcesenergy(in_array, out_array, energy_array, N, boxdim, cutoff);
+    return;
+}
+
+
+void getforcesenergy_cells_f(float* in_array, double* out_array, double* energy_array,
+                             int N, double boxdim, double cutoff){
+    // Mixed precision forcesenergy_cells of float positions, see above.
+
+    forcesenergy_cells(in_array, out_array, energy_array, N, boxdim, cutoff);
+    return;
+}
+
+
+void getforcesenergy_list_f(float* in_array, double* out_array, double* energy_array,
+                            int N, int* pairs_i, int* pairs_j, int npairs,
+                            double boxdim, double cutoff){
+    // Mixed precision forcesenergy_list of float positions, see above.
+
+    forcesenergy_list(in_array, out_array, energy_array, N, pairs_i, pairs_j, npairs,
+                      boxdim, cutoff);
+    return;
+}
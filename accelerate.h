@@ -1,2 +1,15 @@
+void setthreads(int nthreads);
+int getthreads();
+void settable(double* coeffs, int n, double s0, double inv_h);
 void getforces(double* in_array, double* out_array, int N, double boxdim, double cutoff);
 void getenergies(double* pos_array, double* v_array, double* out_array, int N, double boxdim, double cutoff);
+void getforces_cells(double* in_array, double* out_array, int N, double boxdim, double cutoff);
+void getenergies_cells(double* pos_array, double* v_array, double* out_array, int N, double boxdim, double cutoff);
+void getforces_list(double* in_array, double* out_array, int N, int* pairs_i, int* pairs_j, int npairs, double boxdim, double cutoff);
+void getenergies_list(double* pos_array, double* v_array, double* out_array, int N, int* pairs_i, int* pairs_j, int npairs, double boxdim, double cutoff);
+void getforcesenergy(double* in_array, double* out_array, double* energy_array, int N, double boxdim, double cutoff);
+void getforcesenergy_cells(double* in_array, double* out_array, double* energy_array, int N, double boxdim, double cutoff);
+void getforcesenergy_list(double* in_array, double* out_array, double* energy_array, int N, int* pairs_i, int* pairs_j, int npairs, double boxdim, double cutoff);
+void getforcesenergy_f(float* in_array, double* out_array, double* energy_array, int N, double boxdim, double cutoff);
+void getforcesenergy_cells_f(float* in_array, double* out_array, double* energy_array, int N, double boxdim, double cutoff);
+void getforcesenergy_list_f(float* in_array, double* out_array, double* energy_array, int N, int* pairs_i, int* pairs_j, int npairs, double boxdim, double cutoff);
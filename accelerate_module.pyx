@@ -2,28 +2,220 @@
 # get_energies using C(++) accelerated code.
 # It is imported with "import accelerate_lib".
 # Activate C++ acceleration in Main.py by passing the argument "-a".
+# The C++ kernels run without holding the GIL, multi-threaded if the
+# library was compiled with OpenMP. See c_setthreads.
+# The _f functions take float32 positions for mixed precision.
 
 cimport numpy as np
 np.import_array()
 
 # Include python cfunction
-cdef extern from "accelerate.h":
+cdef extern from "accelerate.h" nogil:
+    void setthreads(int nthreads)
+    int getthreads()
+    void settable(double* coeffs, int n, double s0, double inv_h)
     void getforces(double* inarray, double* out_array, int N, double boxdim, double cutoff)
     void getenergies(double* inarray_v, double* inarray_pos, double* out_array,
                     int N, double boxdim, double cutoff)
+    void getforces_cells(double* inarray, double* out_array, int N, double boxdim, double cutoff)
+    void getenergies_cells(double* inarray_v, double* inarray_pos, double* out_array,
+                    int N, double boxdim, double cutoff)
+    void getforces_list(double* inarray, double* out_array, int N, int* pairs_i,
+                    int* pairs_j, int npairs, double boxdim, double cutoff)
+    void getenergies_list(double* inarray_v, double* inarray_pos, double* out_array,
+                    int N, int* pairs_i, int* pairs_j, int npairs,
+                    double boxdim, double cutoff)
+    void getforcesenergy(double* inarray, double* out_array, double* energy_array,
+                    int N, double boxdim, double cutoff)
+    void getforcesenergy_cells(double* inarray, double* out_array, double* energy_array,
+                    int N, double boxdim, double cutoff)
+    void getforcesenergy_list(double* inarray, double* out_array, double* energy_array,
+                    int N, int* pairs_i, int* pairs_j, int npairs,
+                    double boxdim, double cutoff)
+    void getforcesenergy_f(float* inarray, double* out_array, double* energy_array,
+                    int N, double boxdim, double cutoff)
+    void getforcesenergy_cells_f(float* inarray, double* out_array, double* energy_array,
+                    int N, double boxdim, double cutoff)
+    void getforcesenergy_list_f(float* inarray, double* out_array, double* energy_array,
+                    int N, int* pairs_i, int* pairs_j, int npairs,
+                    double boxdim, double cutoff)
 
 # Python wrapper for cfunction
+def c_setthreads(int nthreads):
+    setthreads(nthreads)
+    return
+
+def c_getthreads():
+    return getthreads()
+
+# Coefficients of the tabulated potential in use, kept alive while the
+# C++ kernels point into them.
+_table = None
+
+def c_settable(coeffs, double s0=0, double inv_h=0):
+    """Sets the [n,8] coefficient array of a tabulated pair potential,
+    see Tables.PairTable, or goes back to Lennard-Jones if coeffs is None."""
+    global _table
+    cdef np.ndarray[double, ndim=2, mode='c'] table
+    if coeffs is None or len(coeffs) == 0:
+        settable(NULL, 0, 0, 0)
+        _table = None
+        return
+    table = coeffs
+    settable(<double*> np.PyArray_DATA(table), table.shape[0], s0, inv_h)
+    _table = table
+    return
+
 def c_getforces(np.ndarray[double, ndim=2, mode='c'] in_array not None,
                 np.ndarray[double, ndim=2, mode='c'] out_array not None,
-                boxdim, cutoff):
-    getforces(<double*> np.PyArray_DATA(in_array), <double*> np.PyArray_DATA(out_array),
-              in_array.shape[0], boxdim, cutoff);
+                double boxdim, double cutoff):
+    cdef double* pos = <double*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef int N = in_array.shape[0]
+    with nogil:
+        getforces(pos, out, N, boxdim, cutoff)
     return
 
 def c_getenergies(np.ndarray[double, ndim=2, mode='c'] v_array not None,
                   np.ndarray[double, ndim=2, mode='c'] pos_array not None,
                   np.ndarray[double, ndim=1, mode='c'] out_array not None,
-                  boxdim, cutoff):
-    getenergies(<double*> np.PyArray_DATA(v_array), <double*> np.PyArray_DATA(pos_array),
-              <double*> np.PyArray_DATA(out_array), v_array.shape[0], boxdim, cutoff);
+                  double boxdim, double cutoff):
+    cdef double* v = <double*> np.PyArray_DATA(v_array)
+    cdef double* pos = <double*> np.PyArray_DATA(pos_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef int N = v_array.shape[0]
+    with nogil:
+        getenergies(v, pos, out, N, boxdim, cutoff)
+    return
+
+def c_getforces_cells(np.ndarray[double, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                double boxdim, double cutoff):
+    cdef double* pos = <double*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef int N = in_array.shape[0]
+    with nogil:
+        getforces_cells(pos, out, N, boxdim, cutoff)
+    return
+
+def c_getenergies_cells(np.ndarray[double, ndim=2, mode='c'] v_array not None,
+                  np.ndarray[double, ndim=2, mode='c'] pos_array not None,
+                  np.ndarray[double, ndim=1, mode='c'] out_array not None,
+                  double boxdim, double cutoff):
+    cdef double* v = <double*> np.PyArray_DATA(v_array)
+    cdef double* pos = <double*> np.PyArray_DATA(pos_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef int N = v_array.shape[0]
+    with nogil:
+        getenergies_cells(v, pos, out, N, boxdim, cutoff)
+    return
+
+def c_getforces_list(np.ndarray[double, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                np.ndarray[int, ndim=1, mode='c'] pairs_i not None,
+                np.ndarray[int, ndim=1, mode='c'] pairs_j not None,
+                double boxdim, double cutoff):
+    cdef double* pos = <double*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef int* pi = <int*> np.PyArray_DATA(pairs_i)
+    cdef int* pj = <int*> np.PyArray_DATA(pairs_j)
+    cdef int N = in_array.shape[0], npairs = pairs_i.shape[0]
+    with nogil:
+        getforces_list(pos, out, N, pi, pj, npairs, boxdim, cutoff)
+    return
+
+def c_getenergies_list(np.ndarray[double, ndim=2, mode='c'] v_array not None,
+                  np.ndarray[double, ndim=2, mode='c'] pos_array not None,
+                  np.ndarray[double, ndim=1, mode='c'] out_array not None,
+                  np.ndarray[int, ndim=1, mode='c'] pairs_i not None,
+                  np.ndarray[int, ndim=1, mode='c'] pairs_j not None,
+                  double boxdim, double cutoff):
+    cdef double* v = <double*> np.PyArray_DATA(v_array)
+    cdef double* pos = <double*> np.PyArray_DATA(pos_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef int* pi = <int*> np.PyArray_DATA(pairs_i)
+    cdef int* pj = <int*> np.PyArray_DATA(pairs_j)
+    cdef int N = v_array.shape[0], npairs = pairs_i.shape[0]
+    with nogil:
+        getenergies_list(v, pos, out, N, pi, pj, npairs, boxdim, cutoff)
+    return
+
+def c_getforcesenergy(np.ndarray[double, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                np.ndarray[double, ndim=1, mode='c'] energy_array not None,
+                double boxdim, double cutoff):
+    cdef double* pos = <double*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef double* energy = <double*> np.PyArray_DATA(energy_array)
+    cdef int N = in_array.shape[0]
+    with nogil:
+        getforcesenergy(pos, out, energy, N, boxdim, cutoff)
+    return
+
+def c_getforcesenergy_cells(np.ndarray[double, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                np.ndarray[double, ndim=1, mode='c'] energy_array not None,
+                double boxdim, double cutoff):
+    cdef double* pos = <double*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef double* energy = <double*> np.PyArray_DATA(energy_array)
+    cdef int N = in_array.shape[0]
+    with nogil:
+        getforcesenergy_cells(pos, out, energy, N, boxdim, cutoff)
+    return
+
+def c_getforcesenergy_list(np.ndarray[double, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                np.ndarray[double, ndim=1, mode='c'] energy_array not None,
+                np.ndarray[int, ndim=1, mode='c'] pairs_i not None,
+                np.ndarray[int, ndim=1, mode='c'] pairs_j not None,
+                double boxdim, double cutoff):
+    cdef double* pos = <double*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef double* energy = <double*> np.PyArray_DATA(energy_array)
+    cdef int* pi = <int*> np.PyArray_DATA(pairs_i)
+    cdef int* pj = <int*> np.PyArray_DATA(pairs_j)
+    cdef int N = in_array.shape[0], npairs = pairs_i.shape[0]
+    with nogil:
+        getforcesenergy_list(pos, out, energy, N, pi, pj, npairs, boxdim, cutoff)
+    return
+
+def c_getforcesenergy_f(np.ndarray[float, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                np.ndarray[double, ndim=1, mode='c'] energy_array not None,
+                double boxdim, double cutoff):
+    cdef float* pos = <float*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef double* energy = <double*> np.PyArray_DATA(energy_array)
+    cdef int N = in_array.shape[0]
+    with nogil:
+        getforcesenergy_f(pos, out, energy, N, boxdim, cutoff)
+    return
+
+def c_getforcesenergy_cells_f(np.ndarray[float, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                np.ndarray[double, ndim=1, mode='c'] energy_array not None,
+                double boxdim, double cutoff):
+    cdef float* pos = <float*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef double* energy = <double*> np.PyArray_DATA(energy_array)
+    cdef int N = in_array.shape[0]
+    with nogil:
+        getforcesenergy_cells_f(pos, out, energy, N, boxdim, cutoff)
+    return
+
+def c_getforcesenergy_list_f(np.ndarray[float, ndim=2, mode='c'] in_array not None,
+                np.ndarray[double, ndim=2, mode='c'] out_array not None,
+                np.ndarray[double, ndim=1, mode='c'] energy_array not None,
+                np.ndarray[int, ndim=1, mode='c'] pairs_i not None,
+                np.ndarray[int, ndim=1, mode='c'] pairs_j not None,
+                double boxdim, double cutoff):
+    cdef float* pos = <float*> np.PyArray_DATA(in_array)
+    cdef double* out = <double*> np.PyArray_DATA(out_array)
+    cdef double* energy = <double*> np.PyArray_DATA(energy_array)
+    cdef int* pi = <int*> np.PyArray_DATA(pairs_i)
+    cdef int* pj = <int*> np.PyArray_DATA(pairs_j)
+    cdef int N = in_array.shape[0], npairs = pairs_i.shape[0]
+    with nogil:
+        getforcesenergy_list_f(pos, out, energy, N, pi, pj, npairs, boxdim, cutoff)
     return
@@ -3,14 +3,22 @@ Use this code to compile the C++ acceleration library "accelerate_lib"
 Compilation is done using the command:
 python3 compilec.py build_ext --inplace
 Note: This requires Cython3.
+The library is built multi-threaded with OpenMP. On compilers without
+OpenMP support (e.g. Apple clang) build single-threaded with:
+LJ_OPENMP=0 python3 compilec.py build_ext --inplace
 """
 from distutils.core import setup, Extension
+import os
 import numpy
 from Cython.Distutils import build_ext
 
+openmp_flags = ['-fopenmp'] if os.environ.get('LJ_OPENMP', '1') != '0' else []
+
 setup( cmdclass={'build_ext': build_ext},
        ext_modules=[Extension("accelerate_lib",
        sources=["accelerate_module.pyx", "accelerate.cpp"],
        include_dirs=[numpy.get_include()],
+       extra_compile_args=['-O3'] + openmp_flags,
+       extra_link_args=openmp_flags,
        language='c++')]
 )